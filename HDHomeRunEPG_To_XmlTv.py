@@ -1,19 +1,39 @@
 
 import argparse
+import codecs
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import functools
+import gzip
+import hashlib
+import http.client
+import io
+import itertools
 import json
 import logging
 import os
+import queue
+import re
+import sqlite3
 import ssl
 import sys
+import threading
+import time
 import urllib.error
+import urllib.parse
 import urllib.request
 import xml.etree.ElementTree as ET
+from typing import Optional
 
 import pytz  # noqa: F401, E402
 from dotenv import load_dotenv  # noqa: F401, E402
 from tzlocal import get_localzone  # noqa: F401, E402
 
+import atomic_output
+import generate_m3u_from_xmltv
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -25,6 +45,9 @@ __license__ = "GPL"
 __version__ = "2.0.0"
 __maintainer__ = "Incubus Victim"
 
+class GuideError(Exception):
+    """A run that cannot produce the guide, already logged; the command line exits with status 1."""
+
 def setup_logging(debug_mode: str) -> logging.Logger:
     """Configure logging based on debug mode."""
     log_level = logging.INFO
@@ -40,143 +63,992 @@ def setup_logging(debug_mode: str) -> logging.Logger:
     logger_instance = logging.getLogger(__name__)
     return logger_instance
 
-def discover_device_auth(host: str) -> str:
+class Channel:
+    """Compact record of a tuned channel, keeping only the fields written to XMLTV."""
+
+    __slots__ = ("guide_number", "guide_name", "image_url")
+
+    def __init__(self, guide_number: str, guide_name: Optional[str], image_url: str = ""):
+        self.guide_number = sys.intern(guide_number)
+        self.guide_name = guide_name
+        self.image_url = image_url
+
+    @classmethod
+    def from_dict(cls, data: dict, image_url: Optional[str] = None) -> "Channel":
+        """Create a channel from a lineup.json entry or a saved channel dict."""
+        return cls(data.get("GuideNumber", ""), data.get("GuideName"),
+                   data.get("ImageURL", "") if image_url is None else image_url)
+
+    def to_dict(self) -> dict:
+        """Return the channel in lineup.json form, as stored in the guide state."""
+        data = {"GuideNumber": self.guide_number, "ImageURL": self.image_url}
+        if self.guide_name is not None:
+            data["GuideName"] = self.guide_name
+        return data
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Channel):
+            return NotImplemented
+        return all(getattr(self, slot) == getattr(other, slot) for slot in self.__slots__)
+
+    def __repr__(self) -> str:
+        return f"Channel({self.guide_number!r}, {self.guide_name!r})"
+
+class Programme:
+    """Compact record of a guide.php programme, with interned strings and None for missing fields."""
+
+    RECORD_SLOTS = ("guide_number", "start_time", "end_time", "title", "episode_title", "synopsis",
+                    "categories", "image_url", "episode_number", "original_airdate", "first")
+    __slots__ = RECORD_SLOTS
+
+    # Programme attribute for each guide.php key, in XMLTV emission order
+    FIELDS = (
+        ("title", "Title"),
+        ("episode_title", "EpisodeTitle"),
+        ("synopsis", "Synopsis"),
+        ("categories", "Filter"),
+        ("image_url", "ImageURL"),
+        ("episode_number", "EpisodeNumber"),
+        ("original_airdate", "OriginalAirdate"),
+        ("first", "First"),
+    )
+
+    def __init__(self, guide_number: str, start_time: int, end_time: int, title: Optional[str],
+                 episode_title: Optional[str] = None, synopsis: Optional[str] = None,
+                 categories: Optional[tuple] = None, image_url: Optional[str] = None,
+                 episode_number: Optional[str] = None, original_airdate: Optional[int] = None,
+                 first: Optional[bool] = None):
+        self.guide_number = sys.intern(guide_number)
+        self.start_time = start_time
+        self.end_time = end_time
+        self.title = sys.intern(title) if isinstance(title, str) else title
+        self.episode_title = episode_title
+        self.synopsis = synopsis
+        self.categories = tuple(sys.intern(category) for category in categories) if categories is not None else None
+        self.image_url = image_url
+        self.episode_number = episode_number
+        self.original_airdate = original_airdate
+        self.first = first
+
+    @classmethod
+    def from_dict(cls, guide_number: str, data: dict) -> "Programme":
+        """Create a programme from a guide.php Guide entry or a saved programme dict."""
+        return cls(
+            guide_number,
+            data["StartTime"],
+            data.get("EndTime", data["StartTime"]),
+            data["Title"],
+            data.get("EpisodeTitle"),
+            data.get("Synopsis"),
+            data.get("Filter"),
+            data.get("ImageURL"),
+            data.get("EpisodeNumber"),
+            data.get("OriginalAirdate"),
+            data.get("First"),
+        )
+
+    def to_dict(self) -> dict:
+        """Return the programme in guide.php form, as stored in the guide state."""
+        data = {"GuideNumber": self.guide_number, "StartTime": self.start_time, "EndTime": self.end_time}
+        for attribute, key in self.FIELDS:
+            value = getattr(self, attribute)
+            if value is not None:
+                data[key] = list(value) if attribute == "categories" else value
+        return data
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Programme):
+            return NotImplemented
+        return all(getattr(self, slot) == getattr(other, slot) for slot in self.RECORD_SLOTS)
+
+    def __repr__(self) -> str:
+        return f"Programme({self.guide_number!r}, {self.start_time!r}, {self.end_time!r}, {self.title!r})"
+
+class HttpSession:
+    """Pool of keep-alive HTTP(S) connections per host, with gzip transfer, redirects and proxies."""
+
+    # Statuses followed to their Location, and how many in a row, as urllib.request does
+    REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+    MAX_REDIRECTS = 10
+
+    def __init__(self, timeout: float = 60):
+        self.timeout = timeout
+        self.ssl_context = ssl._create_unverified_context()
+        self.proxies = urllib.request.getproxies()
+        self.requests = 0
+        self.connections = 0
+        self.bytes_on_wire = 0
+        self.bytes_decoded = 0
+        self._idle = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def _proxy(self, scheme: str, netloc: str) -> Optional[str]:
+        """Return the host:port of the proxy for the host, or None to connect directly."""
+        proxy = self.proxies.get(scheme)
+        if not proxy or urllib.request.proxy_bypass_environment(netloc, self.proxies):
+            return None
+        return urllib.parse.urlsplit(proxy if "://" in proxy else f"http://{proxy}").netloc.rpartition("@")[2]
+
+    def _connect(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        """Open a new connection to the host, through its proxy if there is one."""
+        with self._lock:
+            self.connections += 1
+        proxy = self._proxy(scheme, netloc)
+        if scheme == "https":
+            connection = http.client.HTTPSConnection(proxy or netloc, timeout=self.timeout, context=self.ssl_context)
+            if proxy:
+                connection.set_tunnel(netloc)
+            return connection
+        return http.client.HTTPConnection(proxy or netloc, timeout=self.timeout)
+
+    def _acquire(self, scheme: str, netloc: str) -> tuple:
+        """Borrow an idle connection to the host, returning (connection, reused)."""
+        with self._lock:
+            idle = self._idle[(scheme, netloc)]
+            if idle:
+                return idle.pop(), True
+        return self._connect(scheme, netloc), False
+
+    def _release(self, scheme: str, netloc: str, connection: http.client.HTTPConnection) -> None:
+        """Return a connection to the pool for reuse."""
+        with self._lock:
+            self._idle[(scheme, netloc)].append(connection)
+
+    def _request(self, parts: urllib.parse.SplitResult, headers: Optional[dict]) -> tuple:
+        """Send a GET on a pooled connection and return (connection, response) once the headers arrive."""
+        path = parts.path or "/"
+        if parts.query:
+            path = f"{path}?{parts.query}"
+        if parts.scheme == "http" and self._proxy(parts.scheme, parts.netloc):
+            # Plain HTTP proxies take the absolute URL
+            path = f"http://{parts.netloc}{path}"
+        headers = {"Accept-Encoding": "gzip", "Connection": "keep-alive", **(headers or {})}
+
+        connection, reused = self._acquire(parts.scheme, parts.netloc)
+        try:
+            try:
+                connection.request("GET", path, headers=headers)
+                return connection, connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                if not reused:
+                    raise
+                # The server closed the idle keep-alive connection, retry once on a fresh one
+                connection.close()
+                connection = self._connect(parts.scheme, parts.netloc)
+                connection.request("GET", path, headers=headers)
+                return connection, connection.getresponse()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            raise
+
+    def _follow(self, url: str, headers: Optional[dict]) -> tuple:
+        """Send a GET, following redirects, and return (url, parts, connection, response)."""
+        for _ in range(self.MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            connection, response = self._request(parts, headers)
+            location = response.getheader("Location")
+            if response.status not in self.REDIRECT_STATUSES or not location:
+                return url, parts, connection, response
+            try:
+                raw_body = response.read()
+            finally:
+                connection.close()
+            with self._lock:
+                self.requests += 1
+                self.bytes_on_wire += len(raw_body)
+            url = urllib.parse.urljoin(url, location)
+        raise urllib.error.HTTPError(url, response.status, "Too many redirects", response.headers, None)
+
+    def fetch(self, url: str, headers: Optional[dict] = None) -> tuple:
+        """GET a URL and return (status, headers, decoded body), raising HTTPError for 4xx/5xx."""
+        url, parts, connection, response = self._follow(url, headers)
+        try:
+            raw_body = response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(parts.scheme, parts.netloc, connection)
+
+        body = gzip.decompress(raw_body) if response.getheader("Content-Encoding", "").lower() == "gzip" else raw_body
+        with self._lock:
+            self.requests += 1
+            self.bytes_on_wire += len(raw_body)
+            self.bytes_decoded += len(body)
+        if response.status >= 400:
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+        return response.status, response.headers, body
+
+    @contextlib.contextmanager
+    def open(self, url: str, headers: Optional[dict] = None):
+        """GET a URL and yield a file streaming the decoded body, raising HTTPError unless 200."""
+        url, parts, connection, response = self._follow(url, headers)
+        if response.status != 200:
+            try:
+                raw_body = response.read()
+            finally:
+                connection.close()
+            body = gzip.decompress(raw_body) if response.getheader("Content-Encoding", "").lower() == "gzip" else raw_body
+            with self._lock:
+                self.requests += 1
+                self.bytes_on_wire += len(raw_body)
+                self.bytes_decoded += len(body)
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+
+        wire = _CountingReader(response)
+        decoded = _CountingReader(gzip.GzipFile(fileobj=wire, mode="rb")
+                                  if response.getheader("Content-Encoding", "").lower() == "gzip" else wire)
+        try:
+            yield decoded
+        except BaseException:
+            connection.close()
+            raise
+        finally:
+            with self._lock:
+                self.requests += 1
+                self.bytes_on_wire += wire.count
+                self.bytes_decoded += decoded.count
+        if response.isclosed() and not response.will_close:
+            self._release(parts.scheme, parts.netloc, connection)
+        else:
+            connection.close()
+
+    def get(self, url: str) -> bytes:
+        """GET a URL and return the decoded response body, raising urllib.error.HTTPError unless it is a 200."""
+        status, headers, body = self.fetch(url)
+        if status != 200:
+            raise urllib.error.HTTPError(url, status, f"Expected HTTP 200, got {status}", headers, io.BytesIO(body))
+        return body
+
+    def get_json(self, url: str):
+        """GET a URL and decode the response body as JSON."""
+        return json.loads(self.get(url).decode())
+
+    def log_stats(self) -> None:
+        """Log request, connection and transfer size counters."""
+        saved = 100 * (1 - self.bytes_on_wire / self.bytes_decoded) if self.bytes_decoded else 0
+        logger.info("HTTP: %d requests over %d connections, %d bytes on the wire, %d bytes decoded (%.1f%% saved)",
+                    self.requests, self.connections, self.bytes_on_wire, self.bytes_decoded, saved)
+
+    def close(self) -> None:
+        """Close every pooled connection."""
+        with self._lock:
+            idle, self._idle = self._idle, collections.defaultdict(list)
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+class _CountingReader:
+    """Wrap a binary file object, counting the bytes read through it."""
+
+    def __init__(self, file):
+        self.file = file
+        self.count = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.file.read(size)
+        self.count += len(data)
+        return data
+
+_JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+def iter_json_array(file, chunk_size: int = 65536):
+    """Yield the object or array elements of a JSON array streamed from a binary file."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    raw_decode = json.JSONDecoder().raw_decode
+    text = ""
+    position = 0
+    eof = False
+
+    def read(size: int) -> None:
+        # Drop the text already consumed and append the next chunk
+        nonlocal text, position, eof
+        chunk = file.read(size)
+        eof = not chunk
+        text = text[position:] + decoder.decode(chunk, final=eof)
+        position = 0
+
+    def next_char() -> str:
+        # Skip whitespace, reading on as needed; "" at the end of the document
+        nonlocal position
+        while True:
+            position = _JSON_WHITESPACE.match(text, position).end()
+            if position < len(text) or eof:
+                return text[position:position + 1]
+            read(chunk_size)
+
+    if next_char() != "[":
+        raise json.JSONDecodeError("Expecting a JSON array", text, position)
+    position += 1
+    if next_char() == "]":
+        position += 1
+    else:
+        while True:
+            if next_char() not in ("{", "["):
+                raise json.JSONDecodeError("Expecting an object or array element", text, position)
+            while True:
+                try:
+                    element, end = raw_decode(text, position)
+                    break
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    # Grow the read with the element so a large element is not rescanned per chunk
+                    read(max(chunk_size, len(text) - position))
+            position = end
+            yield element
+            char = next_char()
+            position += 1
+            if char == "]":
+                break
+            if char != ",":
+                raise json.JSONDecodeError("Expecting ',' delimiter", text, position - 1)
+    if next_char():
+        raise json.JSONDecodeError("Extra data", text, position)
+
+class GuideCache:
+    """On-disk cache of guide.php window responses, keyed by channel set and window start."""
+
+    def __init__(self, cache_dir: str, near_hours: float = 48, near_ttl: float = 1, far_ttl: float = 24):
+        self.cache_dir = cache_dir
+        self.near_hours = near_hours
+        self.near_ttl = near_ttl
+        self.far_ttl = far_ttl
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def channel_key(guide_numbers) -> str:
+        """Return a short stable key for a set of tuned guide numbers."""
+        joined = ",".join(sorted(str(guide_number) for guide_number in guide_numbers))
+        return hashlib.sha1(joined.encode()).hexdigest()[:16]
+
+    def _path(self, channel_key: str, start: int) -> str:
+        """Return the cache file path for a window."""
+        return os.path.join(self.cache_dir, f"guide-{channel_key}-{start}.json")
+
+    def _ttl(self, start: int, now: float) -> float:
+        """Return the time to live in seconds for a window starting at ``start``."""
+        near = start < now + self.near_hours * 3600
+        return (self.near_ttl if near else self.far_ttl) * 3600
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _load(self, path: str) -> Optional[dict]:
+        """Load a cache entry, treating unreadable entries as missing."""
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable guide cache entry %s: %s", path, e)
+            return None
+
+    def _store(self, path: str, entry: dict) -> None:
+        """Write a cache entry atomically so concurrent runs never read a partial file."""
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with atomic_output.atomic_write(path, encoding="utf-8") as f:
+                json.dump(entry, f)
+        except OSError as e:
+            logger.warning("Could not write guide cache entry %s: %s", path, e)
+
+    def fetch(self, session: HttpSession, url: str, channel_key: str, start: int, now: Optional[float] = None) -> list:
+        """Return the guide window starting at ``start``, from the cache when it is still fresh at ``now``."""
+        now = now if now is not None else time.time()
+        path = self._path(channel_key, start)
+        entry = self._load(path)
+        if entry is not None and now - entry["fetched"] < self._ttl(start, now):
+            self._count("hits")
+            logger.debug("Guide cache hit for window %d", start)
+            return entry["guide"]
+
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        status, response_headers, body = session.fetch(url, headers)
+        if status == 304 and entry is not None:
+            self._count("revalidated")
+            logger.debug("Guide cache revalidated window %d", start)
+        else:
+            self._count("misses")
+            logger.debug("Guide cache miss for window %d", start)
+            entry = {
+                "start": start,
+                "etag": response_headers.get("ETag"),
+                "last_modified": response_headers.get("Last-Modified"),
+                "guide": json.loads(body.decode()),
+            }
+        entry["fetched"] = now
+        self._store(path, entry)
+        return entry["guide"]
+
+    def prune(self, before: float) -> None:
+        """Delete cached windows that start before ``before``."""
+        try:
+            names = os.listdir(self.cache_dir)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if not (name.startswith("guide-") and name.endswith(".json")):
+                continue
+            try:
+                start = int(name[:-len(".json")].rsplit("-", 1)[1])
+            except (IndexError, ValueError):
+                continue
+            if start < before:
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError as e:
+                    logger.warning("Could not remove stale guide cache entry %s: %s", name, e)
+
+    def log_stats(self) -> None:
+        """Log cache hit, revalidation and miss counters."""
+        total = self.hits + self.revalidated + self.misses
+        ratio = 100 * (self.hits + self.revalidated) / total if total else 0
+        logger.info("Guide cache: %d hits, %d revalidated, %d misses (%.1f%% served from cache)",
+                    self.hits, self.revalidated, self.misses, ratio)
+
+class RunStats:
+    """Stage timings and counters of one generator run, rendered for the /metrics endpoint."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.stage_seconds = {}
+        self.programmes_ingested = 0
+        self.programmes_deduped = 0
+        self.guide_cutoff = None
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """Time the enclosed block, adding it to the named stage."""
+        began = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - began)
+
+    def add_time(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + seconds
+
+    def count_programmes(self, ingested: int, deduped: int) -> None:
+        with self._lock:
+            self.programmes_ingested += ingested
+            self.programmes_deduped += deduped
+
+    def guide_end(self, start_date: datetime.datetime) -> None:
+        """Record a window start the API refused with HTTP 400, keeping the earliest."""
+        start = int(start_date.timestamp())
+        with self._lock:
+            if self.guide_cutoff is None or start < self.guide_cutoff:
+                self.guide_cutoff = start
+
+    def to_prometheus(self, epg_data: dict, session: Optional[HttpSession] = None,
+                      cache: Optional[GuideCache] = None) -> str:
+        """Render the run as Prometheus text format gauges."""
+        lines = []
+
+        def gauge(name: str, help_text: str, samples: list) -> None:
+            lines.append(f"# HELP hdhomerun_epg_run_{name} {help_text}")
+            lines.append(f"# TYPE hdhomerun_epg_run_{name} gauge")
+            for labels, value in samples:
+                lines.append(f"hdhomerun_epg_run_{name}{labels} {value}")
+
+        gauge("timestamp_seconds", "Unix time the last generator run started.", [("", int(self.started))])
+        gauge("duration_seconds", "Wall clock duration of the last generator run.",
+              [("", round(time.time() - self.started, 6))])
+        gauge("stage_duration_seconds", "Duration of each stage of the last generator run.",
+              [(f'{{stage="{name}"}}', round(seconds, 6)) for name, seconds in self.stage_seconds.items()])
+        gauge("programmes", "Programmes received from the guide API, skipped as duplicates and written.",
+              [('{state="ingested"}', self.programmes_ingested), ('{state="deduped"}', self.programmes_deduped),
+               ('{state="written"}', len(epg_data.get("programmes", [])))])
+        gauge("channels", "Channels written by the last generator run.", [("", len(epg_data.get("channels", [])))])
+        if session is not None:
+            gauge("http_requests", "HTTP requests made to the device and guide API.", [("", session.requests)])
+            gauge("http_bytes", "Guide API response bytes on the wire and after decoding.",
+                  [('{body="wire"}', session.bytes_on_wire), ('{body="decoded"}', session.bytes_decoded)])
+        if cache is not None:
+            gauge("guide_cache_lookups", "Guide window cache lookups by result.",
+                  [('{result="hit"}', cache.hits), ('{result="revalidated"}', cache.revalidated),
+                   ('{result="miss"}', cache.misses)])
+        if self.guide_cutoff is not None:
+            gauge("guide_cutoff_timestamp_seconds", "Start of the first guide window refused with HTTP 400.",
+                  [("", self.guide_cutoff)])
+        return "\n".join(lines) + "\n"
+
+def discover_device_auth(host: str, session: Optional[HttpSession] = None) -> str:
     """Discover HDHomeRun device auth."""
+    session = session or HttpSession()
     try:
         logger.info("Fetching HDHomeRun Web API Device Auth")
-        with urllib.request.urlopen(f"http://{host}/discover.json") as response:
-            data = json.loads(response.read().decode())
-            for key in data:
-                if "DeviceAuth" in key:
-                    device_auth = data["DeviceAuth"]
-                    logger.info("Discovered device auth: %s", device_auth)
-                    return device_auth
+        data = session.get_json(f"http://{host}/discover.json")
+        for key in data:
+            if "DeviceAuth" in key:
+                device_auth = data["DeviceAuth"]
+                logger.info("Discovered device auth: %s", device_auth)
+                return device_auth
         logger.error("No devices found")
-        sys.exit(1)
+        raise GuideError("No devices found")
     except (json.JSONDecodeError, KeyError) as e:
         logger.error("Error discovering device: %s", e)
-        sys.exit(1)
+        raise GuideError(f"Error discovering device: {e}") from e
 
-def fetch_channels(host: str, device_auth: str) -> list:
+def fetch_channels(host: str, device_auth: str, session: Optional[HttpSession] = None) -> list:
     """Fetch EPG channels from HDHomeRun device."""
+    session = session or HttpSession()
     channel_data = []
     logger.info("Fetching HDHomeRun Web API Lineup for auth %s", device_auth)
     url = f"http://{host}/lineup.json"
-    with urllib.request.urlopen(url) as response:
-        channel_data = json.loads(response.read().decode())
+    channel_data = session.get_json(url)
 
     return channel_data
 
-def fetch_epg_data(device_auth: str, channels: list, days: int, hours: int) -> dict:
+def _fetch_guide_window(session: HttpSession, url: str, start_date: datetime.datetime,
+                        cache: Optional[GuideCache] = None, channel_key: str = "",
+                        guide_numbers: Optional[set] = None, now: Optional[float] = None) -> list:
+    """Fetch a guide.php window as (GuideNumber, ImageURL, programmes) per tuned channel."""
+    url_start_date = int(start_date.timestamp())
+    logger.debug("Fetching EPG for all channels starting %s from %s", start_date, url)
+    if cache is not None:
+        return _decode_guide_window(cache.fetch(session, f"{url}&Start={url_start_date}", channel_key, url_start_date,
+                                                now), guide_numbers)
+    with session.open(f"{url}&Start={url_start_date}") as response:
+        return _decode_guide_window(iter_json_array(response), guide_numbers)
+
+def _decode_guide_window(channel_epg_segments, guide_numbers: Optional[set] = None) -> list:
+    """Convert guide.php channel entries to (GuideNumber, ImageURL, programmes), skipping untuned channels."""
+    epg_segment = []
+    for channel_epg_segment in channel_epg_segments:
+        guide_number = channel_epg_segment["GuideNumber"]
+        # Check if the epg program channel is within our tuned channel list
+        if guide_numbers is not None and guide_number not in guide_numbers:
+            logger.debug("Skipping programs for untuned channel %s", guide_number)
+            continue
+        programmes = [Programme.from_dict(guide_number, programme) for programme in channel_epg_segment["Guide"]]
+        epg_segment.append((guide_number, channel_epg_segment.get("ImageURL", ""), programmes))
+    return epg_segment
+
+def _iter_guide_windows(fetch_window, window_starts: list, concurrency: int):
+    """Yield (start_date, epg_segment) for each guide window in time order, stopping at an HTTP 400."""
+    if concurrency <= 1:
+        for start_date in window_starts:
+            try:
+                epg_segment = fetch_window(start_date)
+            except urllib.error.HTTPError as e:
+                if _is_guide_end(e, start_date):
+                    return
+                raise
+            yield start_date, epg_segment
+        return
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="guide")
+    pending = collections.deque()
+    try:
+        remaining = iter(window_starts)
+        for start_date in itertools.islice(remaining, concurrency):
+            pending.append((start_date, executor.submit(fetch_window, start_date)))
+        while pending:
+            start_date, future = pending.popleft()
+            try:
+                epg_segment = future.result()
+            except urllib.error.HTTPError as e:
+                if _is_guide_end(e, start_date):
+                    return
+                raise
+            # Keep the pool busy with the next window before handing this one back
+            for next_start_date in itertools.islice(remaining, 1):
+                pending.append((next_start_date, executor.submit(fetch_window, next_start_date)))
+            yield start_date, epg_segment
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+def _iter_adaptive_guide_windows(fetch_window, start_date: datetime.datetime, end_time: datetime.datetime,
+                                 hours: int):
+    """Yield (start_date, epg_segment) for guide windows, stepping to where the last window ran out."""
+    while start_date < end_time:
+        try:
+            epg_segment = fetch_window(start_date)
+        except urllib.error.HTTPError as e:
+            if _is_guide_end(e, start_date):
+                return
+            raise
+        yield start_date, epg_segment
+
+        coverage_end = _guide_coverage_end(epg_segment)
+        if coverage_end is not None and coverage_end > start_date.timestamp():
+            next_start_date = datetime.datetime.fromtimestamp(coverage_end, tz=pytz.UTC)
+            logger.debug("Guide window from %s covered all channels until %s", start_date, next_start_date)
+        else:
+            next_start_date = start_date + datetime.timedelta(hours=hours)
+        start_date = next_start_date
+
+def _prefetch(iterable, depth: int):
+    """Yield the items of ``iterable``, produced up to ``depth`` ahead in a background thread."""
+    items = queue.Queue(maxsize=max(1, depth))
+    stopped = threading.Event()
+    done = object()
+
+    def put(entry: tuple) -> bool:
+        while not stopped.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce() -> None:
+        error = None
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException as e:  # re-raised in the consuming thread
+            error = e
+        finally:
+            close = getattr(iterable, "close", None)
+            if close is not None:
+                close()
+        put((done, error))
+
+    producer = threading.Thread(target=produce, name="guide-prefetch", daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
+        producer.join()
+
+def _guide_coverage_end(epg_segment: list) -> Optional[int]:
+    """Return the earliest per-channel latest EndTime of the tuned channels in a guide window."""
+    channel_ends = [
+        max(programme.end_time for programme in programmes)
+        for _, _, programmes in epg_segment
+        if programmes
+    ]
+    return min(channel_ends) if channel_ends else None
+
+def _is_guide_end(error: urllib.error.HTTPError, start_date: datetime.datetime) -> bool:
+    """Return True if the HTTP error marks the end of the available guide data."""
+    if error.code == 400:
+        logger.warning("HTTP 400 error at %s - API limit reached, stopping EPG fetch with available data", start_date.strftime("%Y-%m-%d %H:%M:%S"))
+        return True
+    logger.error("HTTP Error %d at %s: %s", error.code, start_date.strftime("%Y-%m-%d %H:%M:%S"), error)
+    return False
+
+def fetch_epg_data(device_auth: str, channels: list, days: int, hours: int, concurrency: int = 1,
+                   session: Optional[HttpSession] = None, adaptive: bool = False,
+                   cache: Optional[GuideCache] = None, start_date: Optional[datetime.datetime] = None,
+                   end_date: Optional[datetime.datetime] = None, stats: Optional[RunStats] = None,
+                   now: Optional[datetime.datetime] = None) -> dict:
     """Fetch EPG data for a specific channel via POST to HDHomeRun API."""
+    session = session or HttpSession()
     epg_data = {}
     epg_data["channels"] = []
     epg_data["programmes"] = []
     url = f"https://api.hdhomerun.com/api/guide.php?DeviceAuth={device_auth}"
+    # Index the tuned channels by guide number, keeping the first entry for any duplicates
+    channel_index = {}
+    for channel in channels:
+        channel_index.setdefault(channel.get("GuideNumber"), channel)
+    # Guide numbers already added to epg_data["channels"] and (GuideNumber, StartTime, Title) keys of stored programmes
+    epg_channel_numbers = set()
+    programme_keys = set()
     # Start with the now
-    next_start_date = datetime.datetime.now(pytz.UTC)
+    now = now or datetime.datetime.now(pytz.UTC)
+    next_start_date = start_date or now
     # End with the desired number of days
-    end_time = next_start_date + datetime.timedelta(days=days)
+    end_time = end_date or next_start_date + datetime.timedelta(days=days)
+    channel_key = ""
+    if cache is not None:
+        # Align the windows to the --hours grid so reruns request the same, cacheable, windows
+        stride = hours * 3600
+        start = int(next_start_date.timestamp())
+        next_start_date = datetime.datetime.fromtimestamp(start - start % stride, tz=pytz.UTC)
+        channel_key = GuideCache.channel_key(channel_index)
+        now_start = int(now.timestamp())
+        cache.prune(now_start - now_start % stride)
+
+    guide_numbers = set(channel_index)
 
+    def fetch_window(start_date: datetime.datetime) -> list:
+        try:
+            return _fetch_guide_window(session, url, start_date, cache, channel_key, guide_numbers, now.timestamp())
+        except urllib.error.HTTPError as e:
+            if stats is not None and e.code == 400:
+                stats.guide_end(start_date)
+            raise
+
+    if adaptive:
+        if concurrency > 1:
+            logger.info("Adaptive stepping requests guide windows one at a time, ignoring concurrency %d", concurrency)
+        guide_windows = _iter_adaptive_guide_windows(fetch_window, next_start_date, end_time, hours)
+    else:
+        # Request a window every number of hours
+        window_starts = []
+        window_start = next_start_date
+        while window_start < end_time:
+            window_starts.append(window_start)
+            window_start += datetime.timedelta(hours=hours)
+        guide_windows = _iter_guide_windows(fetch_window, window_starts, concurrency)
+    guide_windows = _prefetch(guide_windows, concurrency)
+
+    ingested = deduped = 0
+    transform_seconds = 0.0
     try:
-        while next_start_date < end_time:
-            url_start_date = int(next_start_date.timestamp())
-            context = ssl._create_unverified_context()
-            req = urllib.request.Request(f"{url}&Start={url_start_date}")
-            logger.debug("Fetching EPG for all channels starting %s from %s", next_start_date, url)
-            try:
-                with urllib.request.urlopen(req, context=context) as response:
-                    epg_segment = json.loads(response.read().decode())
-                    logger.info("Processing from %s", next_start_date.strftime("%Y-%m-%d %H:%M:%S"))
-                    for channel_epg_segment in epg_segment:
-                        programmes = channel_epg_segment["Guide"]
-                        for programme in programmes:
-                            channel = next((ch for ch in channels if ch.get("GuideNumber") == channel_epg_segment["GuideNumber"]), None)
-                            # Check if the epg program channel is within our tuned channel list
-                            if channel is None:
-                                logger.debug("Skipping program for untuned channel %s", channel_epg_segment['GuideNumber'])
-                                continue
-                            # Check if the epg program has already been retrieved due to overlapping requests
-                            if any(epg["StartTime"] == programme["StartTime"] and epg["Title"] == programme["Title"] and epg["GuideNumber"] == channel_epg_segment["GuideNumber"] for epg in epg_data["programmes"]):
-                                logger.debug("Skipping duplicate program %s starting at %s", programme["Title"], programme["StartTime"])
-                                continue
-                            epg_channel = next((ch for ch in epg_data["channels"] if ch.get("GuideNumber") == channel_epg_segment["GuideNumber"]), None)
-                            if epg_channel is None:
-                                channel["ImageURL"] = channel_epg_segment.get("ImageURL", "")
-                                epg_data["channels"].append(channel)
-                            programme["GuideNumber"] = channel_epg_segment["GuideNumber"]
-                            logger.debug("Appending: %s from %s to %s", programme["Title"], programme["StartTime"], programme["EndTime"])
-                            epg_data["programmes"].append(programme)
-            except urllib.error.HTTPError as e:
-                if e.code == 400:
-                    logger.warning("HTTP 400 error at %s - API limit reached, stopping EPG fetch with available data", next_start_date.strftime("%Y-%m-%d %H:%M:%S"))
-                    break
-                else:
-                    logger.error("HTTP Error %d at %s: %s", e.code, next_start_date.strftime("%Y-%m-%d %H:%M:%S"), e)
-                    raise
-            next_start_date += datetime.timedelta(hours=hours)
+        for next_start_date, epg_segment in guide_windows:
+            began = time.perf_counter()
+            logger.info("Processing from %s", next_start_date.strftime("%Y-%m-%d %H:%M:%S"))
+            for guide_number, image_url, programmes in epg_segment:
+                ingested += len(programmes)
+                for programme in programmes:
+                    # Check if the epg program has already been retrieved due to overlapping requests
+                    programme_key = (guide_number, programme.start_time, programme.title)
+                    if programme_key in programme_keys:
+                        logger.debug("Skipping duplicate program %s starting at %s", programme.title, programme.start_time)
+                        deduped += 1
+                        continue
+                    programme_keys.add(programme_key)
+                    if guide_number not in epg_channel_numbers:
+                        epg_data["channels"].append(Channel.from_dict(channel_index[guide_number], image_url))
+                        epg_channel_numbers.add(guide_number)
+                    logger.debug("Appending: %s from %s to %s", programme.title, programme.start_time, programme.end_time)
+                    epg_data["programmes"].append(programme)
+            transform_seconds += time.perf_counter() - began
         return epg_data
     except (json.JSONDecodeError, KeyError) as e:
         logger.error("Error fetching EPG for all channels for start time %s: %s", next_start_date, e)
         return epg_data
+    finally:
+        guide_windows.close()
+        if stats is not None:
+            stats.add_time("transform", transform_seconds)
+            stats.count_programmes(ingested, deduped)
+
+GUIDE_STATE_VERSION = 1
+
+def load_guide_state(state_file: str) -> Optional[dict]:
+    """Load the merged guide persisted by a previous incremental run as Channel and Programme records."""
+    try:
+        with open(state_file, encoding="utf-8") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        logger.info("No previous guide state at %s, fetching the full guide", state_file)
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable guide state %s: %s", state_file, e)
+        return None
+    if state.get("version") != GUIDE_STATE_VERSION:
+        logger.warning("Ignoring guide state %s with unsupported version %s", state_file, state.get("version"))
+        return None
+    try:
+        state["channels"] = [Channel.from_dict(channel) for channel in state.get("channels", [])]
+        state["programmes"] = [Programme.from_dict(programme["GuideNumber"], programme)
+                               for programme in state.get("programmes", [])]
+    except (KeyError, TypeError) as e:
+        logger.warning("Ignoring malformed guide state %s: %s", state_file, e)
+        return None
+    return state
 
-def create_xmltv_channel(channel_data: dict, xmltv_root: ET.Element) -> None:
+def save_guide_state(state_file: str, epg_data: dict) -> None:
+    """Persist the merged guide for the next incremental run."""
+    state = {
+        "version": GUIDE_STATE_VERSION,
+        "channels": [channel.to_dict() for channel in epg_data.get("channels", [])],
+        "programmes": [programme.to_dict() for programme in epg_data.get("programmes", [])],
+    }
+    try:
+        state_dir = os.path.dirname(state_file)
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+        with atomic_output.atomic_write(state_file, encoding="utf-8") as f:
+            json.dump(state, f)
+        logger.info("Saved guide state with %d programmes to %s", len(state["programmes"]), state_file)
+    except OSError as e:
+        logger.error("Error writing guide state %s: %s", state_file, e)
+
+def _guide_horizon(programmes: list) -> Optional[int]:
+    """Return the earliest per-channel latest EndTime, the point up to which every channel is covered."""
+    channel_ends = {}
+    for programme in programmes:
+        guide_number = programme.guide_number
+        channel_ends[guide_number] = max(channel_ends.get(guide_number, 0), programme.end_time)
+    return min(channel_ends.values()) if channel_ends else None
+
+def _guide_spans(programmes: list) -> dict:
+    """Return the (first StartTime, last EndTime) span of each channel's programmes."""
+    spans = {}
+    for programme in programmes:
+        guide_number = programme.guide_number
+        first, last = spans.get(guide_number, (programme.start_time, programme.end_time))
+        spans[guide_number] = (min(first, programme.start_time), max(last, programme.end_time))
+    return spans
+
+def merge_epg_data(previous: dict, *fresh: dict) -> dict:
+    """Merge freshly fetched guide data over the guide from a previous run."""
+    fresh_spans = [_guide_spans(epg_data["programmes"]) for epg_data in fresh]
+
+    def replaced(programme: Programme) -> bool:
+        for spans in fresh_spans:
+            span = spans.get(programme.guide_number)
+            if span and span[0] <= programme.start_time < span[1]:
+                return True
+        return False
+
+    programmes = [programme for epg_data in fresh for programme in epg_data["programmes"]]
+    programmes += [programme for programme in previous["programmes"] if not replaced(programme)]
+    programme_keys = set()
+    merged_programmes = []
+    for programme in sorted(programmes, key=lambda programme: programme.start_time):
+        programme_key = (programme.guide_number, programme.start_time, programme.title)
+        if programme_key not in programme_keys:
+            programme_keys.add(programme_key)
+            merged_programmes.append(programme)
+
+    channels = {}
+    for epg_data in (*fresh, previous):
+        for channel in epg_data["channels"]:
+            channels.setdefault(channel.guide_number, channel)
+    guide_numbers = {programme.guide_number for programme in merged_programmes}
+    return {
+        "channels": [channel for guide_number, channel in channels.items() if guide_number in guide_numbers],
+        "programmes": merged_programmes,
+    }
+
+def fetch_incremental_epg_data(device_auth: str, channels: list, days: int, hours: int, state: Optional[dict],
+                               refresh_hours: float, concurrency: int = 1, session: Optional[HttpSession] = None,
+                               adaptive: bool = False, cache: Optional[GuideCache] = None,
+                               stats: Optional[RunStats] = None, now: Optional[datetime.datetime] = None) -> dict:
+    """Fetch only the guide data missing from the state of a previous run."""
+    now = now or datetime.datetime.now(pytz.UTC)
+    end_time = now + datetime.timedelta(days=days)
+    tuned = {channel.get("GuideNumber") for channel in channels}
+    previous = {"channels": [], "programmes": []}
+    if state is not None:
+        previous["programmes"] = [
+            programme for programme in state.get("programmes", [])
+            if programme.end_time > now.timestamp() and programme.guide_number in tuned
+        ]
+        previous["channels"] = [channel for channel in state.get("channels", []) if channel.guide_number in tuned]
+    horizon = _guide_horizon(previous["programmes"])
+    band_end = now + datetime.timedelta(hours=refresh_hours)
+    if horizon is None or horizon <= band_end.timestamp():
+        logger.info("Previous guide does not extend past the refresh band, fetching the full guide")
+        return fetch_epg_data(device_auth, channels, days, hours, concurrency, session, adaptive, cache, stats=stats,
+                              now=now)
+
+    logger.info("Reusing %d programmes from the previous guide covering until %s",
+                len(previous["programmes"]), datetime.datetime.fromtimestamp(horizon, tz=pytz.UTC).strftime("%Y-%m-%d %H:%M:%S"))
+    fresh = [fetch_epg_data(device_auth, channels, days, hours, concurrency, session, adaptive, cache,
+                            start_date=now, end_date=band_end, stats=stats, now=now)]
+    if horizon < end_time.timestamp():
+        fresh.append(fetch_epg_data(device_auth, channels, days, hours, concurrency, session, adaptive, cache,
+                                    start_date=datetime.datetime.fromtimestamp(horizon, tz=pytz.UTC), end_date=end_time,
+                                    stats=stats, now=now))
+    return merge_epg_data(previous, *fresh)
+
+def create_xmltv_channel(channel_data: Channel, xmltv_root: ET.Element) -> None:
     """Create XMLTV channel element according to DTD."""
     # Create a stable channel ID based on guide number for M3U tvg-id matching
-    guide_number = channel_data.get("GuideNumber", "")
-    channel_id = guide_number
+    channel_id = channel_data.guide_number
+    guide_name = channel_data.guide_name if channel_data.guide_name is not None else "Unknown"
 
     channel = ET.SubElement(xmltv_root, "channel", id=channel_id)
-    ET.SubElement(channel, "display-name").text = channel_data.get("GuideName", "Unknown")
-    ET.SubElement(channel, "icon", src=channel_data["ImageURL"])
-    logger.debug("Created channel: %s (ID: %s)", channel_data.get('GuideName', 'Unknown'), channel_id)
+    ET.SubElement(channel, "display-name").text = guide_name
+    ET.SubElement(channel, "icon", src=channel_data.image_url)
+    logger.debug("Created channel: %s (ID: %s)", guide_name, channel_id)
 
-def create_xmltv_programme(programme_data: dict, channel_number: str, xmltv_root: ET.Element) -> None:
+# Guide timestamps cluster on half-hour boundaries shared by every channel, so the local time
+# conversions and XMLTV formatting below are memoized. The caches assume LOCAL_TZ does not change.
+XMLTV_TIME_CACHE_SIZE = 65536
+
+@functools.lru_cache(maxsize=XMLTV_TIME_CACHE_SIZE)
+def _local_datetime(timestamp: int) -> datetime.datetime:
+    """Convert an epoch timestamp to a datetime in the local timezone."""
+    return datetime.datetime.fromtimestamp(timestamp, tz=pytz.UTC).astimezone(LOCAL_TZ)
+
+@functools.lru_cache(maxsize=XMLTV_TIME_CACHE_SIZE)
+def _local_midnight(timestamp: int) -> datetime.datetime:
+    """Return local midnight on the day of an epoch timestamp."""
+    return _local_datetime(timestamp).replace(hour=0, minute=0, second=0, microsecond=0)
+
+@functools.lru_cache(maxsize=XMLTV_TIME_CACHE_SIZE)
+def _xmltv_times(start_timestamp: int, end_timestamp: int) -> tuple:
+    """Return the XMLTV (start, stop) attribute values for a programme."""
+    start_time = _local_datetime(start_timestamp)
+    end_time = start_time + datetime.timedelta(seconds=end_timestamp - start_timestamp)
+    return start_time.strftime("%Y%m%d%H%M%S %z"), end_time.strftime("%Y%m%d%H%M%S %z")
+
+@functools.lru_cache(maxsize=XMLTV_TIME_CACHE_SIZE)
+def _xmltv_date(timestamp: int) -> str:
+    """Return the XMLTV local date-time value, without offset, for an epoch timestamp."""
+    return _local_datetime(timestamp).strftime("%Y%m%d%H%M%S")
+
+def create_xmltv_programme(programme_data: Programme, channel_number: str, xmltv_root: ET.Element) -> None:
     """Create XMLTV programme element according to DTD."""
     try:
         # Create stable channel ID matching the format used in create_xmltv_channel
         channel_id = channel_number
 
-        start_time = datetime.datetime.fromtimestamp(programme_data["StartTime"], tz=pytz.UTC).astimezone(LOCAL_TZ)
-        duration = programme_data.get("EndTime", programme_data["StartTime"]) - programme_data["StartTime"]
-        end_time = start_time + datetime.timedelta(seconds=duration)
+        start, stop = _xmltv_times(programme_data.start_time, programme_data.end_time)
 
         programme = ET.SubElement(
             xmltv_root,
             "programme",
-            start=start_time.strftime("%Y%m%d%H%M%S %z"),
-            stop=end_time.strftime("%Y%m%d%H%M%S %z"),
+            start=start,
+            stop=stop,
             channel=channel_id
         )
 
         # NOTE: All key XMLTV elements are added below in DTD order, not all are used due to HDHomeRun data limitations.
         # <title>
-        ET.SubElement(programme, "title", lang="en").text = programme_data.get("Title")
+        ET.SubElement(programme, "title", lang="en").text = programme_data.title
         # <sub-title>
-        if "EpisodeTitle" in programme_data:
-            ET.SubElement(programme, "sub-title", lang="en").text = programme_data["EpisodeTitle"]
+        if programme_data.episode_title is not None:
+            ET.SubElement(programme, "sub-title", lang="en").text = programme_data.episode_title
         # <desc>
-        if "Synopsis" in programme_data:
-            ET.SubElement(programme, "desc", lang="en").text = programme_data["Synopsis"]
+        if programme_data.synopsis is not None:
+            ET.SubElement(programme, "desc", lang="en").text = programme_data.synopsis
         # <desc> - Could add another for a short description
         # <credits>
         # <date>
-        if "Filter" in programme_data:
-            for filter_item in programme_data["Filter"]:
+        if programme_data.categories is not None:
+            for filter_item in programme_data.categories:
                 ET.SubElement(programme, "category", lang="en").text = filter_item
         # <keyword>
         # <language>
         # <orig-language>
         # <length units="minutes">60</keyword>
         # <icon>
-        if "ImageURL" in programme_data:
-            ET.SubElement(programme, "icon", src=programme_data["ImageURL"])
+        if programme_data.image_url is not None:
+            ET.SubElement(programme, "icon", src=programme_data.image_url)
         # <url>
         # <country>
         # <episode-num system="xmltv_ns">1.0.0/0</episode-num>
-        if "EpisodeNumber" in programme_data:
+        if programme_data.episode_number is not None:
             try:
-                episode_number = programme_data["EpisodeNumber"]
+                episode_number = programme_data.episode_number
                 series = 0
                 episode = 0
                 if "S" in episode_number and "E" in episode_number:
@@ -185,80 +1057,394 @@ def create_xmltv_programme(programme_data: dict, channel_number: str, xmltv_root
                 ET.SubElement(programme, "episode-num", system="onscreen").text = episode_number
                 ET.SubElement(programme, "episode-num", system="xmltv_ns").text = f"{series}.{episode}.0/0"
             except (ValueError, TypeError):
-                logger.warning("Invalid Series/Episode data for %s", programme_data.get('Title'))
+                logger.warning("Invalid Series/Episode data for %s", programme_data.title)
         # <video>
         # <audio>
         # <previously-shown>
-        if "OriginalAirdate" in programme_data:
-            air_date = datetime.datetime.fromtimestamp(programme_data["OriginalAirdate"], tz=pytz.UTC).astimezone(LOCAL_TZ)
-            start_date = start_time.replace(hour=0, minute=0, second=0, microsecond=0)
+        if programme_data.original_airdate is not None:
+            air_date = _local_datetime(programme_data.original_airdate)
+            start_date = _local_midnight(programme_data.start_time)
             if air_date != start_date:
-                ET.SubElement(programme, "previously-shown").set("start", air_date.strftime("%Y%m%d%H%M%S"))
-            elif "First" in programme_data and not programme_data["First"]:
+                ET.SubElement(programme, "previously-shown").set("start", _xmltv_date(programme_data.original_airdate))
+            elif programme_data.first is not None and not programme_data.first:
                 ET.SubElement(programme, "previously-shown")
         # <new>
-        if "First" in programme_data and programme_data["First"]:
+        if programme_data.first:
             ET.SubElement(programme, "new")
         # <subtitles>
-        logger.debug("Created programme: %s", programme_data.get('Title'))
+        logger.debug("Created programme: %s", programme_data.title)
     except (KeyError, ValueError, TypeError) as e:
-        logger.error("Error creating programme for %s: %s", programme_data.get('Title', 'unknown'), e)
+        logger.error("Error creating programme for %s: %s", programme_data.title, e)
+
+class XmltvWriter:
+    """Stream an XMLTV document to a binary file one top level element at a time."""
+
+    def __init__(self, file, attrib: dict):
+        self.file = file
+        self.root = ET.Element("tv", attrib)
+        self._started = False
+
+    def __enter__(self):
+        self.file.write(b"<?xml version='1.0' encoding='UTF-8'?>\n")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+
+    def _start(self) -> None:
+        """Write the <tv> start tag before the first element."""
+        empty_root = ET.tostring(ET.Element("tv", self.root.attrib), encoding="unicode")
+        self.file.write(empty_root[:-len(" />")].encode() + b">")
+        self._started = True
 
-def generate_xmltv(host: str, days: int, hours: int, filename: str) -> None:
-    """Generate XMLTV file from HDHomeRun EPG data."""
-    # Initialize XMLTV root
-    xmltv_root = ET.Element("tv")
-    xmltv_root.set("source-info-name", "HDHomeRun")
-    xmltv_root.set("generator-info-name", "HDHomeRunEPG_to_XmlTv")
+    def write(self, fragment: bytes) -> None:
+        """Write pre-rendered elements, as returned by render_xmltv_elements."""
+        if fragment:
+            if not self._started:
+                self._start()
+            self.file.write(fragment)
+
+    def flush(self) -> None:
+        """Write out and discard the elements added to root since the last flush."""
+        self.write(render_xmltv_elements(self.root))
+
+    def close(self) -> None:
+        """Flush any remaining elements and end the document."""
+        self.flush()
+        if self._started:
+            self.file.write(b"\n</tv>")
+        else:
+            self.file.write(ET.tostring(ET.Element("tv", self.root.attrib), encoding="unicode").encode())
+
+def render_xmltv_elements(root: ET.Element) -> bytes:
+    """Serialise root's children as indented top level XMLTV elements and remove them from root."""
+    fragments = []
+    for element in root:
+        ET.indent(element, space="\t", level=1)
+        element.tail = None
+        fragments.append(b"\n\t" + ET.tostring(element, encoding="unicode").encode())
+    del root[:]
+    return b"".join(fragments)
+
+def render_channel_programmes(guide_number: str, programmes: list) -> bytes:
+    """Render one channel's <programme> elements as an XMLTV fragment."""
+    scratch_root = ET.Element("tv")
+    for guide_programme in programmes:
+        create_xmltv_programme(guide_programme, guide_number, scratch_root)
+    return render_xmltv_elements(scratch_root)
+
+def _render_channel_programmes_task(task: tuple) -> bytes:
+    """Process pool entry point for render_channel_programmes."""
+    return render_channel_programmes(*task)
+
+def group_programmes(programmes: list) -> dict:
+    """Group programmes by GuideNumber in a single pass, each channel's list sorted by StartTime."""
+    grouped = collections.defaultdict(list)
+    for programme in programmes:
+        grouped[programme.guide_number].append(programme)
+    for channel_programmes in grouped.values():
+        channel_programmes.sort(key=lambda programme: programme.start_time)
+    return grouped
+
+# zlib's default level: most of the size reduction of level 9 at a fraction of the CPU time
+GZIP_COMPRESS_LEVEL = 6
+
+class _DigestFile:
+    """Binary file-like sink that only hashes what is written to it."""
+
+    def __init__(self):
+        self.hash = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        self.hash.update(data)
+        return len(data)
+
+def digest_path(filename: str) -> str:
+    """Return the path of the SHA-256 sidecar written next to an output file."""
+    return f"{filename}.sha256"
+
+def read_digest(filename: str) -> Optional[str]:
+    """Return the SHA-256 hex digest recorded for an output file, or None if there is none."""
+    try:
+        with open(digest_path(filename), encoding="utf-8") as f:
+            return f.read().split()[0]
+    except (OSError, IndexError):
+        return None
+
+def _write_digest(filename: str, digest: str) -> None:
+    """Atomically write a sidecar in ``sha256sum`` format for an output file."""
+    try:
+        with atomic_output.atomic_write(digest_path(filename), encoding="utf-8") as f:
+            f.write(f"{digest}  {os.path.basename(filename)}\n")
+    except OSError as e:
+        logger.warning("Could not write digest for %s: %s", filename, e)
+
+def metrics_path(filename: str) -> str:
+    """Return the path of the run metrics sidecar written next to the XMLTV file."""
+    return f"{filename}.metrics"
+
+def write_run_metrics(filename: str, metrics: str) -> None:
+    """Atomically write the Prometheus text format metrics of a run next to the XMLTV file."""
+    try:
+        with atomic_output.atomic_write(metrics_path(filename), encoding="utf-8") as f:
+            f.write(metrics)
+    except OSError as e:
+        logger.warning("Could not write run metrics for %s: %s", filename, e)
+
+def write_xmltv(epg_data: dict, filename: str, workers: int = 1, gzip_output: bool = False) -> str:
+    """Transform EPG data into XMLTV, write it atomically and return its SHA-256 hex digest."""
+    # Create parent directories if they don't exist
+    output_dir = os.path.dirname(filename)
+    if output_dir and not os.path.exists(output_dir):
+        logger.debug("Creating output directory: %s", output_dir)
+        os.makedirs(output_dir, exist_ok=True)
+    attrib = {"source-info-name": "HDHomeRun", "generator-info-name": "HDHomeRunEPG_to_XmlTv"}
+    outputs = [filename] + ([f"{filename}.gz"] if gzip_output else [])
+    digest = _DigestFile()
+    with atomic_output.temporary_outputs(outputs) as tmp_outputs:
+        with contextlib.ExitStack() as stack:
+            files = [digest]
+            for tmp_output in tmp_outputs:
+                file = stack.enter_context(open(tmp_output, "wb"))
+                # Runs after everything written to the file has been closed, before the file itself
+                stack.callback(atomic_output.fsync_file, file)
+                files.append(file)
+            if gzip_output:
+                # A fixed mtime keeps the compressed file identical for identical guides
+                files[-1] = stack.enter_context(gzip.GzipFile(outputs[-1], "wb", GZIP_COMPRESS_LEVEL, files[-1], mtime=0))
+            writer = stack.enter_context(XmltvWriter(atomic_output.TeeWriter(*files), attrib))
+            # Create the xmltv list of channels and programmes
+            for guide_channel in epg_data.get("channels", []):
+                create_xmltv_channel(guide_channel, writer.root)
+                writer.flush()
+            programmes_by_channel = group_programmes(epg_data.get("programmes", []))
+            tasks = [
+                (guide_channel.guide_number, programmes_by_channel.get(guide_channel.guide_number, []))
+                for guide_channel in epg_data.get("channels", [])
+            ]
+            if workers > 1 and len(tasks) > 1:
+                logger.debug("Rendering programmes for %d channels with %d worker processes", len(tasks), workers)
+                with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                    chunksize = max(1, len(tasks) // (workers * 4))
+                    for fragment in executor.map(_render_channel_programmes_task, tasks, chunksize=chunksize):
+                        writer.write(fragment)
+            else:
+                for task in tasks:
+                    writer.write(render_channel_programmes(*task))
+
+        hexdigest = digest.hash.hexdigest()
+        if read_digest(filename) == hexdigest and all(os.path.exists(output) for output in outputs):
+            logger.info("XMLTV content unchanged (sha256 %s), leaving %s untouched", hexdigest, filename)
+            return hexdigest
+        atomic_output.replace_files(tmp_outputs, outputs)
+    _write_digest(filename, hexdigest)
+    return hexdigest
+
+GUIDE_STORE_VERSION = 1
+
+GUIDE_STORE_SCHEMA = """
+CREATE TABLE channels (
+    guide_number TEXT PRIMARY KEY,
+    guide_name TEXT,
+    image_url TEXT,
+    position INTEGER NOT NULL
+);
+CREATE TABLE programmes (
+    guide_number TEXT NOT NULL,
+    start_time INTEGER NOT NULL,
+    end_time INTEGER NOT NULL,
+    title TEXT,
+    episode_title TEXT,
+    synopsis TEXT,
+    categories TEXT,
+    image_url TEXT,
+    episode_number TEXT,
+    original_airdate INTEGER,
+    first INTEGER
+);
+"""
+
+# Created after the bulk insert, which is much faster than maintaining them row by row
+GUIDE_STORE_INDEXES = """
+CREATE INDEX programmes_channel_start ON programmes (guide_number, start_time);
+CREATE INDEX programmes_start_end ON programmes (start_time, end_time);
+"""
+
+def write_sqlite(epg_data: dict, filename: str) -> None:
+    """Write the guide atomically to a SQLite database indexed by (channel, start) and (start, stop)."""
+    output_dir = os.path.dirname(filename)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with atomic_output.temporary_outputs([filename]) as (tmp_filename,):
+        # A file left by a crashed run with the same process and thread id would already hold the schema
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_filename)
+        connection = sqlite3.connect(tmp_filename, isolation_level=None)
+        try:
+            # The file is renamed into place only once complete, so the rollback journal is not needed
+            connection.execute("PRAGMA journal_mode = OFF")
+            connection.execute(f"PRAGMA user_version = {GUIDE_STORE_VERSION}")
+            connection.executescript(GUIDE_STORE_SCHEMA)
+            connection.execute("BEGIN")
+            connection.executemany(
+                "INSERT OR IGNORE INTO channels VALUES (?, ?, ?, ?)",
+                ((channel.guide_number, channel.guide_name, channel.image_url, position)
+                 for position, channel in enumerate(epg_data.get("channels", []))),
+            )
+            connection.executemany(
+                "INSERT INTO programmes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                ((programme.guide_number, programme.start_time, programme.end_time, programme.title,
+                  programme.episode_title, programme.synopsis,
+                  json.dumps(programme.categories) if programme.categories is not None else None,
+                  programme.image_url, programme.episode_number, programme.original_airdate, programme.first)
+                 for programme in epg_data.get("programmes", [])),
+            )
+            connection.execute("COMMIT")
+            connection.executescript(GUIDE_STORE_INDEXES)
+            connection.execute("ANALYZE")
+        finally:
+            connection.close()
+        atomic_output.fsync_path(tmp_filename)
+        atomic_output.replace_files([tmp_filename], [filename])
+
+def open_guide_store(filename: str) -> sqlite3.Connection:
+    """Open a guide database written by write_sqlite read-only."""
+    connection = sqlite3.connect(f"file:{urllib.parse.quote(os.path.abspath(filename))}?mode=ro", uri=True,
+                                 check_same_thread=False)
+    version = connection.execute("PRAGMA user_version").fetchone()[0]
+    if version != GUIDE_STORE_VERSION:
+        connection.close()
+        raise sqlite3.DatabaseError(f"Unsupported guide database version {version} in {filename}")
+    return connection
+
+def query_programmes(connection: sqlite3.Connection, guide_number: Optional[str], start: int, end: int) -> list:
+    """Return the programmes on a channel, or every channel if None, airing in [start, end)."""
+    columns = ("guide_number, start_time, end_time, title, episode_title, synopsis, categories, image_url, "
+               "episode_number, original_airdate, first")
+    if guide_number is None:
+        rows = connection.execute(
+            f"SELECT {columns} FROM programmes WHERE start_time < ? AND end_time > ? "
+            "ORDER BY guide_number, start_time", (end, start))
+    else:
+        rows = connection.execute(
+            f"SELECT {columns} FROM programmes WHERE guide_number = ? AND start_time < ? AND end_time > ? "
+            "ORDER BY start_time", (guide_number, end, start))
+    return [
+        Programme(row[0], row[1], row[2], row[3], row[4], row[5],
+                  json.loads(row[6]) if row[6] is not None else None, row[7], row[8], row[9],
+                  bool(row[10]) if row[10] is not None else None)
+        for row in rows
+    ]
+
+def m3u_channels(channels: list) -> list:
+    """Return the playlist entries for Channel records that generate_m3u_from_xmltv reads back from the XMLTV."""
+    entries = []
+    for channel in channels:
+        # Matches create_xmltv_channel, and extract_channel_info skipping channels without a name
+        name = channel.guide_name if channel.guide_name is not None else "Unknown"
+        if channel.guide_number and name:
+            entries.append({"id": channel.guide_number, "name": name, "icon": channel.image_url or None})
+    return entries
+
+def generate_xmltv(host: str, days: int, hours: int, filename: str, concurrency: int = 1,
+                   adaptive: bool = False, cache: Optional[GuideCache] = None,
+                   state_file: Optional[str] = None, refresh_hours: float = 24, workers: int = 1,
+                   gzip_output: bool = False, sqlite_file: Optional[str] = None,
+                   m3u_file: Optional[str] = None, m3u_server_url: Optional[str] = None) -> None:
+    """Generate XMLTV file, and optionally an M3U playlist and SQLite guide, from HDHomeRun EPG data."""
+    # Share keep-alive connections between the device and guide API requests
+    session = HttpSession()
+    stats = RunStats()
 
     # Discover device authentication
-    device_auth = discover_device_auth(host)
+    with stats.stage("discover"):
+        device_auth = discover_device_auth(host, session)
 
     # Fetch channel list
-    channels = fetch_channels(host, device_auth)
+    with stats.stage("lineup"):
+        channels = fetch_channels(host, device_auth, session)
     if not channels:
         logger.error("No channels retrieved. Exiting.")
-        sys.exit(1)
+        raise GuideError("No channels retrieved")
 
     # Fetch EPG data for all channels
     logger.info("HDHomeRun RPG Extraction Started")
-    epg_data = fetch_epg_data(device_auth, channels, days, hours)
+    with stats.stage("fetch"):
+        if state_file:
+            state = load_guide_state(state_file)
+            epg_data = fetch_incremental_epg_data(device_auth, channels, days, hours, state, refresh_hours,
+                                                  concurrency, session, adaptive, cache, stats)
+        else:
+            epg_data = fetch_epg_data(device_auth, channels, days, hours, concurrency, session, adaptive, cache,
+                                      stats=stats)
     logger.info("HDHomeRun RPG Extraction Completed")
+    session.log_stats()
+    if cache is not None:
+        cache.log_stats()
+    session.close()
 
-    # Create the xmltv list of channels and programmes
-    logger.info("HDHomeRun XMLTV Transformation Started")
-    for guide_channel in epg_data.get("channels", []):
-        create_xmltv_channel(guide_channel, xmltv_root)
-    for guide_channel in epg_data.get("channels", []):
-        guide_number = guide_channel.get("GuideNumber", "")
-        for guide_programme in epg_data.get("programmes", []):
-            if guide_programme.get("GuideNumber") == guide_number:
-                create_xmltv_programme(guide_programme, guide_number, xmltv_root)
-    logger.info("HDHomeRun XMLTV Transformation Completed")
-
-    # Write to XML file
+    # Transform to XMLTV, streaming each element to the XML file as it is created
     try:
         logger.info("Writing XMLTV to file %s Started", filename)
-        # Create parent directories if they don't exist
-        output_dir = os.path.dirname(filename)
-        if output_dir and not os.path.exists(output_dir):
-            logger.debug("Creating output directory: %s", output_dir)
-            os.makedirs(output_dir, exist_ok=True)
-        tree = ET.ElementTree(xmltv_root)
-        ET.indent(tree, space="\t", level=0)
-        tree.write(filename, encoding="UTF-8", xml_declaration=True)
-        logger.info("Writing XMLTV to file %s Completed", filename)
+        with stats.stage("write"):
+            digest = write_xmltv(epg_data, filename, workers, gzip_output)
+        logger.info("Writing XMLTV to file %s Completed (sha256 %s)", filename, digest)
     except OSError as e:
         logger.error("Error writing XML file: %s", e)
-        sys.exit(1)
+        raise GuideError(f"Error writing XML file: {e}") from e
+
+    if sqlite_file:
+        try:
+            logger.info("Writing guide database %s Started", sqlite_file)
+            with stats.stage("sqlite"):
+                write_sqlite(epg_data, sqlite_file)
+            logger.info("Writing guide database %s Completed", sqlite_file)
+        except (OSError, sqlite3.Error) as e:
+            logger.error("Error writing guide database: %s", e)
+            raise GuideError(f"Error writing guide database: {e}") from e
+
+    if state_file:
+        save_guide_state(state_file, epg_data)
+
+    # A playlist that cannot be written fails the run only once the guide state and metrics are saved
+    m3u_error = None
+    if m3u_file:
+        try:
+            logger.info("Writing M3U playlist %s Started", m3u_file)
+            with stats.stage("m3u"):
+                replaced = generate_m3u_from_xmltv.write_m3u(m3u_channels(epg_data["channels"]),
+                                                             m3u_server_url or f"http://{host}:5004", m3u_file,
+                                                             gzip_output)
+            logger.info("Writing M3U playlist %s Completed%s", m3u_file, "" if replaced else " (unchanged)")
+        except OSError as e:
+            logger.error("Error writing M3U playlist: %s", e)
+            m3u_error = e
+
+    write_run_metrics(filename, stats.to_prometheus(epg_data, session, cache))
+    if m3u_error is not None:
+        raise GuideError(f"Error writing M3U playlist: {m3u_error}") from m3u_error
 
-def main():
-    """Main function to parse arguments and generate XMLTV file."""
+def build_config(argv: Optional[list] = None) -> argparse.Namespace:
+    """Parse the run configuration from argv if given, or the command line, with defaults from the environment."""
     # Get defaults from environment variables
     env_host = os.getenv("HDHOMERUN_HOST", "hdhomerun.local")
     env_filename = os.getenv("EPG_OUTPUT_FILE", "output/epg.xml")
     env_days = int(os.getenv("EPG_DAYS", "7"))
     env_hours = int(os.getenv("EPG_HOURS", "3"))
+    env_concurrency = int(os.getenv("EPG_CONCURRENCY", "1"))
+    env_adaptive = os.getenv("EPG_ADAPTIVE", "false").lower() in ("1", "true", "yes", "on")
+    env_cache_dir = os.getenv("EPG_CACHE_DIR", "")
+    env_cache_near_hours = float(os.getenv("EPG_CACHE_NEAR_HOURS", "48"))
+    env_cache_near_ttl = float(os.getenv("EPG_CACHE_NEAR_TTL", "1"))
+    env_cache_far_ttl = float(os.getenv("EPG_CACHE_FAR_TTL", "24"))
+    env_state_file = os.getenv("EPG_STATE_FILE", "")
+    env_refresh_hours = float(os.getenv("EPG_REFRESH_HOURS", "24"))
+    env_workers = int(os.getenv("EPG_WORKERS", "1"))
+    env_gzip = os.getenv("EPG_GZIP", "false").lower() in ("1", "true", "yes", "on")
+    env_sqlite_file = os.getenv("EPG_SQLITE_FILE", "")
+    env_m3u_file = os.getenv("M3U_OUTPUT_FILE", "")
+    env_m3u_server_url = os.getenv("M3U_SERVER_URL", "")
     env_debug = os.getenv("DEBUG", "on")
 
     parser = argparse.ArgumentParser(
@@ -270,18 +1456,49 @@ def main():
     parser.add_argument("--filename", default=env_filename, help="The file path and name of the EPG to be generated. Defaults to output/epg.xml in the current directory.")
     parser.add_argument("--days", type=int, default=env_days, help="The number of days in the future from now to obtain an EPG for. Defaults to 7 but will be restricted to a max of about 14 by the HDHomeRun device.")
     parser.add_argument("--hours", type=int, default=env_hours, help="The number of hours of guide interation to obtain. Defaults to 3 hours.")
+    parser.add_argument("--concurrency", type=int, default=env_concurrency, help="The number of guide windows to request from the HDHomeRun API in parallel. Defaults to 1.")
+    parser.add_argument("--adaptive", action="store_true", default=env_adaptive, help="Start each guide request where the previous response ran out for every channel instead of stepping by --hours.")
+    parser.add_argument("--cache-dir", default=env_cache_dir, help="Directory to cache guide API responses in between runs. Caching is off unless this is set.")
+    parser.add_argument("--cache-near-hours", type=float, default=env_cache_near_hours, help="Guide windows starting within this many hours from now use the near-term cache TTL. Defaults to 48.")
+    parser.add_argument("--cache-near-ttl", type=float, default=env_cache_near_ttl, help="Hours a cached near-term guide window stays fresh. Defaults to 1.")
+    parser.add_argument("--cache-far-ttl", type=float, default=env_cache_far_ttl, help="Hours a cached far-future guide window stays fresh. Defaults to 24.")
+    parser.add_argument("--state-file", default=env_state_file, help="File to keep the merged guide in between runs. When set, only the refresh band and windows beyond the previously covered horizon are fetched.")
+    parser.add_argument("--refresh-hours", type=float, default=env_refresh_hours, help="Hours from now that are always refetched when using --state-file. Defaults to 24.")
+    parser.add_argument("--workers", type=int, default=env_workers, help="The number of processes used to render programmes to XMLTV. Defaults to 1.")
+    parser.add_argument("--gzip", action="store_true", default=env_gzip, help="Also write a gzip compressed copy of the EPG to the file name with .gz appended.")
+    parser.add_argument("--m3u-file", default=env_m3u_file, help="Also write an M3U playlist of the guide's channels to this file, in the format of generate_m3u_from_xmltv.py.")
+    parser.add_argument("--m3u-server-url", default=env_m3u_server_url, help="Base URL of the channel streams in the M3U playlist. Defaults to port 5004 on --host.")
+    parser.add_argument("--sqlite-file", default=env_sqlite_file, help="Also write the guide to this SQLite database, indexed for channel and time range queries.")
     parser.add_argument("--debug", default=env_debug, help="Switch debug log message on, options are \"on\", \"full\" or \"off\". Defaults to \"on\"")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if args.help:
         parser.print_help()
         sys.exit(0)
+    return args
+
+def run(config: argparse.Namespace) -> None:
+    """Generate the guide configured by build_config, raising GuideError if it cannot be produced."""
+    cache = None
+    if config.cache_dir:
+        cache = GuideCache(config.cache_dir, config.cache_near_hours, config.cache_near_ttl, config.cache_far_ttl)
+
+    generate_xmltv(config.host, config.days, config.hours, config.filename, config.concurrency, config.adaptive,
+                   cache, config.state_file, config.refresh_hours, config.workers, config.gzip, config.sqlite_file,
+                   config.m3u_file, config.m3u_server_url)
+
+def main(argv: Optional[list] = None):
+    """Main function to parse arguments, from argv if given, and generate XMLTV file."""
+    config = build_config(argv)
 
     global logger
-    logger = setup_logging(args.debug)
+    logger = setup_logging(config.debug)
 
-    generate_xmltv(args.host, args.days, args.hours, args.filename)
+    try:
+        run(config)
+    except GuideError:
+        sys.exit(1)
 
 # Initialize local timezone with fallback to UTC
 LOCAL_TZ = None
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Atomic file output shared by the XMLTV generator and the M3U playlist generator.
+
+Outputs are written to temporary files next to them, flushed to disk and renamed over the
+previous files, so a reader never sees a partial file and a failed write leaves the old one intact.
+"""
+
+import contextlib
+import filecmp
+import os
+import threading
+from typing import Optional
+
+
+class TeeWriter:
+    """Write the same text or bytes to several files."""
+
+    def __init__(self, *files):
+        self.files = files
+
+    def write(self, data):
+        for file in self.files:
+            file.write(data)
+        return len(data)
+
+
+def fsync_file(f) -> None:
+    """Flush a file through to the disk."""
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def fsync_path(path: str) -> None:
+    """Flush a file written by another library through to the disk."""
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+
+
+def fsync_directory(path: str) -> None:
+    """Persist renames in a directory, where the platform supports opening directories."""
+    try:
+        fd = os.open(path or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def temporary_path(path: str) -> str:
+    """Return a temporary path next to path, unique to this process and thread."""
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+@contextlib.contextmanager
+def temporary_outputs(output_files: list):
+    """Yield a temporary path for each output, removing any not renamed into place when the block exits."""
+    tmp_files = [temporary_path(output) for output in output_files]
+    try:
+        yield tmp_files
+    finally:
+        for tmp in tmp_files:
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+
+
+def replace_files(tmp_files: list, output_files: list) -> None:
+    """Rename finished temporary files over the outputs, given the plain output first."""
+    # Replace the compressed copy first so the plain file is never newer than its .gz
+    for tmp, output in reversed(list(zip(tmp_files, output_files))):
+        os.replace(tmp, output)
+    for directory in {os.path.dirname(output) for output in output_files}:
+        fsync_directory(directory)
+
+
+def replace_outputs(tmp_files: list, output_files: list) -> bool:
+    """Rename finished temporary files over the outputs unless every output already has the same content.
+
+    Returns True if the outputs were replaced. Unchanged outputs keep their mtime so clients do
+    not reimport them.
+    """
+    if all(os.path.exists(output) and filecmp.cmp(tmp, output, shallow=False)
+           for tmp, output in zip(tmp_files, output_files)):
+        for tmp in tmp_files:
+            os.remove(tmp)
+        return False
+    replace_files(tmp_files, output_files)
+    return True
+
+
+@contextlib.contextmanager
+def atomic_write(path: str, mode: str = "w", encoding: Optional[str] = None):
+    """Open a temporary file to write path, renamed over it once the block finishes and it is on disk."""
+    with temporary_outputs([path]) as (tmp,):
+        with open(tmp, mode, encoding=encoding) as f:
+            yield f
+            fsync_file(f)
+        replace_files([tmp], [path])
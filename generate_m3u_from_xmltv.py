@@ -7,16 +7,21 @@ playlist with tvg-id values that match the XMLTV channel IDs. This ensures that
 IPTV apps like UHF can correctly link the playlist channels to EPG data.
 
 Usage:
-    python generate_m3u_from_xmltv.py epg.xml output.m3u [--server-url http://your-server:8000]
+    python generate_m3u_from_xmltv.py epg.xml output.m3u [--server-url http://your-server:8000] [--gzip]
 
 Example:
     python generate_m3u_from_xmltv.py epg.xml playlist.m3u --server-url http://192.168.1.100:8000
 """
 
 import argparse
+import contextlib
+import gzip
+import io
 import sys
 import xml.etree.ElementTree as ET
 
+import atomic_output
+
 
 def extract_channel_info(xmltv_file: str) -> list:
     """Extract channel information from XMLTV file."""
@@ -63,10 +68,25 @@ def extract_channel_number(channel_id: str) -> str:
     return channel_id
 
 
-def generate_m3u(channels: list, server_url: str, output_file: str) -> None:
-    """Generate M3U playlist file."""
-    try:
-        with open(output_file, 'w', encoding='utf-8') as f:
+def write_m3u(channels: list, server_url: str, output_file: str, gzip_output: bool = False) -> bool:
+    """Write the M3U playlist, and a gzip compressed copy at output_file + '.gz' if requested.
+
+    The playlist is written to temporary files renamed over the previous ones, so a server never
+    reads a partial playlist, and an unchanged playlist is left untouched. Returns True if the
+    playlist was replaced. Raises OSError, after removing the temporary files, if it cannot be
+    written.
+    """
+    output_files = [output_file] + ([output_file + '.gz'] if gzip_output else [])
+    with atomic_output.temporary_outputs(output_files) as tmp_files:
+        with contextlib.ExitStack() as stack:
+            f = stack.enter_context(open(tmp_files[0], 'w', encoding='utf-8'))
+            stack.callback(atomic_output.fsync_file, f)
+            if gzip_output:
+                # Compress in the same pass, with a fixed mtime so unchanged playlists compress identically
+                raw = stack.enter_context(open(tmp_files[1], 'wb'))
+                stack.callback(atomic_output.fsync_file, raw)
+                compressed = gzip.GzipFile(output_files[1], 'wb', 6, raw, mtime=0)
+                f = atomic_output.TeeWriter(f, stack.enter_context(io.TextIOWrapper(compressed, encoding='utf-8')))
             # Write M3U header (matching HDHomeRun native format)
             f.write("#EXTM3U\n")
 
@@ -77,7 +97,6 @@ def generate_m3u(channels: list, server_url: str, output_file: str) -> None:
                 channel_number = extract_channel_number(channel_id)
 
                 # Build EXTINF line (matching HDHomeRun native format)
-                print(f"DEBUG: channel_id={channel_id}, channel_number={channel_number}")
                 extinf_line = f'#EXTINF:-1 tvg-id="{channel_number}" channel-id="{channel_number}" channel-number="{channel_number}" tvg-name="{channel_name}"'
 
                 # Add icon if available
@@ -95,18 +114,35 @@ def generate_m3u(channels: list, server_url: str, output_file: str) -> None:
                 url = f"{server_url}/auto/v{channel_number}\n"
                 f.write(url)
 
-        print(f"✓ Successfully generated M3U playlist: {output_file}")
-        print(f"  - Total channels: {len(channels)}")
-        print(f"  - Server URL: {server_url}")
-        print("\nNext steps:")
-        print(f"1. Verify the playlist looks correct: less {output_file}")
-        print(f"2. Test channel matching: python test_m3u_xmltv_matching.py {output_file} epg.xml")
-        print("3. Upload to your server and add to UHF app settings")
+        return atomic_output.replace_outputs(tmp_files, output_files)
+
+
+def generate_m3u(channels: list, server_url: str, output_file: str, gzip_output: bool = False) -> None:
+    """Generate M3U playlist file, and a gzip compressed copy at output_file + '.gz' if requested.
 
+    Prints the playlist written and the next steps, and exits if it cannot be written.
+    """
+    for channel in channels:
+        print(f"DEBUG: channel_id={channel['id']}, channel_number={extract_channel_number(channel['id'])}")
+    try:
+        replaced = write_m3u(channels, server_url, output_file, gzip_output)
     except OSError as e:
         print(f"ERROR: Could not write M3U file: {e}")
         sys.exit(1)
 
+    if not replaced:
+        print(f"✓ M3U playlist unchanged, left untouched: {output_file}")
+        return
+    print(f"✓ Successfully generated M3U playlist: {output_file}")
+    if gzip_output:
+        print(f"  - Compressed copy: {output_file}.gz")
+    print(f"  - Total channels: {len(channels)}")
+    print(f"  - Server URL: {server_url}")
+    print("\nNext steps:")
+    print(f"1. Verify the playlist looks correct: less {output_file}")
+    print(f"2. Test channel matching: python test_m3u_xmltv_matching.py {output_file} epg.xml")
+    print("3. Upload to your server and add to UHF app settings")
+
 
 def main():
     """Main function."""
@@ -126,6 +162,11 @@ def main():
         default="http://127.0.0.1:8000",
         help="Base URL for streaming (default: http://127.0.0.1:8000)"
     )
+    parser.add_argument(
+        "--gzip",
+        action="store_true",
+        help="Also write a gzip compressed copy of the playlist to the output file name with .gz appended"
+    )
 
     args = parser.parse_args()
 
@@ -136,7 +177,7 @@ def main():
 
     # Generate M3U
     print("\nGenerating M3U playlist...")
-    generate_m3u(channels, args.server_url, args.output_file)
+    generate_m3u(channels, args.server_url, args.output_file, args.gzip)
 
 
 if __name__ == "__main__":
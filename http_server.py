@@ -4,71 +4,861 @@ Simple HTTP server to serve the generated XMLTV EPG file and M3U playlist.
 This allows external applications like Jellyfin to access the EPG and playlist via HTTP.
 """
 
+import bisect
+import collections
+import datetime
+import email.utils
+import gzip
+import hashlib
+import itertools
+import json
 import logging
+import mmap
 import os
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+import struct
+import threading
+import time
+import urllib.parse
+import xml.parsers.expat
+import zlib
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import quoteattr
 
 logger = logging.getLogger(__name__)
 
 
+# Files at least this large are streamed from disk with sendfile rather than held in memory
+DEFAULT_SENDFILE_SIZE = 64 * 2**20
+
+# Content-Encoding values offered to clients, in order of preference
+CONTENT_ENCODERS = {
+    'gzip': lambda content: gzip.compress(content, 6, mtime=0),
+    'deflate': lambda content: zlib.compress(content, 6),
+}
+
+# Upper bounds in seconds of the request latency histogram buckets served at /metrics
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class CacheStats:
+    """Hit and miss counters of one in-memory cache."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+
+class CachedFile:
+    """One version of a served file, and its compressed variants.
+
+    Files below the cache's sendfile size are held in content; larger ones have content None and
+    are streamed from disk for every request.
+    """
+
+    __slots__ = ("path", "signature", "size", "mtime", "content", "crc32", "etag", "last_modified", "_variants",
+                 "_derived", "_lock")
+
+    def __init__(self, path, signature, size, mtime, content, digest, crc32=None):
+        self.path = path
+        self.signature = signature
+        self.size = size
+        self.mtime = mtime
+        self.content = content
+        # CRC-32 of the content, recorded in the trailer of a gzip copy of this version
+        self.crc32 = crc32
+        # Hashed once per version; for the EPG this is the digest the generator records in .sha256
+        self.etag = f'"{digest}"'
+        self.last_modified = email.utils.formatdate(mtime, usegmt=True)
+        self._variants = {}
+        self._derived = {}
+        self._lock = threading.Lock()
+
+    def derived(self, key, build):
+        """Return a value computed from this version by build, calling it only on first use."""
+        with self._lock:
+            value = self._derived.get(key)
+            if value is None:
+                value = build()
+                self._derived[key] = value
+        return value
+
+    def encoded_etag(self, encoding):
+        """Return the strong ETag of this version in a Content-Encoding."""
+        return f'{self.etag[:-1]}-{encoding}"'
+
+    def compresses(self, original, file=None):
+        """Return True if this version is a gzip file of exactly the content of original.
+
+        Judged by the CRC-32 and size in the gzip trailer, read from file for a streamed version.
+        """
+        if original.crc32 is None or self.size < 18:
+            return False
+        trailer = self.derived('gzip_trailer', lambda: self.content[-8:] if self.content is not None
+                               else os.pread(file.fileno(), 8, self.size - 8))
+        return trailer == struct.pack('<II', original.crc32, original.size & 0xffffffff)
+
+    def variant(self, encoding, file=None):
+        """Return (content, etag) in a Content-Encoding, or unencoded if encoding is None.
+
+        Each variant is compressed on first use and kept for the life of this version. A streamed
+        version is compressed from file, which must be open on this version; its unencoded content
+        is None.
+        """
+        if encoding is None:
+            return self.content, self.etag
+        with self._lock:
+            variant = self._variants.get(encoding)
+            if variant is None:
+                content = self.content if self.content is not None else file.read()
+                # Each representation needs its own strong ETag
+                variant = (CONTENT_ENCODERS[encoding](content), self.encoded_etag(encoding))
+                self._variants[encoding] = variant
+                logger.info("Compressed %s with %s (%d to %d bytes)", self.path, encoding,
+                            self.size, len(variant[0]))
+        return variant
+
+
+class ChannelSchedule:
+    """The programmes of one channel sorted by start time, for overlap and point queries by bisection."""
+
+    __slots__ = ("starts", "stops", "max_stops", "spans", "titles", "subtitles")
+
+    def __init__(self, programmes):
+        programmes.sort(key=lambda programme: programme[0])
+        self.starts = [programme[0] for programme in programmes]
+        self.stops = [programme[1] for programme in programmes]
+        # Running maximum of stop times, which is sorted even if programmes overlap
+        self.max_stops = list(itertools.accumulate(self.stops, max))
+        self.spans = [programme[2] for programme in programmes]
+        self.titles = [programme[3] for programme in programmes]
+        self.subtitles = [programme[4] for programme in programmes]
+
+    def overlapping(self, start, end):
+        """Return the indexes of programmes airing at any time in [start, end)."""
+        first = bisect.bisect_right(self.max_stops, start) if start is not None else 0
+        last = bisect.bisect_left(self.starts, end) if end is not None else len(self.starts)
+        return [index for index in range(first, last) if start is None or self.stops[index] > start]
+
+    def airing(self, moment):
+        """Return the index of the programme on air at moment, or None between programmes."""
+        index = bisect.bisect_right(self.starts, moment) - 1
+        return index if index >= 0 and self.stops[index] > moment else None
+
+    def following(self, moment):
+        """Return the index of the first programme starting after moment, or None."""
+        index = bisect.bisect_right(self.starts, moment)
+        return index if index < len(self.starts) else None
+
+    def describe(self, index):
+        """Return a programme as a JSON-ready dict."""
+        return {'title': self.titles[index], 'subtitle': self.subtitles[index],
+                'start': self.starts[index], 'stop': self.stops[index]}
+
+
+class GuideIndex:
+    """One version of an XMLTV guide indexed by channel and time, to answer queries without reparsing it.
+
+    Each channel and programme element is kept as the (start, end) offsets of its bytes in content,
+    so a slice is assembled by joining the selected ranges without a second copy of the guide.
+    content is bytes, or an mmap of a guide streamed from disk. Every start and stop time is also
+    kept in one sorted array: slices and what is on now or next only change at those boundaries, so
+    answers are cached by the interval between two of them. Recent answers are kept until the guide
+    changes, up to cache_bytes in all; larger ones are built for each request.
+    """
+
+    cache_bytes = 32 * 2**20
+    # Bytes handed to the parser at a time
+    parse_chunk_size = 2**20
+    # Text of these child elements is kept for the /now and /next listings
+    indexed_text = ('display-name', 'title', 'sub-title')
+
+    def __init__(self, content, source, stats=None):
+        self.content = content
+        self.source = source
+        self.channels = {}
+        self.channel_names = {}
+        programmes = collections.defaultdict(list)
+        times = {}
+        parser = xml.parsers.expat.ParserCreate()
+        depth = 0
+        element_start = element_attributes = None
+        texts = {}
+        collecting = None
+
+        def timestamp(value):
+            # XMLTV times repeat on every channel, so each distinct one is parsed once
+            parsed = times.get(value)
+            if parsed is None:
+                parsed = times[value] = int(datetime.datetime.strptime(value, '%Y%m%d%H%M%S %z').timestamp())
+            return parsed
+
+        def start_element(name, attributes):
+            nonlocal depth, element_start, element_attributes, collecting
+            depth += 1
+            if depth == 1:
+                attributes = ''.join(f' {key}={quoteattr(value)}' for key, value in attributes.items())
+                self.header = f"<?xml version='1.0' encoding='UTF-8'?>\n<{name}{attributes}>\n".encode()
+                self.footer = f'</{name}>\n'.encode()
+            elif depth == 2:
+                element_start, element_attributes = parser.CurrentByteIndex, attributes
+                texts.clear()
+            elif depth == 3 and name in self.indexed_text and name not in texts:
+                collecting = name
+                texts[name] = ''
+
+        def character_data(data):
+            if collecting is not None:
+                texts[collecting] += data
+
+        def end_element(name):
+            nonlocal depth, collecting
+            depth -= 1
+            if depth == 2:
+                collecting = None
+            if depth != 1:
+                return
+            # The end tag, or the start tag of an empty element, closes at the next '>'
+            span = (element_start, content.find(b'>', parser.CurrentByteIndex) + 1)
+            if name == 'channel':
+                channel = element_attributes.get('id')
+                self.channels[channel] = span
+                self.channel_names[channel] = texts.get('display-name')
+            elif name == 'programme':
+                programmes[element_attributes.get('channel')].append(
+                    (timestamp(element_attributes['start']), timestamp(element_attributes['stop']), span,
+                     texts.get('title'), texts.get('sub-title')))
+
+        parser.StartElementHandler = start_element
+        parser.EndElementHandler = end_element
+        parser.CharacterDataHandler = character_data
+        # CurrentByteIndex counts from the start of the document across calls
+        for offset in range(0, len(content), self.parse_chunk_size):
+            parser.Parse(content[offset:offset + self.parse_chunk_size], False)
+        parser.Parse(b'', True)
+        self.schedules = {channel: ChannelSchedule(entries) for channel, entries in programmes.items()}
+        # Channels in guide order, including any with programmes but no <channel> element
+        self.channel_order = list(self.channels) + [channel for channel in self.schedules
+                                                    if channel not in self.channels]
+        self.boundaries = sorted(set(times.values()))
+        # key: (result, size in bytes), least recently used first
+        self._results = collections.OrderedDict()
+        self._result_bytes = 0
+        self._lock = threading.Lock()
+        self.stats = stats or CacheStats()
+
+    def _remember(self, key, build, size):
+        """Return the cached result for key, building and caching it if it is not among the recent ones.
+
+        size returns the bytes a result holds, counted against cache_bytes.
+        """
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None:
+                self._results.move_to_end(key)
+                self.stats.hit()
+                return entry[0]
+        self.stats.miss()
+        result = build()
+        nbytes = size(result)
+        if nbytes > self.cache_bytes:
+            return result
+        with self._lock:
+            if key not in self._results:
+                self._results[key] = (result, nbytes)
+                self._result_bytes += nbytes
+            while self._result_bytes > self.cache_bytes:
+                self._result_bytes -= self._results.popitem(last=False)[1][1]
+        return result
+
+    def slice(self, start, end, channels):
+        """Return a CachedFile holding the XMLTV for channels (None for all) airing in [start, end)."""
+        # Programmes overlap [start, end) alike for every start or end between the same two
+        # boundaries, so both are moved to a boundary, or None past the first or last one
+        if start is not None:
+            position = bisect.bisect_right(self.boundaries, start)
+            start = self.boundaries[position - 1] if position else None
+        if end is not None:
+            position = bisect.bisect_left(self.boundaries, end)
+            end = self.boundaries[position] if position < len(self.boundaries) else None
+
+        def build():
+            spans = [span for channel, span in self.channels.items() if channels is None or channel in channels]
+            for channel, schedule in self.schedules.items():
+                if channels is None or channel in channels:
+                    spans.extend(schedule.spans[index] for index in schedule.overlapping(start, end))
+            parts = [self.header]
+            for begin, end_of_element in spans:
+                parts.extend((b'\t', self.content[begin:end_of_element], b'\n'))
+            parts.append(self.footer)
+            content = b''.join(parts)
+            return CachedFile(self.source.path, None, len(content), self.source.mtime, content,
+                              hashlib.sha256(content).hexdigest())
+
+        return self._remember(('slice', start, end, channels), build, lambda result: result.size)
+
+    def on_air(self, which, moment, channels):
+        """Return (JSON bytes, ETag, next change) listing each channel's programme 'now' or 'next' at moment.
+
+        The next change is the epoch time the listing next changes, or None if it never will.
+        """
+        position = bisect.bisect_right(self.boundaries, moment)
+
+        def build():
+            listing = []
+            for channel in self.channel_order:
+                schedule = self.schedules.get(channel)
+                if schedule is None or (channels is not None and channel not in channels):
+                    continue
+                index = schedule.airing(moment) if which == 'now' else schedule.following(moment)
+                if index is not None:
+                    listing.append({'channel': channel, 'name': self.channel_names.get(channel),
+                                    **schedule.describe(index)})
+            content = json.dumps({which: listing}).encode()
+            return content, f'"{hashlib.sha256(content).hexdigest()}"'
+
+        content, etag = self._remember((which, position, channels), build, lambda result: len(result[0]))
+        return content, etag, self.boundaries[position] if position < len(self.boundaries) else None
+
+
+class FileCache:
+    """Keep served files in memory, reloading a file only when it is replaced or modified.
+
+    The generator renames new files into place, so a changed inode, size or mtime identifies a new
+    version. Checking costs one stat per request instead of reading the whole file. While a new
+    version is loaded, requests are answered from the previous one. Files of at least
+    sendfile_size bytes are not held in memory but streamed from disk with sendfile.
+    """
+
+    def __init__(self, sendfile_size=None):
+        self.sendfile_size = sendfile_size
+        self.stats = CacheStats()
+        self._files = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _signature(stat):
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def get(self, path):
+        """Return the CachedFile for path, or None if the file does not exist."""
+        try:
+            signature = self._signature(os.stat(path))
+        except FileNotFoundError:
+            self._files.pop(path, None)
+            return None
+        cached = self._files.get(path)
+        if cached is not None and cached.signature == signature:
+            self.stats.hit()
+            return cached
+        # One thread reloads a changed file instead of all reading it. The others keep answering
+        # from the previous version if it is held in memory, and otherwise wait for the new one
+        if cached is not None and cached.content is not None:
+            if not self._lock.acquire(blocking=False):
+                self.stats.hit()
+                return cached
+        else:
+            self._lock.acquire()
+        try:
+            cached = self._files.get(path)
+            if cached is not None and cached.signature == signature:
+                self.stats.hit()
+                return cached
+            self.stats.miss()
+            try:
+                with open(path, 'rb') as f:
+                    stat = os.fstat(f.fileno())
+                    if self.sendfile_size is not None and stat.st_size >= self.sendfile_size:
+                        content = None
+                        digest = hashlib.sha256()
+                        crc32 = 0
+                        for block in iter(lambda: f.read(2**20), b''):
+                            digest.update(block)
+                            crc32 = zlib.crc32(block, crc32)
+                    else:
+                        content = f.read()
+                        digest = hashlib.sha256(content)
+                        crc32 = zlib.crc32(content)
+            except FileNotFoundError:
+                self._files.pop(path, None)
+                return None
+            cached = CachedFile(path, self._signature(stat), stat.st_size, stat.st_mtime, content,
+                                digest.hexdigest(), crc32)
+            self._files[path] = cached
+            logger.info("Loaded %s (%d bytes%s)", path, stat.st_size, ", streamed" if content is None else "")
+            return cached
+        finally:
+            self._lock.release()
+
+    def open(self, path):
+        """Return (CachedFile, file) for path, or (None, None) if it does not exist.
+
+        For a streamed version, file is opened on exactly that version, so a guide replaced in the
+        middle of a request cannot mix two versions; it is None for versions held in memory.
+        """
+        for _ in range(3):
+            cached = self.get(path)
+            if cached is None or cached.content is not None:
+                return cached, None
+            try:
+                f = open(path, 'rb')
+            except FileNotFoundError:
+                continue
+            if self._signature(os.fstat(f.fileno())) == cached.signature:
+                return cached, f
+            f.close()
+        raise OSError(f"{path} changed while it was being opened")
+
+
+class ServerMetrics:
+    """Request counts, latencies and bytes served per route, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.guide_index = CacheStats()
+        self._requests = collections.Counter()
+        self._bytes = collections.Counter()
+        # Per route: a count for each latency bucket and one for slower requests, then the total seconds
+        self._latency = {}
+        self._lock = threading.Lock()
+
+    def observe(self, route, method, status, seconds, sent):
+        """Record one request to route and the body bytes sent in reply."""
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            self._requests[(route, method, status)] += 1
+            self._bytes[route] += sent
+            latency = self._latency.setdefault(route, [0] * (len(LATENCY_BUCKETS) + 2))
+            latency[bucket] += 1
+            latency[-1] += seconds
+
+    def render(self, caches):
+        """Return the metrics as Prometheus text, with hit counters for the named CacheStats in caches."""
+        with self._lock:
+            requests = sorted(self._requests.items())
+            sent = sorted(self._bytes.items())
+            latencies = sorted((route, list(latency)) for route, latency in self._latency.items())
+
+        lines = ['# HELP hdhomerun_epg_http_requests_total HTTP requests served by route, method and status.',
+                 '# TYPE hdhomerun_epg_http_requests_total counter']
+        lines.extend(f'hdhomerun_epg_http_requests_total{{route="{route}",method="{method}",status="{status}"}} '
+                     f'{count}' for (route, method, status), count in requests)
+
+        lines += ['# HELP hdhomerun_epg_http_request_duration_seconds Time taken to answer HTTP requests by route.',
+                  '# TYPE hdhomerun_epg_http_request_duration_seconds histogram']
+        for route, latency in latencies:
+            for bound, count in zip((*LATENCY_BUCKETS, '+Inf'), itertools.accumulate(latency[:-1])):
+                lines.append(f'hdhomerun_epg_http_request_duration_seconds_bucket{{route="{route}",le="{bound}"}} '
+                             f'{count}')
+            lines.append(f'hdhomerun_epg_http_request_duration_seconds_sum{{route="{route}"}} {latency[-1]:.6f}')
+            lines.append(f'hdhomerun_epg_http_request_duration_seconds_count{{route="{route}"}} '
+                         f'{sum(latency[:-1])}')
+
+        lines += ['# HELP hdhomerun_epg_http_response_bytes_total Response body bytes sent by route.',
+                  '# TYPE hdhomerun_epg_http_response_bytes_total counter']
+        lines.extend(f'hdhomerun_epg_http_response_bytes_total{{route="{route}"}} {count}' for route, count in sent)
+
+        lines += ['# HELP hdhomerun_epg_cache_lookups_total In-memory cache lookups by cache and result.',
+                  '# TYPE hdhomerun_epg_cache_lookups_total counter']
+        for name, stats in caches.items():
+            lines.append(f'hdhomerun_epg_cache_lookups_total{{cache="{name}",result="hit"}} {stats.hits}')
+            lines.append(f'hdhomerun_epg_cache_lookups_total{{cache="{name}",result="miss"}} {stats.misses}')
+        lines += ['# HELP hdhomerun_epg_cache_hit_ratio Share of in-memory cache lookups that were hits.',
+                  '# TYPE hdhomerun_epg_cache_hit_ratio gauge']
+        for name, stats in caches.items():
+            lookups = stats.hits + stats.misses
+            lines.append(f'hdhomerun_epg_cache_hit_ratio{{cache="{name}"}} '
+                         f'{stats.hits / lookups if lookups else 0:.6f}')
+        return '\n'.join(lines) + '\n'
+
+
 class EPGRequestHandler(SimpleHTTPRequestHandler):
     """Custom HTTP request handler for serving EPG and M3U files."""
 
     epg_file_path = None
     m3u_file_path = None
+    file_cache = FileCache()
+    # Served compressed when the client accepts it; the .gz files are already compressed
+    compressible_types = ('application/xml', 'audio/x-mpegurl')
+    metrics = ServerMetrics()
+    # The GuideRefresher regenerating the guide in this process, if any
+    refresher = None
 
     def do_GET(self):
-        """Handle GET requests for the EPG and M3U files."""
-        # EPG file endpoints
-        if self.path in ['/', '/guide.xml', '/epg.xml']:
-            self._serve_file(self.epg_file_path, 'application/xml', 'EPG')
+        """Handle GET requests, recording each one in the server metrics."""
+        began = time.perf_counter()
+        self._status = None
+        self._bytes_sent = 0
+        route = 'other'
+        try:
+            route = self._route()
+        finally:
+            self.metrics.observe(route, self.command, self._status or 500, time.perf_counter() - began,
+                                 self._bytes_sent)
+
+    def _route(self):
+        """Serve the EPG and M3U files and the other endpoints, returning the route label for metrics."""
+        path, _, query = self.path.partition('?')
+        # EPG file endpoints, or a slice of the EPG when queried by time or channel
+        if path in ['/', '/guide.xml', '/epg.xml']:
+            if query:
+                self._serve_guide_slice(query)
+            else:
+                self._serve_file(self.epg_file_path, 'application/xml', 'EPG')
+        # Gzip compressed EPG written alongside the XMLTV file with --gzip
+        elif path in ['/guide.xml.gz', '/epg.xml.gz']:
+            self._serve_file(self._gzip_path(self.epg_file_path), 'application/gzip', 'Compressed EPG')
         # M3U playlist endpoints
-        elif self.path in ['/channels.m3u', '/playlist.m3u', '/lineup.m3u']:
+        elif path in ['/channels.m3u', '/playlist.m3u', '/lineup.m3u']:
             self._serve_file(self.m3u_file_path, 'audio/x-mpegurl', 'M3U playlist')
+        elif path in ['/channels.m3u.gz', '/playlist.m3u.gz', '/lineup.m3u.gz']:
+            self._serve_file(self._gzip_path(self.m3u_file_path), 'application/gzip', 'Compressed M3U playlist')
+        # What is on now, or next, on each channel
+        elif path in ['/now', '/next']:
+            self._serve_on_air(path[1:], query)
         # Health check endpoint
-        elif self.path == '/health':
+        elif path == '/health':
             self._serve_health_check()
         # Status endpoint
-        elif self.path == '/status':
+        elif path == '/status':
             self._serve_status()
+        # Prometheus metrics endpoint
+        elif path == '/metrics':
+            self._serve_metrics()
         else:
-            self.send_response(404)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(b'Not found')
+            self._send_text(404, 'Not found')
+            return 'other'
+        return path
+
+    def do_HEAD(self):
+        """Handle HEAD requests with the headers a GET would send."""
+        self.do_GET()
+
+    def send_response(self, code, message=None):
+        """Send the response status line, remembering the status for the metrics."""
+        self._status = code
+        super().send_response(code, message)
+
+    def _write_body(self, data):
+        """Write a response body, unless answering a HEAD request."""
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+            self._bytes_sent += len(data)
+
+    @staticmethod
+    def _gzip_path(file_path):
+        """Return the path of the precompressed copy of a file."""
+        return f'{file_path}.gz' if file_path else None
 
     def _serve_file(self, file_path, content_type, file_type):
         """Serve a file with appropriate content type."""
+        file = None
         try:
-            if file_path and os.path.exists(file_path):
-                with open(file_path, 'rb') as f:
-                    content = f.read()
-                self.send_response(200)
-                self.send_header('Content-type', content_type)
-                self.send_header('Content-Length', str(len(content)))
-                self.send_header('Cache-Control', 'max-age=300')  # Cache for 5 minutes
-                self.end_headers()
-                self.wfile.write(content)
-                logger.info("Served %s file: %s", file_type, self.path)
+            cached, file = self.file_cache.open(file_path) if file_path else (None, None)
+            if cached is None:
+                self._send_not_found(file_type, file_path)
             else:
-                self.send_response(404)
-                self.send_header('Content-type', 'text/plain')
-                self.end_headers()
-                self.wfile.write(f'{file_type} file not found'.encode())
-                logger.warning("%s file not found: %s", file_type, file_path)
+                self._send_version(cached, file, content_type, file_type, self._gzip_path(file_path))
         except OSError as e:
-            self.send_response(500)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(f'Error serving {file_type}: {str(e)}'.encode())
+            self._send_text(500, f'Error serving {file_type}: {str(e)}')
             logger.error("Error serving %s: %s", file_type, e)
+        finally:
+            if file is not None:
+                file.close()
+
+    def _serve_guide_slice(self, query):
+        """Serve the part of the EPG selected by the start, end and channels query parameters."""
+        try:
+            start, end, channels = self._slice_parameters(query)
+        except ValueError as e:
+            self._send_text(400, f'Invalid guide query: {e}')
+            return
+        file = None
+        try:
+            cached, file = self.file_cache.open(self.epg_file_path) if self.epg_file_path else (None, None)
+            if cached is None:
+                self._send_not_found('EPG', self.epg_file_path)
+                return
+            index = self._guide_index(cached, file)
+            self._send_version(index.slice(start, end, channels), None, 'application/xml', 'EPG slice')
+        except (OSError, ValueError, KeyError, xml.parsers.expat.ExpatError) as e:
+            self._send_text(500, f'Error serving EPG slice: {str(e)}')
+            logger.error("Error serving EPG slice: %s", e)
+        finally:
+            if file is not None:
+                file.close()
+
+    def _serve_on_air(self, which, query):
+        """Serve the programme on air now, or next, on every channel or those in the channel parameter."""
+        try:
+            parameters = urllib.parse.parse_qs(query)
+            moment = self._time_parameter(parameters, 'time')
+            channels = self._channels_parameter(parameters, 'channel')
+        except ValueError as e:
+            self._send_text(400, f'Invalid {which} query: {e}')
+            return
+        file = None
+        try:
+            cached, file = self.file_cache.open(self.epg_file_path) if self.epg_file_path else (None, None)
+            if cached is None:
+                self._send_not_found('EPG', self.epg_file_path)
+                return
+            index = self._guide_index(cached, file)
+            now = int(time.time()) if moment is None else moment
+            content, etag, next_change = index.on_air(which, now, channels)
+        except (OSError, ValueError, KeyError, xml.parsers.expat.ExpatError) as e:
+            self._send_text(500, f'Error serving {which}: {str(e)}')
+            logger.error("Error serving %s: %s", which, e)
+            return
+        finally:
+            if file is not None:
+                file.close()
+        # Cacheable until the listing next changes; there is no Last-Modified as it changes with time
+        max_age = min(next_change - now, 300) if next_change is not None and moment is None else 300
+        not_modified = self._etag_matches(etag)
+        self.send_response(304 if not_modified else 200)
+        if not not_modified:
+            self.send_header('Content-type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', f'max-age={max_age}')
+        self.end_headers()
+        if not not_modified:
+            self._write_body(content)
+
+    def _guide_index(self, cached, file):
+        """Return the GuideIndex of a guide version, indexing it on first use.
+
+        A guide that is not held in memory is mapped from file, which is open on that version, so
+        the index reads it through the page cache instead of holding a copy.
+        """
+        return cached.derived('guide_index', lambda: GuideIndex(
+            cached.content if cached.content is not None else mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ),
+            cached, self.metrics.guide_index))
+
+    @staticmethod
+    def _time_parameter(parameters, name):
+        """Return a query time in epoch seconds, or None if it is missing.
+
+        Times are epoch seconds or ISO 8601, with times without an offset taken as UTC.
+        """
+        value = parameters.get(name, [''])[-1].strip()
+        if not value:
+            return None
+        if value.lstrip('-').isdigit():
+            return int(value)
+        try:
+            moment = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            raise ValueError(f"{name} must be epoch seconds or an ISO 8601 time") from None
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=datetime.timezone.utc)
+        return int(moment.timestamp())
+
+    @staticmethod
+    def _channels_parameter(parameters, name):
+        """Return the set of channel ids given, comma separated or repeated, in a query, or None for all."""
+        channels = ','.join(parameters.get(name, []))
+        return frozenset(channel.strip() for channel in channels.split(',') if channel.strip()) or None
+
+    def _slice_parameters(self, query):
+        """Parse start, end and channels from a guide query string; missing ones leave the slice unbounded."""
+        parameters = urllib.parse.parse_qs(query)
+        return (self._time_parameter(parameters, 'start'), self._time_parameter(parameters, 'end'),
+                self._channels_parameter(parameters, 'channels'))
+
+    def _send_not_found(self, file_type, file_path):
+        self._send_text(404, f'{file_type} file not found')
+        logger.warning("%s file not found: %s", file_type, file_path)
+
+    def _send_text(self, status, text):
+        """Send a short plain text response."""
+        self.send_response(status)
+        self.send_header('Content-type', 'text/plain')
+        self.end_headers()
+        self._write_body(text.encode())
+
+    def _open_precompressed(self, cached, gzip_path):
+        """Return (CachedFile, file) of the gzip copy at gzip_path if it holds this version, else (None, None)."""
+        compressed, file = self.file_cache.open(gzip_path)
+        if compressed is not None and compressed.compresses(cached, file):
+            return compressed, file
+        if file is not None:
+            file.close()
+        return None, None
+
+    def _send_version(self, cached, file, content_type, file_type, gzip_path=None):
+        """Send one version of a file, negotiating its encoding, conditional request and range.
+
+        A gzip response is sent from the copy the generator wrote at gzip_path when it holds the
+        same version, and compressed in memory otherwise.
+        """
+        compressible = content_type in self.compressible_types
+        encoding = self._accepted_encoding() if compressible else None
+        precompressed, precompressed_file = (None, None)
+        if encoding == 'gzip' and gzip_path:
+            precompressed, precompressed_file = self._open_precompressed(cached, gzip_path)
+        try:
+            if precompressed is not None:
+                content, etag, file = precompressed.content, cached.encoded_etag(encoding), precompressed_file
+                size = precompressed.size
+            else:
+                content, etag = cached.variant(encoding, file)
+                size = len(content) if content is not None else cached.size
+            self._send_representation(cached, file, content_type, file_type, encoding, content, etag, size)
+        finally:
+            if precompressed_file is not None:
+                precompressed_file.close()
+
+    def _send_representation(self, cached, file, content_type, file_type, encoding, content, etag, size):
+        """Send content, or size bytes streamed from file if it is None, as one representation of a version."""
+        compressible = content_type in self.compressible_types
+        if self._not_modified(cached, etag):
+            self.send_response(304)
+            self._send_validators(cached, etag, compressible)
+            self.end_headers()
+            logger.info("%s file not modified: %s", file_type, self.path)
+            return
+        try:
+            byte_range = self._requested_range(size, cached, etag)
+        except ValueError:
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start, end = byte_range or (0, size)
+        self.send_response(206 if byte_range else 200)
+        self.send_header('Content-type', content_type)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(end - start))
+        if byte_range:
+            self.send_header('Content-Range', f'bytes {start}-{end - 1}/{size}')
+        self.send_header('Accept-Ranges', 'bytes')
+        self._send_validators(cached, etag, compressible)
+        self.end_headers()
+        if content is not None:
+            self._write_body(memoryview(content)[start:end])
+        elif self.command != 'HEAD' and end > start:
+            # Copied from the page cache to the socket by the kernel, without passing through Python
+            self._bytes_sent += self.connection.sendfile(file, start, end - start)
+        logger.info("Served %s file: %s", file_type, self.path)
+
+    def _requested_range(self, size, cached, etag):
+        """Return the (start, end) byte range requested with Range, or None to send the whole file.
+
+        Only single ranges are supported; other Range headers are ignored and the whole file sent.
+        Raises ValueError if the range lies outside the file.
+        """
+        range_header = self.headers.get('Range')
+        if range_header is None:
+            return None
+        # A resumed download only continues from the version it started with
+        if_range = self.headers.get('If-Range')
+        if if_range is not None and if_range.strip() not in (etag, cached.last_modified):
+            return None
+        unit, _, ranges = range_header.partition('=')
+        if unit.strip().lower() != 'bytes' or ',' in ranges:
+            return None
+        first, _, last = ranges.strip().partition('-')
+        try:
+            if not first:
+                # A suffix range: the last N bytes
+                start, end = max(size - int(last), 0), size
+            else:
+                start, end = int(first), min(int(last) + 1, size) if last else size
+        except ValueError:
+            return None
+        if start >= size or start >= end:
+            raise ValueError(f"Range {range_header} not satisfiable for {size} bytes")
+        return start, end
+
+    def _accepted_encoding(self):
+        """Return the preferred Content-Encoding the client accepts, or None to send the file as is."""
+        weights = {}
+        for item in self.headers.get('Accept-Encoding', '').split(','):
+            coding, _, parameters = item.partition(';')
+            weight = 1.0
+            for parameter in parameters.split(';'):
+                name, _, value = parameter.partition('=')
+                if name.strip().lower() == 'q':
+                    try:
+                        weight = float(value)
+                    except ValueError:
+                        weight = 0.0
+            if coding.strip():
+                weights[coding.strip().lower()] = weight
+        best, best_weight = None, 0.0
+        for encoding in CONTENT_ENCODERS:
+            weight = weights.get(encoding, weights.get('*', 0.0))
+            if weight > best_weight:
+                best, best_weight = encoding, weight
+        return best
+
+    def _send_validators(self, cached, etag, compressible=False):
+        """Send the caching headers that let clients revalidate with a conditional GET."""
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', cached.last_modified)
+        self.send_header('Cache-Control', 'max-age=300')  # Cache for 5 minutes
+        if compressible:
+            self.send_header('Vary', 'Accept-Encoding')
+
+    def _etag_matches(self, etag):
+        """Return True if the request's If-None-Match lists etag, using weak comparison."""
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is None:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or etag in (tag[2:] if tag.startswith('W/') else tag for tag in tags)
+
+    def _not_modified(self, cached, etag):
+        """Return True if the request's If-None-Match or If-Modified-Since matches the cached version."""
+        if self.headers.get('If-None-Match') is not None:
+            # If-None-Match takes precedence over If-Modified-Since
+            return self._etag_matches(etag)
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            # HTTP dates have one second resolution
+            return since.tzinfo is not None and int(cached.mtime) <= since.timestamp()
+        return False
 
     def _serve_health_check(self):
         """Serve health check endpoint."""
         self.send_response(200)
         self.send_header('Content-type', 'text/plain')
         self.end_headers()
-        self.wfile.write(b'OK')
+        self._write_body(b'OK')
+
+    def _serve_metrics(self):
+        """Serve the server metrics, followed by those the generator recorded for its last run."""
+        content = self.metrics.render({'file': self.file_cache.stats, 'guide_index': self.metrics.guide_index})
+        if self.epg_file_path:
+            try:
+                with open(f'{self.epg_file_path}.metrics', encoding='utf-8') as f:
+                    content += f.read()
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning("Could not read generator metrics: %s", e)
+        body = content.encode()
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self._write_body(body)
 
     def _serve_status(self):
         """Serve status information."""
@@ -93,10 +883,15 @@ M3U File: {self.m3u_file_path or 'Not configured'}
   Size: {m3u_size} bytes
   Last Modified: {m3u_mtime}
 
-Available Endpoints:
+{self._refresh_status()}Available Endpoints:
   /epg.xml - XMLTV EPG data
+  /epg.xml?start=&end=&channels= - XMLTV EPG slice by time window and channels
+  /epg.xml.gz - Gzip compressed XMLTV EPG data (with --gzip)
+  /now, /next - JSON programme on air now, or next, on each channel (?channel= to filter)
   /channels.m3u - M3U playlist
+  /channels.m3u.gz - Gzip compressed M3U playlist (with --gzip)
   /health - Health check
+  /metrics - Prometheus metrics of the server and the last generator run
   /status - This status page
 """
 
@@ -104,13 +899,110 @@ Available Endpoints:
         self.send_header('Content-type', 'text/plain')
         self.send_header('Content-Length', str(len(status.encode())))
         self.end_headers()
-        self.wfile.write(status.encode())
+        self._write_body(status.encode())
+
+    def _refresh_status(self):
+        """Describe the in-process guide refresh for the status page, or nothing when cron refreshes it."""
+        if self.refresher is None:
+            return ''
+        return (f"Guide Refresh: every {self.refresher.interval} seconds\n"
+                f"  Last Refreshed: {self.refresher.last_refresh or 'Never'}\n"
+                f"  Last Error: {self.refresher.last_error!r}\n\n")
 
     def log_message(self, msg_format: str, *args) -> None:  # noqa: A002, ARG001
         """Override log_message to use Python logging."""
         logger.info(msg_format, *args)
 
-def start_http_server(epg_file_path, m3u_file_path, bind_address='0.0.0.0', http_port=8000):
+class EPGHTTPServer(ThreadingHTTPServer):
+    """Threaded HTTP server with a listen backlog deep enough for clients polling together."""
+
+    # socketserver's default of 5 drops connections from a burst of clients, which then wait a
+    # second or more to retry
+    request_queue_size = 128
+
+
+class GuideRefresher:
+    """Regenerate the guide in a background thread of the server process every interval seconds.
+
+    Requests are answered from the previous version while a refresh runs. The generator renames
+    the new files into place, and they are loaded into the file cache straight away so the
+    swap happens before clients ask for them. A failed refresh is logged and the previous guide
+    kept. The first refresh waits until the existing guide is interval seconds old, so
+    restarting the server does not regenerate a fresh guide.
+    """
+
+    def __init__(self, refresh, interval, file_cache, paths):
+        self.refresh = refresh
+        self.interval = interval
+        self.file_cache = file_cache
+        self.paths = [path for path in paths if path]
+        self.last_refresh = None
+        self.last_error = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='guide-refresh', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _delay(self):
+        """Return the seconds until the guide, the first path, is due to be regenerated."""
+        try:
+            age = time.time() - os.path.getmtime(self.paths[0])
+        except (IndexError, OSError):
+            return 0
+        return max(0, self.interval - age)
+
+    def _run(self):
+        # The generator leaves an unchanged guide untouched, so only the first wait goes by its mtime
+        delay = self._delay()
+        while not self._stopped.wait(delay):
+            self.run_once()
+            delay = self.interval
+
+    def run_once(self):
+        """Regenerate the guide and load the new files into the cache, returning True on success."""
+        began = time.perf_counter()
+        logger.info("Refreshing guide")
+        try:
+            self.refresh()
+        except Exception as e:
+            self.last_error = e
+            logger.error("Guide refresh failed, serving the previous guide: %r", e)
+            return False
+        for path in self.paths:
+            self.file_cache.get(path)
+            self.file_cache.get(EPGRequestHandler._gzip_path(path))
+        self.last_refresh = time.time()
+        self.last_error = None
+        logger.info("Guide refreshed in %.1f seconds", time.perf_counter() - began)
+        return True
+
+
+def guide_generator(epg_file_path, m3u_file_path):
+    """Return a function generating the guide, and the playlist from its channels, in this process.
+
+    The generator is configured from the environment once, here. The guide is rendered without a
+    process pool, since forking from a thread of the threaded server is unsafe; EPG_WORKERS only
+    applies to the standalone generator.
+    """
+    # Imported here so that only the refresh needs the generator's dependencies
+    import HDHomeRunEPG_To_XmlTv
+
+    arguments = ['--filename', epg_file_path, '--workers', '1']
+    if m3u_file_path:
+        arguments += ['--m3u-file', m3u_file_path]
+    config = HDHomeRunEPG_To_XmlTv.build_config(arguments)
+    return lambda: HDHomeRunEPG_To_XmlTv.run(config)
+
+
+def start_http_server(epg_file_path, m3u_file_path, bind_address='0.0.0.0', http_port=8000,
+                      sendfile_size=DEFAULT_SENDFILE_SIZE, refresh_interval=0):
     """Start the HTTP server to serve the EPG and M3U files.
 
     Args:
@@ -118,12 +1010,25 @@ def start_http_server(epg_file_path, m3u_file_path, bind_address='0.0.0.0', http
         m3u_file_path: Path to the M3U playlist file to serve
         bind_address: Address to bind the server to (default: 0.0.0.0)
         http_port: Port to run the server on (default: 8000)
+        sendfile_size: Files of at least this many bytes are streamed from disk instead of held
+            in memory; None keeps every file in memory (default: 64 MiB)
+        refresh_interval: Seconds between regenerating the guide in the server process; 0 leaves
+            it to cron (default: 0)
     """
     EPGRequestHandler.epg_file_path = epg_file_path
     EPGRequestHandler.m3u_file_path = m3u_file_path
+    EPGRequestHandler.file_cache = FileCache(sendfile_size)
 
     server_address = (bind_address, http_port)
-    httpd = HTTPServer(server_address, EPGRequestHandler)
+    httpd = EPGHTTPServer(server_address, EPGRequestHandler)
+
+    refresher = None
+    if refresh_interval > 0:
+        refresher = GuideRefresher(guide_generator(epg_file_path, m3u_file_path), refresh_interval,
+                                   EPGRequestHandler.file_cache, [epg_file_path, m3u_file_path])
+        EPGRequestHandler.refresher = refresher
+        refresher.start()
+        logger.info("Refreshing the guide every %d seconds", refresh_interval)
 
     logger.info("Starting HTTP server on %s:%d", bind_address, http_port)
     logger.info("EPG file path: %s", epg_file_path)
@@ -137,6 +1042,8 @@ def start_http_server(epg_file_path, m3u_file_path, bind_address='0.0.0.0', http
     except KeyboardInterrupt:
         logger.info("HTTP server stopped")
         httpd.shutdown()
+        if refresher is not None:
+            refresher.stop()
 
 
 if __name__ == '__main__':
@@ -153,6 +1060,8 @@ if __name__ == '__main__':
     m3u_file = os.getenv('M3U_OUTPUT_FILE', '/app/output/channels.m3u')
     bind_addr = os.getenv('HTTP_BIND_ADDRESS', '0.0.0.0')
     port = int(os.getenv('HTTP_PORT', '8000'))
+    sendfile_size = int(os.getenv('HTTP_SENDFILE_SIZE', str(DEFAULT_SENDFILE_SIZE)))
+    refresh_interval = int(os.getenv('HTTP_REFRESH_INTERVAL', '0'))
 
     if len(sys.argv) > 1:
         epg_file = sys.argv[1]
@@ -163,4 +1072,4 @@ if __name__ == '__main__':
     if len(sys.argv) > 4:
         port = int(sys.argv[4])
 
-    start_http_server(epg_file, m3u_file, bind_addr, port)
+    start_http_server(epg_file, m3u_file, bind_addr, port, sendfile_size, refresh_interval)
@@ -25,49 +25,70 @@ M3U_OUTPUT_FILE=${M3U_OUTPUT_FILE}
 EPG_DAYS=${EPG_DAYS}
 EPG_HOURS=${EPG_HOURS}
 DEBUG=${DEBUG}
+EPG_GZIP=${EPG_GZIP}
+EPG_SQLITE_FILE=${EPG_SQLITE_FILE}
 HTTP_PORT=${HTTP_PORT}
 HTTP_BIND_ADDRESS=${HTTP_BIND_ADDRESS}
+HTTP_REFRESH_INTERVAL=${HTTP_REFRESH_INTERVAL}
 CONTAINER_MODE=${CONTAINER_MODE}
 EOF
 
-# Setup cron job with the configured schedule
-echo "Setting up cron job with schedule: ${CRON_SCHEDULE}"
-echo "${CRON_SCHEDULE} /app/scripts/cron_job.sh" > /tmp/crontab
-echo "" >> /tmp/crontab  # Cron requires a newline at the end
-crontab /tmp/crontab
-rm /tmp/crontab
+# In http mode with HTTP_REFRESH_INTERVAL set, the server regenerates the guide itself
+USE_CRON=true
+if [ "${CONTAINER_MODE}" = "http" ] && [ "${HTTP_REFRESH_INTERVAL:-0}" -gt 0 ]; then
+    echo "HTTP server will refresh the guide every ${HTTP_REFRESH_INTERVAL} seconds, cron is not used"
+    USE_CRON=false
+else
+    # Setup cron job with the configured schedule
+    echo "Setting up cron job with schedule: ${CRON_SCHEDULE}"
+    echo "${CRON_SCHEDULE} /app/scripts/cron_job.sh" > /tmp/crontab
+    echo "" >> /tmp/crontab  # Cron requires a newline at the end
+    crontab /tmp/crontab
+    rm /tmp/crontab
 
-# Start cron service
-echo "Starting cron service"
-cron
+    # Start cron service
+    echo "Starting cron service"
+    cron
 
-# Generate initial EPG and M3U files
-echo "Running initial EPG and M3U generation"
-/app/scripts/cron_job.sh || echo "Initial EPG generation failed, but continuing..."
+    # Generate initial EPG and M3U files
+    echo "Running initial EPG and M3U generation"
+    /app/scripts/cron_job.sh || echo "Initial EPG generation failed, but continuing..."
+fi
 
 # SIGTERM handler for graceful shutdown
 term_handler() {
     echo "Received SIGTERM, shutting down gracefully..."
     
-    # Stop cron service
-    service cron stop
+    if [ "${USE_CRON}" = "true" ]; then
+        # Stop cron service
+        service cron stop || true
+        
+        # Wait for any running cron jobs to complete (with timeout)
+        timeout=30
+        count=0
+        while [ $count -lt $timeout ]; do
+            if ! pgrep -f "cron_job.sh" > /dev/null; then
+                break
+            fi
+            echo "Waiting for cron jobs to complete..."
+            sleep 1
+            count=$((count + 1))
+        done
+    fi
     
-    # Wait for any running cron jobs to complete (with timeout)
-    timeout=30
-    count=0
-    while [ $count -lt $timeout ]; do
-        if ! pgrep -f "cron_job.sh" > /dev/null; then
-            break
-        fi
-        echo "Waiting for cron jobs to complete..."
-        sleep 1
-        count=$((count + 1))
-    done
+    # Stop the HTTP server, which also stops a guide refresh running in it
+    if [ -n "${SERVER_PID}" ]; then
+        kill -TERM "${SERVER_PID}" 2>/dev/null || true
+        wait "${SERVER_PID}" 2>/dev/null || true
+    fi
     
     echo "Shutdown complete"
     exit 0
 }
 
+# Set once the HTTP server is started, for term_handler to stop it
+SERVER_PID=""
+
 # Set up signal handlers
 trap term_handler SIGTERM SIGINT
 
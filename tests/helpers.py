@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Shared test fixtures: a fake guide.php API, the tuned channel lineup and sample guide records.
+"""
+
+import contextlib
+import email.message
+import io
+import json
+import threading
+import time
+import urllib.error
+import urllib.parse
+from unittest.mock import patch
+
+import HDHomeRunEPG_To_XmlTv as hdhomerun
+
+START = 1700000000
+
+
+def lineup(count: int = 2) -> list:
+    """Return a lineup.json channel list of ``count`` channels numbered from 1."""
+    return [{"GuideNumber": str(number), "GuideName": f"Channel {number}", "ImageURL": ""}
+            for number in range(1, count + 1)]
+
+
+def sample_epg_data(channels=2, slots: int = 50, title: str = "Show", icons: bool = False, fields=None) -> dict:
+    """Build a guide of back-to-back half-hour programmes from START on every channel.
+
+    ``channels`` is a count of channels numbered from 0 or a list of Channel records, and ``fields``
+    returns the extra Programme fields for a slot index.
+    """
+    if isinstance(channels, int):
+        channels = [hdhomerun.Channel(f"{number}.1", f"Channel {number}", f"http://img/{number}.png" if icons else "")
+                    for number in range(channels)]
+    programmes = [
+        hdhomerun.Programme(channel.guide_number, START + index * 1800, START + (index + 1) * 1800, f"{title} {index}",
+                            **{"synopsis": f"A synthetic programme description {index}", **(fields(index) if fields else {})})
+        for channel in channels for index in range(slots)
+    ]
+    return {"channels": channels, "programmes": programmes}
+
+
+class FakeGuideApi:
+    """Serve synthetic guide.php windows of back-to-back programmes for the Start of each request.
+
+    Programmes last ``slot`` seconds on the slot grid and cover ``hours`` from the Start, or the
+    hours given for a guide number in ``coverage``. Requests at or after ``fail_from`` fail with
+    ``fail_status``, and the window starting at ``malformed_at`` has an invalid first programme.
+    """
+
+    def __init__(self, channels=("1", "2"), hours: float = 3, slot: int = 1800, coverage=None, version=None,
+                 fields=None, untuned: bool = False, fail_from=None, fail_status: int = 400, malformed_at=None,
+                 delay: float = 0.0, etag=None):
+        self.channels = channels
+        self.hours = hours
+        self.slot = slot
+        self.coverage = coverage or {}
+        self.version = version
+        self.fields = fields or {}
+        self.untuned = untuned
+        self.fail_from = fail_from
+        self.fail_status = fail_status
+        self.malformed_at = malformed_at
+        self.delay = delay
+        self.etag = etag
+        # (DeviceAuth, Start, request headers) of every request
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self._requested = {}
+
+    @property
+    def starts(self) -> list:
+        return [start for _, start, _ in self.requests]
+
+    def requested(self, start: int) -> threading.Event:
+        """Return the event set when the window starting at ``start`` is requested."""
+        with self.lock:
+            return self._requested.setdefault(start, threading.Event())
+
+    def body(self, start: int) -> bytes:
+        first_slot = start - start % self.slot
+        suffix = f" v{self.version}" if self.version is not None else ""
+        segment = []
+        for guide_number in self.channels:
+            end = first_slot + int(self.coverage.get(guide_number, self.hours) * 3600)
+            guide = [{"Title": f"Show {slot}{suffix}", "StartTime": slot, "EndTime": slot + self.slot, **self.fields}
+                     for slot in range(first_slot, end, self.slot)]
+            if start == self.malformed_at:
+                guide[0] = {"StartTime": start}
+            segment.append({"GuideNumber": guide_number, "ImageURL": "", "Guide": guide})
+        if self.untuned:
+            # Untuned channels must not hold back the next window start
+            segment.append({"GuideNumber": "99", "ImageURL": "",
+                            "Guide": [{"Title": "Short", "StartTime": first_slot, "EndTime": first_slot + self.slot}]})
+        return json.dumps(segment).encode()
+
+    def fetch(self, url: str, headers=None) -> tuple:
+        """Answer like HttpSession.fetch."""
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+        start = int(query["Start"][0])
+        headers = headers or {}
+        with self.lock:
+            self.requests.append((query["DeviceAuth"][0], start, headers))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        self.requested(start).set()
+        try:
+            time.sleep(self.delay)
+            if self.fail_from is not None and start >= self.fail_from:
+                raise urllib.error.HTTPError(url, self.fail_status, "Error", {}, None)
+            response_headers = email.message.Message()
+            if self.etag:
+                response_headers["ETag"] = self.etag
+                if headers.get("If-None-Match") == self.etag:
+                    return 304, response_headers, b""
+            return 200, response_headers, self.body(start)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def open(self, url: str):
+        """Answer like HttpSession.open."""
+        return io.BytesIO(self.fetch(url)[2])
+
+
+@contextlib.contextmanager
+def serving(api: FakeGuideApi):
+    """Answer the guide requests of every HttpSession from api."""
+    with patch.object(hdhomerun.HttpSession, "open", side_effect=api.open), \
+            patch.object(hdhomerun.HttpSession, "fetch", side_effect=api.fetch):
+        yield api
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Test script to verify adaptive guide window stepping in fetch_epg_data.
+"""
+
+import datetime
+import unittest
+
+import HDHomeRunEPG_To_XmlTv as hdhomerun
+from tests.helpers import FakeGuideApi, lineup, serving
+
+NOW = datetime.datetime(2024, 1, 1, 0, 10, tzinfo=datetime.timezone.utc)
+SLOT = 1800
+# Hours of guide returned per request for each channel, like guide.php does
+CHANNEL_HOURS = {"1": 12, "2": 9}
+
+
+def guide_api(**options) -> FakeGuideApi:
+    """Return an API covering each channel for its own number of hours, with an untuned channel."""
+    return FakeGuideApi(slot=SLOT, coverage=CHANNEL_HOURS, untuned=True, **options)
+
+
+class TestAdaptiveStepping(unittest.TestCase):
+    """Test fetch_epg_data with adaptive window stepping."""
+
+    def fetch(self, api: FakeGuideApi, adaptive: bool, concurrency: int = 1) -> dict:
+        with serving(api):
+            return hdhomerun.fetch_epg_data("test_auth_token", lineup(), days=2, hours=3,
+                                            concurrency=concurrency, adaptive=adaptive, now=NOW)
+
+    @staticmethod
+    def programme_keys(epg_data: dict) -> set:
+        return {(programme.guide_number, programme.start_time) for programme in epg_data["programmes"]}
+
+    def test_adaptive_uses_fewer_requests(self):
+        """Test that adaptive stepping advances by the returned coverage rather than --hours."""
+        fixed_api = guide_api()
+        adaptive_api = guide_api()
+        self.fetch(fixed_api, adaptive=False)
+        self.fetch(adaptive_api, adaptive=True)
+
+        self.assertEqual(len(fixed_api.starts), 16)
+        self.assertLess(len(adaptive_api.starts), len(fixed_api.starts) / 2)
+        # Every step lands on the end of the shortest tuned channel's guide
+        for previous, current in zip(adaptive_api.starts, adaptive_api.starts[1:]):
+            self.assertEqual(current, previous - previous % SLOT + CHANNEL_HOURS["2"] * 3600)
+
+    def test_adaptive_leaves_no_gaps(self):
+        """Test that adaptive stepping covers every channel without gaps up to the end time."""
+        epg_data = self.fetch(guide_api(), adaptive=True)
+        end_time = NOW.timestamp() + 2 * 86400
+
+        for guide_number in CHANNEL_HOURS:
+            programmes = sorted(
+                (programme for programme in epg_data["programmes"] if programme.guide_number == guide_number),
+                key=lambda programme: programme.start_time,
+            )
+            self.assertLessEqual(programmes[0].start_time, NOW.timestamp())
+            self.assertGreaterEqual(programmes[-1].end_time, end_time)
+            for previous, current in zip(programmes, programmes[1:]):
+                self.assertEqual(previous.end_time, current.start_time)
+
+    def test_adaptive_covers_fixed_guide(self):
+        """Test that adaptive stepping returns every programme the fixed stride finds."""
+        fixed = self.fetch(guide_api(), adaptive=False)
+        adaptive = self.fetch(guide_api(), adaptive=True)
+
+        self.assertTrue(self.programme_keys(fixed) <= self.programme_keys(adaptive))
+
+    def test_adaptive_stops_at_http_400(self):
+        """Test that an HTTP 400 still ends the adaptive fetch with the data retrieved so far."""
+        api = guide_api(fail_from=NOW.timestamp() + 86400)
+        epg_data = self.fetch(api, adaptive=True)
+
+        self.assertGreater(len(epg_data["programmes"]), 0)
+        self.assertGreaterEqual(api.starts[-1], NOW.timestamp() + 86400)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
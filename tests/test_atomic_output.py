@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Test script to verify atomic output replacement and digest based no-op detection.
+"""
+
+import contextlib
+import hashlib
+import io
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import atomic_output
+import generate_m3u_from_xmltv
+import HDHomeRunEPG_To_XmlTv as hdhomerun
+from tests.helpers import sample_epg_data
+
+
+class TestAtomicXmltvOutput(unittest.TestCase):
+    """Test write_xmltv replacing its output atomically."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, "epg.xml")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def read(self, filename: str) -> bytes:
+        with open(filename, "rb") as f:
+            return f.read()
+
+    def age(self, filename: str) -> float:
+        """Backdate a file by an hour and return its new mtime."""
+        mtime = os.path.getmtime(filename) - 3600
+        os.utime(filename, (mtime, mtime))
+        return mtime
+
+    def test_digest_is_recorded(self):
+        """Test that the returned digest is the SHA-256 of the file and is written to the sidecar."""
+        digest = hdhomerun.write_xmltv(sample_epg_data(), self.filename)
+
+        self.assertEqual(digest, hashlib.sha256(self.read(self.filename)).hexdigest())
+        self.assertEqual(hdhomerun.read_digest(self.filename), digest)
+        self.assertEqual(self.read(hdhomerun.digest_path(self.filename)).decode(), f"{digest}  epg.xml\n")
+
+    def test_unchanged_guide_is_not_rewritten(self):
+        """Test that rewriting the same guide leaves the files and their mtimes untouched."""
+        hdhomerun.write_xmltv(sample_epg_data(), self.filename, gzip_output=True)
+        mtimes = [self.age(self.filename), self.age(f"{self.filename}.gz")]
+        inode = os.stat(self.filename).st_ino
+
+        hdhomerun.write_xmltv(sample_epg_data(), self.filename, gzip_output=True)
+
+        self.assertEqual([os.path.getmtime(self.filename), os.path.getmtime(f"{self.filename}.gz")], mtimes)
+        self.assertEqual(os.stat(self.filename).st_ino, inode)
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)), ["epg.xml", "epg.xml.gz", "epg.xml.sha256"])
+
+    def test_changed_guide_replaces_file(self):
+        """Test that a changed guide is renamed over the old file and the digest is updated."""
+        first = hdhomerun.write_xmltv(sample_epg_data(), self.filename)
+        mtime = self.age(self.filename)
+        inode = os.stat(self.filename).st_ino
+
+        second = hdhomerun.write_xmltv(sample_epg_data(title="Sports"), self.filename)
+
+        self.assertNotEqual(first, second)
+        self.assertGreater(os.path.getmtime(self.filename), mtime)
+        self.assertNotEqual(os.stat(self.filename).st_ino, inode, "The file should be replaced, not rewritten in place")
+        self.assertIn(b"Sports 0", self.read(self.filename))
+        self.assertEqual(hdhomerun.read_digest(self.filename), second)
+
+    def test_missing_gzip_copy_is_written(self):
+        """Test that enabling gzip on an unchanged guide still writes the compressed copy."""
+        hdhomerun.write_xmltv(sample_epg_data(), self.filename)
+        hdhomerun.write_xmltv(sample_epg_data(), self.filename, gzip_output=True)
+
+        self.assertTrue(os.path.exists(f"{self.filename}.gz"))
+
+    def test_failed_write_keeps_previous_file(self):
+        """Test that an error part way through leaves the previous guide intact and no temporary files."""
+        hdhomerun.write_xmltv(sample_epg_data(), self.filename, gzip_output=True)
+        previous = self.read(self.filename)
+
+        with patch('HDHomeRunEPG_To_XmlTv.render_channel_programmes', side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                hdhomerun.write_xmltv(sample_epg_data(title="Sports"), self.filename, gzip_output=True)
+
+        self.assertEqual(self.read(self.filename), previous)
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)), ["epg.xml", "epg.xml.gz", "epg.xml.sha256"])
+
+
+class TestAtomicM3uOutput(unittest.TestCase):
+    """Test generate_m3u replacing its output atomically."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, "channels.m3u")
+        self.channels = [{"id": "2.1", "name": "Channel 2", "icon": None}]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def generate(self, channels: list) -> None:
+        with contextlib.redirect_stdout(io.StringIO()):
+            generate_m3u_from_xmltv.generate_m3u(channels, "http://hdhomerun:5004", self.filename, gzip_output=True)
+
+    def test_unchanged_playlist_is_not_rewritten(self):
+        """Test that regenerating the same playlist keeps its mtime, and a changed one replaces it."""
+        self.generate(self.channels)
+        mtime = os.path.getmtime(self.filename) - 3600
+        os.utime(self.filename, (mtime, mtime))
+
+        self.generate(self.channels)
+        self.assertEqual(os.path.getmtime(self.filename), mtime)
+
+        self.generate(self.channels + [{"id": "5.1", "name": "Channel 5", "icon": None}])
+        self.assertGreater(os.path.getmtime(self.filename), mtime)
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)), ["channels.m3u", "channels.m3u.gz"])
+
+
+class TestAtomicWrite(unittest.TestCase):
+    """Test the atomic_write helper shared by the guide state, cache and sidecar writers."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, "state.json")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_file_is_replaced_once_written(self):
+        """Test that the previous file is readable until the block finishes."""
+        with atomic_output.atomic_write(self.filename) as f:
+            f.write("first")
+        with atomic_output.atomic_write(self.filename) as f:
+            f.write("second")
+            with open(self.filename) as previous:
+                self.assertEqual(previous.read(), "first")
+
+        with open(self.filename) as f:
+            self.assertEqual(f.read(), "second")
+        self.assertEqual(os.listdir(self.tmpdir.name), ["state.json"])
+
+    def test_failed_write_keeps_previous_file(self):
+        """Test that an error in the block keeps the previous file and removes the temporary one."""
+        with atomic_output.atomic_write(self.filename) as f:
+            f.write("first")
+
+        with self.assertRaises(ValueError):
+            with atomic_output.atomic_write(self.filename) as f:
+                f.write("partial")
+                raise ValueError("bad state")
+
+        with open(self.filename) as f:
+            self.assertEqual(f.read(), "first")
+        self.assertEqual(os.listdir(self.tmpdir.name), ["state.json"])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Test script to verify concurrent guide window fetching in fetch_epg_data.
+"""
+
+import datetime
+import unittest
+import urllib.error
+from unittest.mock import patch
+
+import HDHomeRunEPG_To_XmlTv as hdhomerun
+from tests.helpers import FakeGuideApi, lineup, serving
+
+HOURS = 3
+# Frozen "now" so serial and concurrent runs request the same windows
+NOW = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def guide_api(fail_from_window=None, delay=0.0) -> FakeGuideApi:
+    """Return an API whose windows overlap the next by one programme, to exercise duplicate detection."""
+    fail_from = NOW.timestamp() + fail_from_window * HOURS * 3600 if fail_from_window is not None else None
+    return FakeGuideApi(hours=HOURS + 1.5, slot=5400, fail_from=fail_from, delay=delay)
+
+
+class TestConcurrentFetch(unittest.TestCase):
+    """Test fetch_epg_data with --concurrency greater than one."""
+
+    def fetch(self, api: FakeGuideApi, concurrency: int) -> dict:
+        with serving(api):
+            return hdhomerun.fetch_epg_data("test_auth_token", lineup(), days=2, hours=HOURS, concurrency=concurrency,
+                                            now=NOW)
+
+    def test_concurrent_matches_serial(self):
+        """Test that concurrent fetching merges windows in the same order as serial fetching."""
+        serial = self.fetch(guide_api(), concurrency=1)
+        concurrent = self.fetch(guide_api(delay=0.01), concurrency=4)
+
+        self.assertEqual(serial, concurrent)
+        self.assertEqual(len(serial["channels"]), 2)
+        starts = [programme.start_time for programme in serial["programmes"] if programme.guide_number == "1"]
+        self.assertEqual(starts, sorted(set(starts)), "Programmes should be deduplicated and in time order")
+
+    def test_concurrency_is_bounded(self):
+        """Test that no more than --concurrency windows are in flight at once."""
+        api = guide_api(delay=0.02)
+        self.fetch(api, concurrency=3)
+
+        self.assertLessEqual(api.max_in_flight, 3)
+        self.assertGreater(api.max_in_flight, 1)
+
+    def test_http_400_discards_later_windows(self):
+        """Test that an HTTP 400 keeps earlier windows and discards the failing and later ones."""
+        serial = self.fetch(guide_api(fail_from_window=5), concurrency=1)
+        concurrent = self.fetch(guide_api(fail_from_window=5, delay=0.01), concurrency=4)
+
+        self.assertEqual(serial, concurrent)
+        last_start = NOW.timestamp() + 4 * HOURS * 3600
+        self.assertTrue(all(programme.start_time <= last_start + HOURS * 3600 + 5400 for programme in concurrent["programmes"]))
+        self.assertTrue(any(programme.start_time >= last_start for programme in concurrent["programmes"]))
+
+    def test_other_http_errors_are_raised(self):
+        """Test that non-400 HTTP errors are still raised in concurrent mode."""
+        def forbidden(url):
+            raise urllib.error.HTTPError(url, 403, "Forbidden", {}, None)
+
+        with patch('HDHomeRunEPG_To_XmlTv.HttpSession.open', side_effect=forbidden):
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                hdhomerun.fetch_epg_data("test_auth_token", lineup(), days=2, hours=HOURS, concurrency=4)
+
+        self.assertEqual(context.exception.code, 403)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Regression benchmark for programme ingestion in fetch_epg_data.
+
+Channel lookup and duplicate detection used to scan every channel and every
+programme collected so far, making ingestion quadratic in guide size. These
+tests feed a synthetic large lineup through fetch_epg_data and check that
+ingestion stays fast and scales linearly.
+"""
+
+import io
+import json
+import time
+import unittest
+from unittest.mock import patch
+
+import pytest
+
+import HDHomeRunEPG_To_XmlTv as hdhomerun
+
+GUIDE_START = 1700000000
+
+
+def build_lineup(channel_count: int) -> list:
+    """Build a synthetic lineup of tuned channels."""
+    return [
+        {"GuideNumber": f"{number}.1", "GuideName": f"Channel {number}", "ImageURL": ""}
+        for number in range(1, channel_count + 1)
+    ]
+
+
+def build_guide_response(lineup: list, programmes_per_channel: int) -> bytes:
+    """Build a synthetic guide.php response of half-hour programmes for every channel."""
+    segment = []
+    for channel in lineup:
+        guide = []
+        for index in range(programmes_per_channel):
+            start = GUIDE_START + index * 1800
+            guide.append({
+                "Title": f"Programme {index % 50}",
+                "StartTime": start,
+                "EndTime": start + 1800,
+                "Synopsis": "Synthetic programme",
+            })
+        segment.append({"GuideNumber": channel["GuideNumber"], "ImageURL": "", "Guide": guide})
+    return json.dumps(segment).encode()
+
+
+@pytest.mark.slow
+class TestFetchEpgPerformance(unittest.TestCase):
+    """Benchmark fetch_epg_data on a synthetic 300 channel lineup."""
+
+    def time_ingestion(self, lineup: list, programmes_per_channel: int) -> tuple:
+        """Ingest one window of guide data and return (seconds, epg_data)."""
+        body = build_guide_response(lineup, programmes_per_channel)
+        # The same window is returned twice so every programme also goes through duplicate detection
+        with patch('HDHomeRunEPG_To_XmlTv.HttpSession.open') as mock_open:
+            mock_open.side_effect = [io.BytesIO(body), io.BytesIO(body)]
+            started = time.perf_counter()
+            epg_data = hdhomerun.fetch_epg_data("test_auth_token", lineup, days=1, hours=12)
+            elapsed = time.perf_counter() - started
+        return elapsed, epg_data
+
+    def test_large_lineup_ingestion_is_fast(self):
+        """Test that two days of guide for 300 channels ingests in well under the quadratic cost."""
+        lineup = build_lineup(300)
+        elapsed, epg_data = self.time_ingestion(lineup, 96)
+
+        self.assertEqual(len(epg_data["channels"]), 300)
+        self.assertEqual(len(epg_data["programmes"]), 300 * 96)
+        self.assertLess(elapsed, 5.0, f"Ingesting {300 * 96} programmes took {elapsed:.2f}s")
+        print(f"✓ Ingested {len(epg_data['programmes'])} programmes in {elapsed:.3f}s")
+
+    def test_ingestion_scales_linearly(self):
+        """Test that ingestion time grows linearly rather than quadratically with guide size."""
+        lineup = build_lineup(300)
+        # Take the best of several runs to keep scheduler noise out of the comparison
+        small = min(self.time_ingestion(lineup, 24)[0] for _ in range(3))
+        large = min(self.time_ingestion(lineup, 96)[0] for _ in range(3))
+
+        # Four times the data must take well under sixteen times as long
+        self.assertLess(large, max(small, 0.01) * 10, f"small={small:.3f}s large={large:.3f}s")
+        print(f"✓ 4x guide size took {large / max(small, 1e-9):.1f}x as long")
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
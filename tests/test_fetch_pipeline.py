@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Test script to verify guide windows are transformed while the next window is being fetched.
+"""
+
+import datetime
+import os
+import tempfile
+import threading
+import unittest
+import urllib.error
+from unittest.mock import patch
+
+import HDHomeRunEPG_To_XmlTv as hdhomerun
+from tests.helpers import FakeGuideApi, lineup, serving
+
+HOURS = 3
+NOW = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def window_start(index: int) -> int:
+    """Return the Start of the guide window at index."""
+    return int(NOW.timestamp()) + index * HOURS * 3600
+
+
+def guide_api(fail_from_window=None, malformed_window=None) -> FakeGuideApi:
+    """Return an API with every optional programme field, failing with a server error if asked."""
+    return FakeGuideApi(hours=HOURS, fields={"EpisodeNumber": "S01E02", "Filter": ["News"],
+                                             "OriginalAirdate": 1600000000, "First": False},
+                        fail_from=window_start(fail_from_window) if fail_from_window is not None else None,
+                        fail_status=500,
+                        malformed_at=window_start(malformed_window) if malformed_window is not None else None)
+
+
+class TestFetchPipeline(unittest.TestCase):
+    """Test the producer/consumer pipeline in fetch_epg_data."""
+
+    def fetch(self, api: FakeGuideApi) -> dict:
+        with serving(api):
+            return hdhomerun.fetch_epg_data("test_auth_token", lineup(), days=1, hours=HOURS, now=NOW)
+
+    def test_next_window_is_fetched_during_transform(self):
+        """Test that the second window is requested while the first is still being deduped."""
+        api = guide_api()
+        overlapped = []
+        from_dict = hdhomerun.Channel.from_dict
+
+        def slow_from_dict(*args):
+            if not overlapped:
+                overlapped.append(api.requested(window_start(1)).wait(timeout=5))
+            return from_dict(*args)
+
+        with patch('HDHomeRunEPG_To_XmlTv.Channel.from_dict', side_effect=slow_from_dict):
+            self.fetch(api)
+
+        self.assertEqual(overlapped, [True])
+
+    def test_records_hold_no_rendered_xml(self):
+        """Test that fetched programmes are rendered only when the guide is written."""
+        epg_data = self.fetch(guide_api())
+
+        self.assertFalse(any(hasattr(programme, "fragment") for programme in epg_data["programmes"]))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "epg.xml")
+            hdhomerun.write_xmltv(epg_data, filename)
+            with open(filename, "rb") as xml_file:
+                self.assertEqual(xml_file.read().count(b"<programme "), len(epg_data["programmes"]))
+
+    def test_fetch_errors_reach_the_caller(self):
+        """Test that an HTTP error raised in the fetch thread propagates and the thread is stopped."""
+        threads = threading.active_count()
+        with self.assertRaises(urllib.error.HTTPError):
+            self.fetch(guide_api(fail_from_window=2))
+
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_malformed_window_keeps_earlier_data(self):
+        """Test that a malformed window ends the fetch with the data retrieved so far."""
+        threads = threading.active_count()
+        epg_data = self.fetch(guide_api(malformed_window=2))
+
+        self.assertEqual(len(epg_data["programmes"]), 2 * 2 * HOURS * 2)
+        self.assertEqual(threading.active_count(), threads)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
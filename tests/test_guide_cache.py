@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Test script to verify the on-disk guide.php response cache.
+"""
+
+import datetime
+import os
+import tempfile
+import unittest
+
+import HDHomeRunEPG_To_XmlTv as hdhomerun
+from tests.helpers import FakeGuideApi, lineup, serving
+
+NOW = datetime.datetime(2024, 1, 1, 0, 10, tzinfo=datetime.timezone.utc)
+HOURS = 3
+DAYS = 4
+
+
+def guide_api(etag=None) -> FakeGuideApi:
+    """Return an API serving one programme per window for a single channel."""
+    return FakeGuideApi(channels=("1",), hours=HOURS, slot=HOURS * 3600, etag=etag)
+
+
+class TestGuideCache(unittest.TestCase):
+    """Test fetch_epg_data with a GuideCache."""
+
+    def setUp(self):
+        """Create a temporary cache directory."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmpdir.name, "cache")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def fetch(self, api: FakeGuideApi, elapsed_hours: float = 0, device_auth: str = "auth1"):
+        """Run fetch_epg_data with a fresh GuideCache, ``elapsed_hours`` after NOW."""
+        cache = hdhomerun.GuideCache(self.cache_dir, near_hours=24, near_ttl=1, far_ttl=24)
+        with serving(api):
+            epg_data = hdhomerun.fetch_epg_data(device_auth, lineup(1), days=DAYS, hours=HOURS, cache=cache,
+                                                now=NOW + datetime.timedelta(hours=elapsed_hours))
+        return epg_data, cache
+
+    def test_rerun_is_served_from_cache(self):
+        """Test that a rerun within the TTL makes no requests and returns the same guide."""
+        api = guide_api()
+        first, first_cache = self.fetch(api)
+        requests = len(api.requests)
+        second, second_cache = self.fetch(api, elapsed_hours=0.5, device_auth="auth2")
+
+        self.assertEqual(first_cache.misses, requests)
+        self.assertEqual(len(api.requests), requests, "Cache should be independent of DeviceAuth")
+        self.assertEqual(second_cache.hits, first_cache.misses)
+        self.assertEqual(first["programmes"], second["programmes"])
+
+    def test_windows_are_aligned_to_hours(self):
+        """Test that window starts are aligned to the --hours grid so reruns share them."""
+        api = guide_api()
+        self.fetch(api)
+
+        for _, start, _ in api.requests:
+            self.assertEqual(start % (HOURS * 3600), 0)
+
+    def test_near_term_expires_before_far_future(self):
+        """Test that near-term windows are refetched while far-future windows stay cached."""
+        api = guide_api()
+        self.fetch(api)
+        api.requests.clear()
+        _, cache = self.fetch(api, elapsed_hours=2)
+
+        refetched = [start for _, start, _ in api.requests]
+        horizon = (NOW + datetime.timedelta(hours=2 + 24)).timestamp()
+        self.assertTrue(refetched)
+        self.assertTrue(all(start < horizon for start in refetched))
+        self.assertGreater(cache.hits, 0)
+        self.assertEqual(cache.misses, len(refetched))
+
+    def test_expired_entries_are_revalidated(self):
+        """Test that expired entries send If-None-Match and reuse the cached guide on 304."""
+        api = guide_api(etag='"v1"')
+        first, _ = self.fetch(api)
+        api.requests.clear()
+        second, cache = self.fetch(api, elapsed_hours=2)
+
+        self.assertTrue(api.requests)
+        self.assertTrue(all(headers.get("If-None-Match") == '"v1"' for _, _, headers in api.requests))
+        self.assertEqual(cache.revalidated, len(api.requests))
+        self.assertEqual(cache.misses, 0)
+        starts = {programme.start_time for programme in second["programmes"]}
+        self.assertTrue(starts <= {programme.start_time for programme in first["programmes"]})
+
+    def test_past_windows_are_pruned(self):
+        """Test that cached windows before the current start are removed."""
+        api = guide_api()
+        self.fetch(api)
+        before = set(os.listdir(self.cache_dir))
+        self.fetch(api, elapsed_hours=HOURS * 2)
+        after = set(os.listdir(self.cache_dir))
+
+        self.assertTrue(before - after)
+        cutoff = (NOW + datetime.timedelta(hours=HOURS * 2)).timestamp() - HOURS * 3600
+        for name in after:
+            self.assertGreaterEqual(int(name[:-5].rsplit("-", 1)[1]), cutoff)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Test script to verify the slotted Channel and Programme guide records.
+"""
+
+import os
+import tempfile
+import tracemalloc
+import unittest
+
+import pytest
+
+import HDHomeRunEPG_To_XmlTv as hdhomerun
+
+
+def api_programme(guide_number: str, index: int) -> dict:
+    """Build a guide.php programme dict with the fields the API actually returns."""
+    return {
+        "StartTime": 1700000000 + index * 1800,
+        "EndTime": 1700001800 + index * 1800,
+        "Title": f"Series {index % 40}",
+        "EpisodeNumber": f"S01E{index % 20 + 1:02d}",
+        "EpisodeTitle": f"Episode {index}",
+        "Synopsis": f"A synthetic programme description for episode {index} " * 2,
+        "OriginalAirdate": 1600000000,
+        "ImageURL": f"https://img.hdhomerun.com/titles/C{index % 40}.jpg",
+        "PosterURL": f"https://img.hdhomerun.com/posters/C{index % 40}.jpg",
+        "SeriesID": f"C{index % 40:06d}",
+        "Filter": ["Drama", "Series"],
+        "GuideNumber": guide_number,
+    }
+
+
+class TestGuideRecords(unittest.TestCase):
+    """Test record conversion and guide state round trips."""
+
+    def test_from_dict_keeps_xmltv_fields(self):
+        """Test that a guide.php entry converts to a record and back without losing written fields."""
+        data = api_programme("2.1", 3)
+        programme = hdhomerun.Programme.from_dict("2.1", data)
+
+        expected = {key: value for key, value in data.items() if key not in ("PosterURL", "SeriesID")}
+        self.assertEqual(programme.to_dict(), expected)
+        self.assertEqual(programme.categories, ("Drama", "Series"))
+        self.assertIsNone(programme.first)
+
+    def test_missing_fields_are_none(self):
+        """Test that absent optional fields stay absent when converted back to a dict."""
+        programme = hdhomerun.Programme.from_dict("5.1", {"Title": "News", "StartTime": 1700000000, "EndTime": 1700001800})
+
+        self.assertIsNone(programme.synopsis)
+        self.assertEqual(programme.to_dict(), {"GuideNumber": "5.1", "Title": "News", "StartTime": 1700000000,
+                                               "EndTime": 1700001800})
+
+    def test_repeated_strings_are_shared(self):
+        """Test that titles and categories are interned across programmes."""
+        first = hdhomerun.Programme.from_dict("2.1", api_programme("2.1", 1))
+        second = hdhomerun.Programme.from_dict("5.1", api_programme("5.1", 41))
+
+        self.assertIs(first.title, second.title)
+        self.assertIs(first.categories[0], second.categories[0])
+
+    def test_records_have_no_instance_dict(self):
+        """Test that records are slotted."""
+        self.assertFalse(hasattr(hdhomerun.Programme("1", 0, 1800, "News"), "__dict__"))
+        self.assertFalse(hasattr(hdhomerun.Channel("1", "Channel 1"), "__dict__"))
+
+    def test_guide_state_round_trip(self):
+        """Test that saved guide state loads back as equal records."""
+        epg_data = {
+            "channels": [hdhomerun.Channel("2.1", "Channel 2", "http://img/2.1.png"), hdhomerun.Channel("5.1", None)],
+            "programmes": [hdhomerun.Programme.from_dict("2.1", api_programme("2.1", index)) for index in range(5)],
+        }
+        with tempfile.TemporaryDirectory() as tmpdir:
+            state_file = os.path.join(tmpdir, "guide.json")
+            hdhomerun.save_guide_state(state_file, epg_data)
+            state = hdhomerun.load_guide_state(state_file)
+
+        self.assertEqual(state["channels"], epg_data["channels"])
+        self.assertEqual(state["programmes"], epg_data["programmes"])
+
+
+def measure_allocated(build) -> int:
+    """Return the bytes still allocated after ``build`` constructs a guide."""
+    tracemalloc.start()
+    try:
+        guide = build()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del guide
+    return current
+
+
+@pytest.mark.slow
+class TestGuideRecordsMemory(unittest.TestCase):
+    """Report the memory held by a guide as raw dicts and as records."""
+
+    def test_records_use_less_memory(self):
+        """Test that 30,000 programmes take far less memory as records than as parsed API dicts."""
+        channels, slots = 100, 300
+
+        def raw_guide():
+            return [api_programme(f"{channel}.1", index) for channel in range(channels) for index in range(slots)]
+
+        def record_guide():
+            return [hdhomerun.Programme.from_dict(f"{channel}.1", api_programme(f"{channel}.1", index))
+                    for channel in range(channels) for index in range(slots)]
+
+        raw = measure_allocated(raw_guide)
+        records = measure_allocated(record_guide)
+        # 14 days of half-hour slots on 300 channels
+        scale = 14 * 48 * 300 / (channels * slots)
+        print(f"✓ {channels * slots} programmes: dicts {raw / 2**20:.1f} MiB, records {records / 2**20:.1f} MiB; "
+              f"14 days x 300 channels ≈ {raw * scale / 2**20:.0f} MiB vs {records * scale / 2**20:.0f} MiB")
+        self.assertLess(records, raw * 0.7)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Test script to verify the SQLite guide store written with --sqlite-file.
+"""
+
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+import xml.etree.ElementTree as ET
+from datetime import datetime
+
+import pytest
+
+import HDHomeRunEPG_To_XmlTv as hdhomerun
+from tests.helpers import START
+from tests.helpers import sample_epg_data as sample_guide
+
+
+def programme_fields(index: int) -> dict:
+    """Return the optional fields of the programme in slot index."""
+    return {"episode_title": f"Episode {index}", "synopsis": "A synthetic programme",
+            "categories": ("Drama", "Series") if index % 2 else None, "episode_number": "S01E01",
+            "original_airdate": 1600000000, "first": bool(index % 3 == 0)}
+
+
+def sample_epg_data(channels: int = 3, slots: int = 48, title: str = "Show") -> dict:
+    """Build a guide of half-hour programmes with icons and every optional field."""
+    return sample_guide(channels, slots, title, icons=True, fields=programme_fields)
+
+
+class TestGuideStore(unittest.TestCase):
+    """Test writing and querying the guide database."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, "epg.db")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def open(self) -> sqlite3.Connection:
+        connection = hdhomerun.open_guide_store(self.filename)
+        self.addCleanup(connection.close)
+        return connection
+
+    def test_round_trip(self):
+        """Test that every programme reads back as an equal record."""
+        epg_data = sample_epg_data()
+        hdhomerun.write_sqlite(epg_data, self.filename)
+
+        programmes = hdhomerun.query_programmes(self.open(), None, START, START + 48 * 1800)
+        self.assertEqual(programmes, epg_data["programmes"])
+        self.assertEqual(programmes[1].categories, ("Drama", "Series"))
+        self.assertIs(programmes[0].first, True)
+
+    def test_channels_keep_lineup_order(self):
+        """Test that channels are stored with their lineup position."""
+        epg_data = sample_epg_data()
+        epg_data["channels"].reverse()
+        hdhomerun.write_sqlite(epg_data, self.filename)
+
+        rows = self.open().execute("SELECT guide_number, guide_name, image_url FROM channels ORDER BY position")
+        self.assertEqual([hdhomerun.Channel(*row) for row in rows], epg_data["channels"])
+
+    def test_time_range_overlap(self):
+        """Test that programmes partly inside the range are included and ones touching its edges are not."""
+        hdhomerun.write_sqlite(sample_epg_data(), self.filename)
+        connection = self.open()
+
+        # 00:45 to 01:45 overlaps the 00:30, 01:00 and 01:30 slots
+        programmes = hdhomerun.query_programmes(connection, "1.1", START + 2700, START + 6300)
+        self.assertEqual([programme.start_time for programme in programmes], [START + 1800, START + 3600, START + 5400])
+        self.assertTrue(all(programme.guide_number == "1.1" for programme in programmes))
+
+        # Exactly one slot: the neighbours ending at the start and starting at the end are excluded
+        programmes = hdhomerun.query_programmes(connection, None, START + 3600, START + 5400)
+        self.assertEqual([(p.guide_number, p.start_time) for p in programmes],
+                         [("0.1", START + 3600), ("1.1", START + 3600), ("2.1", START + 3600)])
+
+        self.assertEqual(hdhomerun.query_programmes(connection, "9.1", START, START + 86400), [])
+
+    def test_queries_use_indexes(self):
+        """Test that channel and time range queries are answered from the indexes."""
+        hdhomerun.write_sqlite(sample_epg_data(), self.filename)
+        connection = self.open()
+
+        def plan(sql, parameters):
+            return " ".join(row[-1] for row in connection.execute(f"EXPLAIN QUERY PLAN {sql}", parameters))
+
+        self.assertIn("programmes_channel_start",
+                      plan("SELECT * FROM programmes WHERE guide_number = ? AND start_time < ? AND end_time > ?",
+                           ("1.1", START + 3600, START)))
+        self.assertIn("programmes_start_end",
+                      plan("SELECT * FROM programmes WHERE start_time < ? AND end_time > ?", (START + 3600, START)))
+
+    def test_rewrite_replaces_database(self):
+        """Test that a new guide is renamed over the old database, leaving open readers on the old one."""
+        hdhomerun.write_sqlite(sample_epg_data(), self.filename)
+        reader = self.open()
+
+        hdhomerun.write_sqlite(sample_epg_data(slots=4, title="News"), self.filename)
+
+        self.assertEqual(hdhomerun.query_programmes(reader, "0.1", START, START + 1800)[0].title, "Show 0")
+        self.assertEqual(hdhomerun.query_programmes(self.open(), "0.1", START, START + 1800)[0].title, "News 0")
+        self.assertEqual(self.open().execute("SELECT COUNT(*) FROM programmes").fetchone()[0], 12)
+        self.assertEqual(os.listdir(self.tmpdir.name), ["epg.db"])
+
+    def test_store_is_read_only(self):
+        """Test that connections from open_guide_store cannot modify the guide."""
+        hdhomerun.write_sqlite(sample_epg_data(), self.filename)
+
+        with self.assertRaises(sqlite3.OperationalError):
+            self.open().execute("DELETE FROM programmes")
+
+    def test_unknown_version_is_rejected(self):
+        """Test that a database with another schema version is refused."""
+        hdhomerun.write_sqlite(sample_epg_data(), self.filename)
+        with sqlite3.connect(self.filename) as connection:
+            connection.execute("PRAGMA user_version = 99")
+        connection.close()
+
+        with self.assertRaises(sqlite3.DatabaseError):
+            hdhomerun.open_guide_store(self.filename)
+
+
+@pytest.mark.slow
+class TestGuideStoreLatency(unittest.TestCase):
+    """Compare answering a time slice query from the database and from the XMLTV file."""
+
+    def test_slice_query_is_faster_than_parsing_xmltv(self):
+        """Test that a two hour slice of 100 channels x 7 days comes from SQLite much faster than from epg.xml."""
+        epg_data = sample_epg_data(channels=100, slots=7 * 48)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            xml_filename = os.path.join(tmpdir, "epg.xml")
+            db_filename = os.path.join(tmpdir, "epg.db")
+            hdhomerun.write_xmltv(epg_data, xml_filename)
+            hdhomerun.write_sqlite(epg_data, db_filename)
+            start, end = START + 3 * 86400, START + 3 * 86400 + 7200
+
+            began = time.perf_counter()
+            xml_count = 0
+            for programme in ET.parse(xml_filename).getroot().iter("programme"):
+                programme_start = datetime.strptime(programme.get("start"), "%Y%m%d%H%M%S %z").timestamp()
+                programme_stop = datetime.strptime(programme.get("stop"), "%Y%m%d%H%M%S %z").timestamp()
+                xml_count += programme_start < end and programme_stop > start
+            xml_seconds = time.perf_counter() - began
+
+            connection = hdhomerun.open_guide_store(db_filename)
+            try:
+                began = time.perf_counter()
+                programmes = hdhomerun.query_programmes(connection, None, start, end)
+                sqlite_seconds = time.perf_counter() - began
+            finally:
+                connection.close()
+
+        print(f"✓ {len(epg_data['programmes'])} programmes, 2 hour slice of {len(programmes)}: "
+              f"XMLTV parse {xml_seconds * 1000:.0f} ms, SQLite {sqlite_seconds * 1000:.1f} ms")
+        self.assertEqual(len(programmes), xml_count)
+        self.assertLess(sqlite_seconds, xml_seconds / 10)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Test script to verify gzip compressed EPG and M3U output written in the same pass.
+"""
+
+import contextlib
+import gzip
+import io
+import os
+import tempfile
+import threading
+import unittest
+import urllib.request
+from http.server import HTTPServer
+
+import generate_m3u_from_xmltv
+import HDHomeRunEPG_To_XmlTv as hdhomerun
+import http_server
+from tests.helpers import sample_epg_data
+
+
+class TestGzipOutput(unittest.TestCase):
+    """Test the --gzip output of the XMLTV and M3U writers."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def read(self, filename: str) -> bytes:
+        with open(filename, "rb") as f:
+            return f.read()
+
+    def test_xmltv_gzip_matches_plain_output(self):
+        """Test that epg.xml.gz decompresses to exactly the epg.xml written alongside it."""
+        filename = os.path.join(self.tmpdir.name, "epg.xml")
+        hdhomerun.write_xmltv(sample_epg_data(), filename, gzip_output=True)
+
+        compressed = self.read(f"{filename}.gz")
+        self.assertEqual(gzip.decompress(compressed), self.read(filename))
+        self.assertLess(len(compressed), len(self.read(filename)) / 4)
+
+    def test_xmltv_gzip_is_reproducible(self):
+        """Test that the same guide compresses to identical bytes so unchanged files can be detected."""
+        filename = os.path.join(self.tmpdir.name, "epg.xml")
+        hdhomerun.write_xmltv(sample_epg_data(), filename, gzip_output=True)
+        first = self.read(f"{filename}.gz")
+        hdhomerun.write_xmltv(sample_epg_data(), filename, gzip_output=True, workers=2)
+
+        self.assertEqual(self.read(f"{filename}.gz"), first)
+
+    def test_no_gzip_by_default(self):
+        """Test that no compressed copy is written unless requested."""
+        filename = os.path.join(self.tmpdir.name, "epg.xml")
+        hdhomerun.write_xmltv(sample_epg_data(), filename)
+
+        self.assertFalse(os.path.exists(f"{filename}.gz"))
+
+    def test_m3u_gzip_matches_plain_output(self):
+        """Test that channels.m3u.gz decompresses to exactly the playlist written alongside it."""
+        filename = os.path.join(self.tmpdir.name, "channels.m3u")
+        channels = [{"id": "2.1", "name": "KTVK", "icon": "http://img/2.1.png"}, {"id": "5.1", "name": "Ünïcode", "icon": None}]
+        with contextlib.redirect_stdout(io.StringIO()):
+            generate_m3u_from_xmltv.generate_m3u(channels, "http://hdhomerun:5004", filename, gzip_output=True)
+
+        self.assertEqual(gzip.decompress(self.read(f"{filename}.gz")), self.read(filename))
+        self.assertTrue(self.read(filename).startswith(b"#EXTM3U\n"))
+
+    def test_compressed_epg_is_served(self):
+        """Test that the HTTP server serves the precompressed EPG file directly."""
+        filename = os.path.join(self.tmpdir.name, "epg.xml")
+        hdhomerun.write_xmltv(sample_epg_data(), filename, gzip_output=True)
+        http_server.EPGRequestHandler.epg_file_path = filename
+        http_server.EPGRequestHandler.m3u_file_path = None
+        server = HTTPServer(("127.0.0.1", 0), http_server.EPGRequestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/epg.xml.gz") as response:
+                self.assertEqual(response.headers["Content-Type"], "application/gzip")
+                self.assertEqual(response.read(), self.read(f"{filename}.gz"))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
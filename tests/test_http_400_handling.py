@@ -3,11 +3,12 @@
 Test script to verify HTTP 400 error handling in fetch_epg_data.
 """
 
+import io
 import json
 import sys
 import unittest
 import urllib.error
-from unittest.mock import MagicMock, patch
+from unittest.mock import patch
 
 # Import the module we're testing
 sys.path.insert(0, '/Users/andy/workspaces/forks/HDHomeRunEPG-to-XmlTv')
@@ -25,8 +26,8 @@ class TestHTTP400Handling(unittest.TestCase):
             {"GuideNumber": "501", "GuideName": "ESPN", "ImageURL": ""},
         ]
 
-    @patch('HDHomeRunEPG_To_XmlTv.urllib.request.urlopen')
-    def test_http_400_graceful_handling(self, mock_urlopen):
+    @patch('HDHomeRunEPG_To_XmlTv.HttpSession.open')
+    def test_http_400_graceful_handling(self, mock_open):
         """Test that HTTP 400 errors are caught and don't crash the script."""
 
         # Create a mock response for the first successful request
@@ -44,15 +45,9 @@ class TestHTTP400Handling(unittest.TestCase):
             }
         ]
 
-        # First call succeeds, second call raises HTTP 400
-        mock_response = MagicMock()
-        mock_response.read.return_value = json.dumps(mock_response_data).encode()
-        mock_response.__enter__.return_value = mock_response
-        mock_response.__exit__.return_value = False
-
         # Make first call succeed, second call fail with 400
-        mock_urlopen.side_effect = [
-            mock_response,  # First successful response
+        mock_open.side_effect = [
+            io.BytesIO(json.dumps(mock_response_data).encode()),  # First successful response
             urllib.error.HTTPError(
                 "https://api.hdhomerun.com/api/guide.php",
                 400,
@@ -74,16 +69,16 @@ class TestHTTP400Handling(unittest.TestCase):
         self.assertIsNotNone(result)
         self.assertEqual(len(result["channels"]), 1, "Should have one channel from successful request")
         self.assertEqual(len(result["programmes"]), 1, "Should have one programme from successful request")
-        self.assertEqual(result["programmes"][0]["Title"], "Test Program")
+        self.assertEqual(result["programmes"][0].title, "Test Program")
 
         print("✓ Test passed: HTTP 400 errors are handled gracefully")
         print(f"✓ Successfully retrieved {len(result['programmes'])} programmes before API limit")
 
-    @patch('HDHomeRunEPG_To_XmlTv.urllib.request.urlopen')
-    def test_other_http_errors_are_raised(self, mock_urlopen):
+    @patch('HDHomeRunEPG_To_XmlTv.HttpSession.open')
+    def test_other_http_errors_are_raised(self, mock_open):
         """Test that other HTTP errors are not suppressed."""
 
-        mock_urlopen.side_effect = urllib.error.HTTPError(
+        mock_open.side_effect = urllib.error.HTTPError(
             "https://api.hdhomerun.com/api/guide.php",
             403,
             "Forbidden",
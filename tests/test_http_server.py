@@ -0,0 +1,1045 @@
+#!/usr/bin/env python3
+"""
+Test script to verify the EPG HTTP server: threading, file caching, conditional, compressed, range and HEAD
+requests, guide slices, the /now and /next listings, the /metrics endpoint and the in-process guide refresh.
+"""
+
+import contextlib
+import email.utils
+import gzip
+import hashlib
+import inspect
+import io
+import json
+import mmap
+import os
+import random
+import socket
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
+import urllib.parse
+import urllib.request
+import xml.etree.ElementTree as ET
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer
+from unittest.mock import patch
+
+import pytest
+
+import generate_m3u_from_xmltv
+import HDHomeRunEPG_To_XmlTv as hdhomerun
+import http_server
+from tests.helpers import sample_epg_data
+
+
+@contextlib.contextmanager
+def running_server(handler, server_class=http_server.EPGHTTPServer):
+    """Serve handler on a free local port and yield the base URL."""
+    server = server_class(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def make_handler(epg_file_path, m3u_file_path=None, **attributes):
+    """Return an EPGRequestHandler subclass serving the given files from its own cache."""
+    attributes.setdefault("file_cache", http_server.FileCache())
+    return type("Handler", (http_server.EPGRequestHandler,),
+                dict(epg_file_path=epg_file_path, m3u_file_path=m3u_file_path, **attributes))
+
+
+def raw_request(url, request):
+    """Send a raw HTTP request and return the whole response, headers included."""
+    host, port = url[len("http://"):].split(":")
+    with socket.create_connection((host, int(port))) as connection:
+        connection.sendall(request)
+        return connection.makefile("rb").read()
+
+
+def fetch(url, headers=None, method="GET"):
+    """Request a URL and return (status, headers, body)."""
+    request = urllib.request.Request(url, headers=headers or {}, method=method)
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as error:
+        return error.code, error.headers, error.read()
+
+
+class TestFileCache(unittest.TestCase):
+    """Test reloading cached files only when they change."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, "epg.xml")
+        self.write(b"<tv>first</tv>")
+        self.cache = http_server.FileCache()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, content):
+        """Replace the file the way the generator does."""
+        tmp = f"{self.filename}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(content)
+        os.replace(tmp, self.filename)
+
+    def test_unchanged_file_is_not_reread(self):
+        """Test that repeated lookups return the same cached version."""
+        first = self.cache.get(self.filename)
+        self.assertEqual(first.content, b"<tv>first</tv>")
+        self.assertIs(self.cache.get(self.filename), first)
+
+    def test_replaced_file_is_reloaded(self):
+        """Test that renaming a new file into place is picked up on the next request."""
+        first = self.cache.get(self.filename)
+        self.write(b"<tv>second</tv>")
+
+        second = self.cache.get(self.filename)
+        self.assertIsNot(second, first)
+        self.assertEqual(second.content, b"<tv>second</tv>")
+
+    def test_missing_file(self):
+        """Test that a missing or removed file is reported as None."""
+        self.cache.get(self.filename)
+        os.remove(self.filename)
+
+        self.assertIsNone(self.cache.get(self.filename))
+
+
+class TestThreadedServer(unittest.TestCase):
+    """Test serving requests concurrently from the cache."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.epg_file = os.path.join(self.tmpdir.name, "epg.xml")
+        self.m3u_file = os.path.join(self.tmpdir.name, "channels.m3u")
+        with open(self.epg_file, "wb") as f:
+            f.write(b"<tv>" + b"<programme/>" * 1000 + b"</tv>")
+        with open(self.m3u_file, "wb") as f:
+            f.write(b"#EXTM3U\n")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_serves_cached_files(self):
+        """Test that the EPG and playlist are served, and a replaced EPG is served on the next request."""
+        handler = make_handler(self.epg_file, self.m3u_file)
+        with running_server(handler) as url:
+            self.assertEqual(fetch(f"{url}/epg.xml")[2], b"<tv>" + b"<programme/>" * 1000 + b"</tv>")
+            self.assertEqual(fetch(f"{url}/channels.m3u")[2], b"#EXTM3U\n")
+            with open(f"{self.epg_file}.tmp", "wb") as f:
+                f.write(b"<tv/>")
+            os.replace(f"{self.epg_file}.tmp", self.epg_file)
+            self.assertEqual(fetch(f"{url}/epg.xml")[2], b"<tv/>")
+
+    def test_missing_file_is_404(self):
+        """Test that a missing EPG file is reported as not found."""
+        handler = make_handler(os.path.join(self.tmpdir.name, "missing.xml"))
+        with running_server(handler) as url:
+            self.assertEqual(fetch(f"{url}/epg.xml")[0], 404)
+
+    def test_stalled_client_does_not_block_health_check(self):
+        """Test that a client that never finishes its request does not hold up other requests."""
+        handler = make_handler(self.epg_file)
+        with running_server(handler) as url:
+            host, port = url[len("http://"):].split(":")
+            with socket.create_connection((host, int(port))) as stalled:
+                stalled.sendall(b"GET /health HTTP/1.1\r\n")
+                self.assertEqual(fetch(f"{url}/health")[2], b"OK")
+                stalled.sendall(b"\r\n")
+                self.assertTrue(stalled.makefile("rb").read().endswith(b"OK"))
+
+
+class TestConditionalGet(unittest.TestCase):
+    """Test ETag and Last-Modified revalidation."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.epg_file = os.path.join(self.tmpdir.name, "epg.xml")
+        hdhomerun.write_xmltv(sample_epg_data(), self.epg_file)
+        self.stack = contextlib.ExitStack()
+        self.url = self.stack.enter_context(running_server(make_handler(self.epg_file)))
+
+    def tearDown(self):
+        self.stack.close()
+        self.tmpdir.cleanup()
+
+    def test_validators_are_sent(self):
+        """Test that the ETag is the content SHA-256 recorded by the generator, with the file mtime."""
+        status, headers, body = fetch(f"{self.url}/epg.xml")
+
+        self.assertEqual(status, 200)
+        self.assertEqual(headers["ETag"], f'"{hashlib.sha256(body).hexdigest()}"')
+        self.assertEqual(headers["ETag"], f'"{hdhomerun.read_digest(self.epg_file)}"')
+        self.assertEqual(email.utils.parsedate_to_datetime(headers["Last-Modified"]).timestamp(),
+                         int(os.path.getmtime(self.epg_file)))
+
+    def test_matching_etag_is_not_modified(self):
+        """Test that If-None-Match with the current ETag, alone, weak or in a list, returns 304."""
+        etag = fetch(f"{self.url}/epg.xml")[1]["ETag"]
+
+        for if_none_match in (etag, f"W/{etag}", f'"other", {etag}', "*"):
+            status, headers, body = fetch(f"{self.url}/epg.xml", {"If-None-Match": if_none_match})
+            self.assertEqual((status, body), (304, b""), if_none_match)
+            self.assertEqual(headers["ETag"], etag)
+
+        self.assertEqual(fetch(f"{self.url}/epg.xml", {"If-None-Match": '"other"'})[0], 200)
+
+    def test_if_modified_since(self):
+        """Test that If-Modified-Since at or after the mtime returns 304, and before it returns 200."""
+        last_modified = fetch(f"{self.url}/epg.xml")[1]["Last-Modified"]
+        earlier = email.utils.formatdate(os.path.getmtime(self.epg_file) - 60, usegmt=True)
+
+        self.assertEqual(fetch(f"{self.url}/epg.xml", {"If-Modified-Since": last_modified})[0], 304)
+        self.assertEqual(fetch(f"{self.url}/epg.xml", {"If-Modified-Since": earlier})[0], 200)
+        self.assertEqual(fetch(f"{self.url}/epg.xml", {"If-Modified-Since": "yesterday"})[0], 200)
+        # A mismatched ETag wins over a matching date
+        self.assertEqual(fetch(f"{self.url}/epg.xml", {"If-None-Match": '"other"',
+                                                       "If-Modified-Since": last_modified})[0], 200)
+
+    def test_new_version_is_sent_to_revalidating_clients(self):
+        """Test that a client holding the old ETag gets the new guide after it is replaced."""
+        etag = fetch(f"{self.url}/epg.xml")[1]["ETag"]
+        with open(f"{self.epg_file}.tmp", "wb") as f:
+            f.write(b"<tv/>")
+        os.replace(f"{self.epg_file}.tmp", self.epg_file)
+
+        status, headers, body = fetch(f"{self.url}/epg.xml", {"If-None-Match": etag})
+        self.assertEqual((status, body), (200, b"<tv/>"))
+        self.assertNotEqual(headers["ETag"], etag)
+
+    def test_revalidation_is_small(self):
+        """Test that a repeat poll costs a few hundred bytes instead of the whole guide."""
+        etag = fetch(f"{self.url}/epg.xml")[1]["ETag"]
+        full = raw_request(self.url, b"GET /epg.xml HTTP/1.0\r\n\r\n")
+        revalidated = raw_request(self.url, f"GET /epg.xml HTTP/1.0\r\nIf-None-Match: {etag}\r\n\r\n".encode())
+
+        print(f"✓ full response {len(full)} bytes, 304 response {len(revalidated)} bytes")
+        self.assertTrue(revalidated.startswith(b"HTTP/1.0 304"))
+        self.assertLess(len(revalidated), 400)
+
+
+class TestCompressedResponses(unittest.TestCase):
+    """Test Accept-Encoding negotiation of gzip and deflate responses."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.epg_file = os.path.join(self.tmpdir.name, "epg.xml")
+        self.m3u_file = os.path.join(self.tmpdir.name, "channels.m3u")
+        hdhomerun.write_xmltv(sample_epg_data(), self.epg_file, gzip_output=True)
+        with open(self.m3u_file, "wb") as f:
+            f.write(b"#EXTM3U\n" + b"#EXTINF:-1 tvg-id=\"2.1\",2.1 Channel\nhttp://hdhomerun:5004/auto/v2.1\n" * 20)
+        with open(self.epg_file, "rb") as f:
+            self.epg = f.read()
+        self.file_cache = http_server.FileCache()
+        self.stack = contextlib.ExitStack()
+        self.url = self.stack.enter_context(running_server(
+            make_handler(self.epg_file, self.m3u_file, file_cache=self.file_cache)))
+
+    def tearDown(self):
+        self.stack.close()
+        self.tmpdir.cleanup()
+
+    def test_gzip_is_negotiated(self):
+        """Test that a client accepting gzip gets the guide compressed, with Vary and its own ETag."""
+        plain_etag = fetch(f"{self.url}/epg.xml")[1]["ETag"]
+        status, headers, body = fetch(f"{self.url}/epg.xml", {"Accept-Encoding": "gzip, deflate"})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        self.assertEqual(headers["Vary"], "Accept-Encoding")
+        self.assertEqual(gzip.decompress(body), self.epg)
+        self.assertEqual(int(headers["Content-Length"]), len(body))
+        self.assertNotEqual(headers["ETag"], plain_etag)
+
+    def test_deflate_and_weights(self):
+        """Test that q-values choose the encoding and q=0 refuses it."""
+        status, headers, body = fetch(f"{self.url}/channels.m3u", {"Accept-Encoding": "gzip;q=0.5, deflate"})
+        self.assertEqual(headers["Content-Encoding"], "deflate")
+        self.assertEqual(zlib.decompress(body), fetch(f"{self.url}/channels.m3u")[2])
+
+        for accept_encoding in ("gzip;q=0", "br", "identity", ""):
+            status, headers, body = fetch(f"{self.url}/epg.xml", {"Accept-Encoding": accept_encoding})
+            self.assertIsNone(headers["Content-Encoding"], accept_encoding)
+            self.assertEqual(body, self.epg)
+            self.assertEqual(headers["Vary"], "Accept-Encoding")
+
+        self.assertEqual(fetch(f"{self.url}/epg.xml", {"Accept-Encoding": "*"})[1]["Content-Encoding"], "gzip")
+
+    def test_gzip_copy_is_sent_for_same_version(self):
+        """Test that a gzip response is the epg.xml.gz written with the guide, in memory or streamed."""
+        with open(f"{self.epg_file}.gz", "rb") as f:
+            compressed = f.read()
+        streamed_url = self.stack.enter_context(running_server(
+            make_handler(self.epg_file, file_cache=http_server.FileCache(sendfile_size=1))))
+
+        for url in (self.url, streamed_url):
+            status, headers, body = fetch(f"{url}/epg.xml", {"Accept-Encoding": "gzip"})
+            self.assertEqual(headers["Content-Encoding"], "gzip")
+            self.assertEqual(body, compressed)
+            self.assertEqual(fetch(f"{url}/epg.xml", {"Accept-Encoding": "gzip", "Range": "bytes=0-9"})[2],
+                             compressed[:10])
+
+    def test_stale_gzip_copy_is_not_sent(self):
+        """Test that a guide rewritten without --gzip is compressed in memory instead of sending the old copy."""
+        hdhomerun.write_xmltv(sample_epg_data(title="News"), self.epg_file)
+        with open(self.epg_file, "rb") as f:
+            epg = f.read()
+
+        body = fetch(f"{self.url}/epg.xml", {"Accept-Encoding": "gzip"})[2]
+        self.assertEqual(gzip.decompress(body), epg)
+
+    def test_compressed_once_per_version(self):
+        """Test that the compressed variant is reused until the file changes."""
+        os.remove(f"{self.epg_file}.gz")
+        headers = {"Accept-Encoding": "gzip"}
+        first = fetch(f"{self.url}/epg.xml", headers)[2]
+        cached = self.file_cache.get(self.epg_file)
+        variant = cached.variant("gzip")
+
+        self.assertEqual(fetch(f"{self.url}/epg.xml", headers)[2], first)
+        self.assertIs(cached.variant("gzip"), variant)
+
+        with open(f"{self.epg_file}.tmp", "wb") as f:
+            f.write(b"<tv/>")
+        os.replace(f"{self.epg_file}.tmp", self.epg_file)
+        self.assertEqual(gzip.decompress(fetch(f"{self.url}/epg.xml", headers)[2]), b"<tv/>")
+
+    def test_compressed_revalidation(self):
+        """Test that a compressed response revalidates against its own ETag."""
+        etag = fetch(f"{self.url}/epg.xml", {"Accept-Encoding": "gzip"})[1]["ETag"]
+
+        status, headers, _ = fetch(f"{self.url}/epg.xml", {"Accept-Encoding": "gzip", "If-None-Match": etag})
+        self.assertEqual(status, 304)
+        self.assertEqual(headers["Vary"], "Accept-Encoding")
+        self.assertEqual(fetch(f"{self.url}/epg.xml", {"If-None-Match": etag})[0], 200)
+
+    def test_precompressed_file_is_not_recompressed(self):
+        """Test that /epg.xml.gz is sent as the stored gzip file whatever the client accepts."""
+        status, headers, body = fetch(f"{self.url}/epg.xml.gz", {"Accept-Encoding": "gzip"})
+
+        self.assertIsNone(headers["Content-Encoding"])
+        self.assertIsNone(headers["Vary"])
+        with open(f"{self.epg_file}.gz", "rb") as f:
+            self.assertEqual(body, f.read())
+
+
+class TestRangeAndHead(unittest.TestCase):
+    """Test HEAD and Range requests, for files held in memory and files streamed with sendfile."""
+
+    sendfile_size = None
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.epg_file = os.path.join(self.tmpdir.name, "epg.xml")
+        hdhomerun.write_xmltv(sample_epg_data(), self.epg_file)
+        with open(self.epg_file, "rb") as f:
+            self.epg = f.read()
+        self.file_cache = http_server.FileCache(self.sendfile_size)
+        self.stack = contextlib.ExitStack()
+        self.url = self.stack.enter_context(running_server(make_handler(self.epg_file, file_cache=self.file_cache)))
+
+    def tearDown(self):
+        self.stack.close()
+        self.tmpdir.cleanup()
+
+    def test_head(self):
+        """Test that HEAD sends the headers of a GET without the body."""
+        _, get_headers, _ = fetch(f"{self.url}/epg.xml")
+        status, headers, body = fetch(f"{self.url}/epg.xml", method="HEAD")
+
+        self.assertEqual((status, body), (200, b""))
+        self.assertEqual(headers["Content-Length"], str(len(self.epg)))
+        self.assertEqual(headers["ETag"], get_headers["ETag"])
+        self.assertEqual(headers["Accept-Ranges"], "bytes")
+        self.assertEqual(fetch(f"{self.url}/health", method="HEAD")[2], b"")
+
+    def test_ranges(self):
+        """Test that byte ranges, open ended ranges and suffix ranges return 206 with Content-Range."""
+        size = len(self.epg)
+        for range_header, start, end in (("bytes=10-19", 10, 20), ("bytes=100-", 100, size),
+                                         ("bytes=-50", size - 50, size), ("bytes=0-999999999", 0, size)):
+            status, headers, body = fetch(f"{self.url}/epg.xml", {"Range": range_header})
+            self.assertEqual(status, 206, range_header)
+            self.assertEqual(body, self.epg[start:end], range_header)
+            self.assertEqual(headers["Content-Range"], f"bytes {start}-{end - 1}/{size}")
+            self.assertEqual(headers["Content-Length"], str(end - start))
+
+    def test_unsatisfiable_and_ignored_ranges(self):
+        """Test that a range past the end is 416, and multiple or malformed ranges get the whole file."""
+        status, headers, _ = fetch(f"{self.url}/epg.xml", {"Range": f"bytes={len(self.epg)}-"})
+        self.assertEqual(status, 416)
+        self.assertEqual(headers["Content-Range"], f"bytes */{len(self.epg)}")
+
+        for range_header in ("bytes=0-1,5-6", "bytes=a-b", "lines=1-2"):
+            self.assertEqual(fetch(f"{self.url}/epg.xml", {"Range": range_header})[:3:2], (200, self.epg))
+
+    def test_resume_requires_same_version(self):
+        """Test that If-Range resumes only while the guide is unchanged."""
+        _, headers, _ = fetch(f"{self.url}/epg.xml")
+
+        self.assertEqual(fetch(f"{self.url}/epg.xml", {"Range": "bytes=100-", "If-Range": headers["ETag"]})[0], 206)
+        self.assertEqual(fetch(f"{self.url}/epg.xml",
+                               {"Range": "bytes=100-", "If-Range": headers["Last-Modified"]})[0], 206)
+        status, _, body = fetch(f"{self.url}/epg.xml", {"Range": "bytes=100-", "If-Range": '"previous"'})
+        self.assertEqual((status, body), (200, self.epg))
+
+    def test_compressed_range(self):
+        """Test that a range of a compressed response is taken from the compressed bytes."""
+        compressed = fetch(f"{self.url}/epg.xml", {"Accept-Encoding": "gzip"})[2]
+        status, headers, body = fetch(f"{self.url}/epg.xml", {"Accept-Encoding": "gzip", "Range": "bytes=10-"})
+
+        self.assertEqual((status, body), (206, compressed[10:]))
+        self.assertEqual(gzip.decompress(compressed), self.epg)
+
+
+class TestSendfileRangeAndHead(TestRangeAndHead):
+    """Run the range and HEAD tests with every file streamed from disk."""
+
+    sendfile_size = 0
+
+    def test_streamed_with_sendfile(self):
+        """Test that a streamed file is not held in memory and is sent with socket.sendfile."""
+        with patch.object(socket.socket, "sendfile", autospec=True, side_effect=socket.socket.sendfile) as sendfile:
+            self.assertEqual(fetch(f"{self.url}/epg.xml")[2], self.epg)
+            self.assertEqual(fetch(f"{self.url}/epg.xml", {"Range": "bytes=10-19"})[2], self.epg[10:20])
+
+        self.assertIsNone(self.file_cache.get(self.epg_file).content)
+        self.assertEqual([call.args[2:] for call in sendfile.call_args_list], [(0, len(self.epg)), (10, 10)])
+
+    def test_open_returns_current_version(self):
+        """Test that a streamed file replaced after it was cached is opened together with its new version."""
+        self.file_cache.get(self.epg_file)
+        with open(f"{self.epg_file}.tmp", "wb") as f:
+            f.write(b"<tv/>")
+        os.replace(f"{self.epg_file}.tmp", self.epg_file)
+
+        cached, file = self.file_cache.open(self.epg_file)
+        with file:
+            self.assertEqual((cached.size, file.read()), (5, b"<tv/>"))
+
+
+class TestGuideSlices(unittest.TestCase):
+    """Test /epg.xml queries by time window and channel."""
+
+    sendfile_size = None
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.epg_file = os.path.join(self.tmpdir.name, "epg.xml")
+        hdhomerun.write_xmltv(sample_epg_data(channels=3, slots=48), self.epg_file)
+        self.file_cache = http_server.FileCache(self.sendfile_size)
+        self.stack = contextlib.ExitStack()
+        self.url = self.stack.enter_context(running_server(make_handler(self.epg_file, file_cache=self.file_cache)))
+
+    def tearDown(self):
+        self.stack.close()
+        self.tmpdir.cleanup()
+
+    def query(self, query, headers=None):
+        status, headers, body = fetch(f"{self.url}/epg.xml?{query}", headers)
+        self.assertEqual(status, 200, body)
+        return ET.fromstring(body)
+
+    def programmes(self, root):
+        return [(programme.get("channel"), programme.find("title").text) for programme in root.iter("programme")]
+
+    def test_time_window(self):
+        """Test that a window returns every channel and the programmes overlapping it."""
+        # 00:45 to 01:45 after the first programme overlaps slots 1, 2 and 3
+        root = self.query("start=1700002700&end=1700006300")
+
+        self.assertEqual(root.tag, "tv")
+        self.assertEqual(root.get("generator-info-name"), "HDHomeRunEPG_to_XmlTv")
+        self.assertEqual([channel.get("id") for channel in root.iter("channel")], ["0.1", "1.1", "2.1"])
+        self.assertEqual(self.programmes(root),
+                         [(f"{number}.1", f"Show {index}") for number in range(3) for index in (1, 2, 3)])
+
+    def test_channel_filter(self):
+        """Test that only the listed channels, and their programmes, are returned."""
+        root = self.query("channels=2.1,0.1,9.9&end=1700001800")
+
+        self.assertEqual([channel.get("id") for channel in root.iter("channel")], ["0.1", "2.1"])
+        self.assertEqual(self.programmes(root), [("0.1", "Show 0"), ("2.1", "Show 0")])
+        self.assertEqual(len(self.query("channels=1.1").findall("programme")), 48)
+
+    def test_iso_times(self):
+        """Test that ISO 8601 times, with or without an offset, select the same slice as epoch seconds."""
+        epoch = self.programmes(self.query("start=1700002700&end=1700006300"))
+
+        self.assertEqual(self.programmes(self.query("start=2023-11-14T22:58:20Z&end=2023-11-14T23:58:20")), epoch)
+        self.assertEqual(self.programmes(self.query(
+            "start=" + urllib.parse.quote("2023-11-14T15:58:20-07:00") + "&end=1700006300")), epoch)
+
+    def test_invalid_query(self):
+        """Test that an unparseable time is rejected with 400."""
+        self.assertEqual(fetch(f"{self.url}/epg.xml?start=tomorrow")[0], 400)
+
+    def test_slices_are_indexed_once_per_version(self):
+        """Test that the guide is parsed once for all slices and reindexed only when it is replaced."""
+        with patch.object(http_server, "GuideIndex", wraps=http_server.GuideIndex) as guide_index:
+            first = fetch(f"{self.url}/epg.xml?channels=0.1")
+            self.query("channels=1.1")
+            self.assertEqual(fetch(f"{self.url}/epg.xml?channels=0.1")[2], first[2])
+            self.assertEqual(guide_index.call_count, 1)
+
+            hdhomerun.write_xmltv(sample_epg_data(channels=3, slots=2), self.epg_file)
+            self.assertEqual(len(self.query("channels=0.1").findall("programme")), 2)
+            self.assertEqual(guide_index.call_count, 2)
+
+        status, headers, _ = fetch(f"{self.url}/epg.xml?channels=0.1", {"If-None-Match": first[1]["ETag"]})
+        self.assertEqual(status, 200)
+
+    def test_slices_are_cached_between_boundaries(self):
+        """Test that times between the same two programme boundaries share one cached slice, up to cache_bytes."""
+        with open(self.epg_file, "rb") as f:
+            content = f.read()
+        index = http_server.GuideIndex(content, http_server.CachedFile(self.epg_file, None, len(content), 0,
+                                                                          content, ""))
+
+        first = index.slice(1700000010, 1700003000, None)
+        self.assertIs(index.slice(1700001799, 1700003600, None), first)
+        self.assertIsNot(index.slice(1700001800, 1700003600, None), first)
+        self.assertEqual(index.slice(1600000000, 1800000000, None).content, index.slice(None, None, None).content)
+
+        index.cache_bytes = first.size
+        self.assertIsNot(index.slice(1700000000, None, None), index.slice(1700000000, None, None))
+        self.assertIs(index.slice(1700000010, 1700003000, None), index.slice(1700000010, 1700003000, None))
+
+    def test_slice_is_compressed_and_revalidated(self):
+        """Test that slices are served with the same negotiation and validators as the full guide."""
+        status, headers, body = fetch(f"{self.url}/epg.xml?channels=1.1", {"Accept-Encoding": "gzip"})
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        self.assertEqual(len(ET.fromstring(gzip.decompress(body)).findall("programme")), 48)
+
+        status, _, _ = fetch(f"{self.url}/epg.xml?channels=1.1",
+                             {"Accept-Encoding": "gzip", "If-None-Match": headers["ETag"]})
+        self.assertEqual(status, 304)
+
+
+class TestStreamedGuideSlices(TestGuideSlices):
+    """Run the slice tests with the guide streamed from disk instead of held in memory."""
+
+    sendfile_size = 0
+
+
+class TestOnAir(unittest.TestCase):
+    """Test the /now and /next JSON listings."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.epg_file = os.path.join(self.tmpdir.name, "epg.xml")
+        epg_data = sample_epg_data(channels=3, slots=4)
+        epg_data["programmes"][1].episode_title = "Pilot"
+        hdhomerun.write_xmltv(epg_data, self.epg_file)
+        self.stack = contextlib.ExitStack()
+        self.url = self.stack.enter_context(running_server(make_handler(self.epg_file)))
+
+    def tearDown(self):
+        self.stack.close()
+        self.tmpdir.cleanup()
+
+    def listing(self, path):
+        status, headers, body = fetch(f"{self.url}{path}")
+        self.assertEqual(status, 200, body)
+        self.assertEqual(headers["Content-Type"], "application/json")
+        return json.loads(body)
+
+    def test_now_and_next(self):
+        """Test that every channel lists the programme on air and the one after it."""
+        moment = 1700000000 + 2700
+
+        now = self.listing(f"/now?time={moment}")["now"]
+        self.assertEqual([(entry["channel"], entry["name"], entry["title"]) for entry in now],
+                         [(f"{number}.1", f"Channel {number}", "Show 1") for number in range(3)])
+        self.assertEqual(now[0], {"channel": "0.1", "name": "Channel 0", "title": "Show 1", "subtitle": "Pilot",
+                                  "start": 1700001800, "stop": 1700003600})
+        self.assertEqual([entry["title"] for entry in self.listing(f"/next?time={moment}")["next"]], ["Show 2"] * 3)
+
+    def test_channel_filter(self):
+        """Test that ?channel= limits the listing to the given channels."""
+        now = self.listing("/now?time=1700000000&channel=1.1")["now"]
+
+        self.assertEqual([(entry["channel"], entry["title"], entry["subtitle"]) for entry in now],
+                         [("1.1", "Show 0", None)])
+        self.assertEqual(self.listing("/now?time=1700000000&channel=9.9")["now"], [])
+
+    def test_outside_the_guide(self):
+        """Test the listings before the first programme and after the last one."""
+        self.assertEqual(self.listing("/now?time=1600000000")["now"], [])
+        self.assertEqual([entry["title"] for entry in self.listing("/next?time=1600000000")["next"]], ["Show 0"] * 3)
+        self.assertEqual(self.listing("/now?time=1800000000")["now"], [])
+        self.assertEqual(self.listing("/next?time=1800000000")["next"], [])
+
+    def test_current_time_and_max_age(self):
+        """Test that the listing defaults to the current time and may be cached until it changes."""
+        with patch.object(http_server.time, "time", return_value=1700001700.5):
+            status, headers, body = fetch(f"{self.url}/now")
+
+        self.assertEqual([entry["title"] for entry in json.loads(body)["now"]], ["Show 0"] * 3)
+        self.assertEqual(headers["Cache-Control"], "max-age=100")
+        self.assertEqual(fetch(f"{self.url}/now?time=1700000100", {"If-None-Match": headers["ETag"]})[0], 304)
+        self.assertEqual(fetch(f"{self.url}/now?time=1700001800", {"If-None-Match": headers["ETag"]})[0], 200)
+
+    def test_listing_is_cached_between_boundaries(self):
+        """Test that moments between the same two programme boundaries share one cached listing."""
+        with open(self.epg_file, "rb") as f:
+            content = f.read()
+        index = http_server.GuideIndex(content, http_server.CachedFile(self.epg_file, None, len(content), 0,
+                                                                          content, ""))
+
+        first = index.on_air("now", 1700000010, None)
+        self.assertIs(index.on_air("now", 1700001799, None)[0], first[0])
+        self.assertEqual(first[2], 1700001800)
+        self.assertIsNot(index.on_air("now", 1700001800, None)[0], first[0])
+
+    def test_invalid_time(self):
+        """Test that an unparseable time is rejected with 400."""
+        self.assertEqual(fetch(f"{self.url}/next?time=soon")[0], 400)
+
+
+class TestGuideRefresher(unittest.TestCase):
+    """Test regenerating the guide in the server process and swapping it in."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.epg_file = os.path.join(self.tmpdir.name, "epg.xml")
+        hdhomerun.write_xmltv(sample_epg_data(slots=2), self.epg_file)
+        self.handler = make_handler(self.epg_file)
+        self.stack = contextlib.ExitStack()
+        self.url = self.stack.enter_context(running_server(self.handler))
+
+    def tearDown(self):
+        self.stack.close()
+        self.tmpdir.cleanup()
+
+    def refresher(self, refresh, interval=3600):
+        return http_server.GuideRefresher(refresh, interval, self.handler.file_cache, [self.epg_file, None])
+
+    def test_new_guide_is_loaded_before_it_is_requested(self):
+        """Test that a refresh swaps the new guide into the cache so the next request is a cache hit."""
+        fetch(f"{self.url}/epg.xml")
+        data = sample_epg_data(slots=3)
+
+        self.assertTrue(self.refresher(lambda: hdhomerun.write_xmltv(data, self.epg_file)).run_once())
+        misses = self.handler.file_cache.stats.misses
+        self.assertIn(b"Show 2", fetch(f"{self.url}/epg.xml")[2])
+        self.assertEqual(self.handler.file_cache.stats.misses, misses)
+
+    def test_failed_refresh_keeps_previous_guide(self):
+        """Test that a generator failing with an error is logged and the previous guide still served."""
+        previous = fetch(f"{self.url}/epg.xml")[2]
+
+        def refresh():
+            raise hdhomerun.GuideError("No devices found")
+
+        refresher = self.refresher(refresh)
+        with self.assertLogs(http_server.logger, "ERROR"):
+            self.assertFalse(refresher.run_once())
+        self.assertIsInstance(refresher.last_error, hdhomerun.GuideError)
+        self.assertEqual(fetch(f"{self.url}/epg.xml")[2], previous)
+
+    def test_previous_version_is_served_while_loading(self):
+        """Test that requests during a reload are answered from the previous version instead of waiting."""
+        cache = self.handler.file_cache
+        previous = cache.get(self.epg_file)
+        hdhomerun.write_xmltv(sample_epg_data(slots=3), self.epg_file)
+
+        with cache._lock:
+            self.assertIs(cache.get(self.epg_file), previous)
+        self.assertIn(b"Show 2", cache.get(self.epg_file).content)
+
+    def test_first_refresh_waits_for_the_guide_to_age(self):
+        """Test that a fresh guide is not regenerated on start, and a missing one is generated at once."""
+        refreshed = threading.Event()
+        refresher = self.refresher(refreshed.set)
+        refresher.start()
+        self.addCleanup(refresher.stop)
+        self.assertFalse(refreshed.wait(0.2))
+
+        os.remove(self.epg_file)
+        refresher = self.refresher(refreshed.set)
+        refresher.start()
+        self.addCleanup(refresher.stop)
+        self.assertTrue(refreshed.wait(5))
+
+    def test_guide_generator_runs_the_pipeline_in_process(self):
+        """Test that each refresh runs the generator on the served EPG and M3U paths, without a render pool.
+
+        The configuration is parsed and logging set up once, not on every refresh.
+        """
+        m3u_file = os.path.join(self.tmpdir.name, "channels.m3u")
+        signature = inspect.signature(hdhomerun.generate_xmltv)
+        calls = []
+
+        def generate_xmltv(*args, **kwargs):
+            calls.append(signature.bind(*args, **kwargs).arguments)
+
+        with patch.object(hdhomerun, "generate_xmltv", side_effect=generate_xmltv), \
+                patch.object(hdhomerun, "build_config", wraps=hdhomerun.build_config) as build_config, \
+                patch.object(hdhomerun, "setup_logging") as setup_logging, \
+                patch.dict(os.environ, {"HDHOMERUN_HOST": "10.0.0.5", "EPG_WORKERS": "4"}):
+            generate = http_server.guide_generator(self.epg_file, m3u_file)
+            generate()
+            generate()
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(build_config.call_count, 1)
+        setup_logging.assert_not_called()
+        self.assertEqual((calls[0]["host"], calls[0]["filename"], calls[0]["m3u_file"]),
+                         ("10.0.0.5", self.epg_file, m3u_file))
+        self.assertEqual(calls[0]["workers"], 1)
+
+
+class TestMetrics(unittest.TestCase):
+    """Test the Prometheus /metrics endpoint."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.epg_file = os.path.join(self.tmpdir.name, "epg.xml")
+        hdhomerun.write_xmltv(sample_epg_data(slots=4), self.epg_file)
+        self.stack = contextlib.ExitStack()
+        self.url = self.stack.enter_context(running_server(
+            make_handler(self.epg_file, metrics=http_server.ServerMetrics())))
+
+    def tearDown(self):
+        self.stack.close()
+        self.tmpdir.cleanup()
+
+    def samples(self):
+        """Scrape /metrics and return {sample name with labels: value}."""
+        status, headers, body = fetch(f"{self.url}/metrics")
+        self.assertEqual(status, 200)
+        self.assertTrue(headers["Content-Type"].startswith("text/plain; version=0.0.4"))
+        return {line.rsplit(" ", 1)[0]: float(line.rsplit(" ", 1)[1])
+                for line in body.decode().splitlines() if line and not line.startswith("#")}
+
+    def test_requests_latency_and_bytes(self):
+        """Test that requests are counted by route and status, timed and their body bytes added up."""
+        for _ in range(3):
+            fetch(f"{self.url}/epg.xml")
+        fetch(f"{self.url}/epg.xml", method="HEAD")
+        fetch(f"{self.url}/missing/1")
+        fetch(f"{self.url}/missing/2")
+
+        samples = self.samples()
+        size = os.path.getsize(self.epg_file)
+        self.assertEqual(samples['hdhomerun_epg_http_requests_total{route="/epg.xml",method="GET",status="200"}'], 3)
+        self.assertEqual(samples['hdhomerun_epg_http_requests_total{route="/epg.xml",method="HEAD",status="200"}'], 1)
+        self.assertEqual(samples['hdhomerun_epg_http_requests_total{route="other",method="GET",status="404"}'], 2)
+        self.assertEqual(samples['hdhomerun_epg_http_response_bytes_total{route="/epg.xml"}'], 3 * size)
+        self.assertEqual(samples['hdhomerun_epg_http_request_duration_seconds_count{route="/epg.xml"}'], 4)
+        self.assertEqual(samples['hdhomerun_epg_http_request_duration_seconds_bucket{route="/epg.xml",le="+Inf"}'], 4)
+        self.assertLessEqual(samples['hdhomerun_epg_http_request_duration_seconds_bucket{route="/epg.xml",le="0.001"}'],
+                             samples['hdhomerun_epg_http_request_duration_seconds_bucket{route="/epg.xml",le="10.0"}'])
+
+    def test_cache_hit_ratios(self):
+        """Test that file cache and guide index lookups are counted and their hit ratios reported."""
+        for _ in range(4):
+            fetch(f"{self.url}/epg.xml")
+        fetch(f"{self.url}/now?time=1700000000")
+        fetch(f"{self.url}/now?time=1700000100")
+
+        samples = self.samples()
+        self.assertEqual(samples['hdhomerun_epg_cache_lookups_total{cache="file",result="miss"}'], 1)
+        self.assertEqual(samples['hdhomerun_epg_cache_lookups_total{cache="file",result="hit"}'], 5)
+        self.assertAlmostEqual(samples['hdhomerun_epg_cache_hit_ratio{cache="file"}'], 5 / 6, places=5)
+        self.assertEqual(samples['hdhomerun_epg_cache_lookups_total{cache="guide_index",result="miss"}'], 1)
+        self.assertEqual(samples['hdhomerun_epg_cache_hit_ratio{cache="guide_index"}'], 0.5)
+
+    def test_generator_metrics_are_included(self):
+        """Test that the metrics the generator wrote next to the guide follow the server's own."""
+        stats = hdhomerun.RunStats()
+        stats.add_time("fetch", 2.5)
+        stats.count_programmes(12, 4)
+        with open(hdhomerun.metrics_path(self.epg_file), "w", encoding="utf-8") as f:
+            f.write(stats.to_prometheus(sample_epg_data(slots=4)))
+
+        samples = self.samples()
+        self.assertEqual(samples['hdhomerun_epg_run_stage_duration_seconds{stage="fetch"}'], 2.5)
+        self.assertEqual(samples['hdhomerun_epg_run_programmes{state="deduped"}'], 4)
+        self.assertEqual(samples['hdhomerun_epg_run_programmes{state="written"}'], 8)
+        self.assertIn('hdhomerun_epg_cache_hit_ratio{cache="file"}', samples)
+
+
+@pytest.mark.slow
+class TestOnAirLatency(unittest.TestCase):
+    """Measure /now and /next lookups on a 100 channel x 14 day guide."""
+
+    def test_lookup_latency(self):
+        """Test that uncached lookups for one channel and for every channel beat scanning each schedule."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            epg_file = os.path.join(tmpdir, "epg.xml")
+            hdhomerun.write_xmltv(sample_epg_data(channels=100, slots=14 * 48), epg_file)
+            with open(epg_file, "rb") as f:
+                content = f.read()
+            began = time.perf_counter()
+            index = http_server.GuideIndex(content, http_server.CachedFile(epg_file, None, len(content), 0,
+                                                                              content, ""))
+            index_seconds = time.perf_counter() - began
+
+            with running_server(make_handler(epg_file)) as url:
+                fetch(f"{url}/now")
+                began = time.perf_counter()
+                for _ in range(100):
+                    fetch(f"{url}/now?channel=5.1")
+                request_seconds = (time.perf_counter() - began) / 100
+
+        def scan(moment, channels):
+            # The same listing found by walking each channel's programmes in order
+            listing = []
+            for channel in index.channel_order:
+                schedule = index.schedules.get(channel)
+                if schedule is None or (channels is not None and channel not in channels):
+                    continue
+                for position, (start, stop) in enumerate(zip(schedule.starts, schedule.stops)):
+                    if start <= moment < stop:
+                        listing.append({'channel': channel, 'name': index.channel_names.get(channel),
+                                        **schedule.describe(position)})
+                        break
+            content = json.dumps({"now": listing}).encode()
+            return content, f'"{hashlib.sha256(content).hexdigest()}"'
+
+        # Each moment falls in a different half hour, so none is answered from the listing cache
+        moments = random.Random(1).sample(range(1700000000, 1700000000 + 14 * 86400, 1800), 500)
+        timings, baselines = {}, {}
+        for label, channels in (("one channel", frozenset(["5.1"])), ("all channels", None)):
+            samples, scanned = [], []
+            for moment in moments:
+                began = time.perf_counter()
+                listing = index.on_air("now", moment + 60, channels)
+                samples.append(time.perf_counter() - began)
+                began = time.perf_counter()
+                self.assertEqual(scan(moment + 60, channels), listing[:2])
+                scanned.append(time.perf_counter() - began)
+            timings[label] = statistics.median(samples)
+            baselines[label] = statistics.median(scanned)
+        cached = []
+        for _ in range(500):
+            began = time.perf_counter()
+            index.on_air("now", moments[0] + 60, None)
+            cached.append(time.perf_counter() - began)
+
+        print(f"✓ 100 x 14 day guide indexed in {index_seconds * 1000:.0f} ms; median /now lookup: "
+              + ", ".join(f"{label} {seconds * 1e6:.0f} µs (scan {baselines[label] * 1e6:.0f} µs)"
+                          for label, seconds in timings.items())
+              + f", cached {statistics.median(cached) * 1e6:.1f} µs; HTTP request {request_seconds * 1000:.2f} ms")
+        # Both build and hash the same JSON, which dominates a single channel's listing
+        self.assertLess(timings["one channel"], baselines["one channel"])
+        self.assertLess(timings["all channels"], baselines["all channels"] / 3)
+
+
+@pytest.mark.slow
+class TestGuideSliceLatency(unittest.TestCase):
+    """Compare serving a guide slice from the index with reparsing the guide for each request."""
+
+    def test_slice_latency(self):
+        """Test a 6 hour, 10 channel slice of a 100 channel x 14 day guide."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            epg_file = os.path.join(tmpdir, "epg.xml")
+            hdhomerun.write_xmltv(sample_epg_data(channels=100, slots=14 * 48), epg_file)
+            start = 1700000000 + 3 * 86400
+            channels = ",".join(f"{number}.1" for number in range(0, 100, 10))
+            query = f"start={start}&end={start + 6 * 3600}&channels={channels}"
+
+            began = time.perf_counter()
+            root = ET.parse(epg_file).getroot()
+            wanted = set(channels.split(","))
+            reparsed = [programme for programme in root.iter("programme") if programme.get("channel") in wanted]
+            reparse_seconds = time.perf_counter() - began
+            self.assertTrue(reparsed)
+
+            with running_server(make_handler(epg_file)) as url:
+                began = time.perf_counter()
+                fetch(f"{url}/epg.xml?{query}")
+                first_seconds = time.perf_counter() - began
+                timings = {}
+                for label, queries in (("cached", [query] * 20),
+                                       ("new", [f"{query}&end={start + hours * 3600}" for hours in range(1, 21)])):
+                    began = time.perf_counter()
+                    for each in queries:
+                        fetch(f"{url}/epg.xml?{each}")
+                    timings[label] = (time.perf_counter() - began) / len(queries)
+
+        print(f"✓ 6 hour x 10 channel slice of a 100 x 14 day guide: reparsing {reparse_seconds * 1000:.0f} ms, "
+              f"first request with indexing {first_seconds * 1000:.0f} ms, new query {timings['new'] * 1000:.1f} ms, "
+              f"cached query {timings['cached'] * 1000:.1f} ms")
+        self.assertLess(timings["new"], reparse_seconds / 10)
+
+
+@pytest.mark.slow
+class TestSendfileMemory(unittest.TestCase):
+    """Compare server memory when a large guide is held in memory and when it is streamed."""
+
+    def test_streaming_does_not_hold_the_guide(self):
+        """Test 4 clients each downloading a 64 MiB guide from both modes."""
+        clients = 4
+        with tempfile.TemporaryDirectory() as tmpdir:
+            epg_file = os.path.join(tmpdir, "epg.xml")
+            with open(epg_file, "wb") as f:
+                f.write(os.urandom(32 * 2**20).hex().encode())
+
+            results = {}
+            for mode, sendfile_size in (("in memory", None), ("sendfile", 0)):
+                handler = make_handler(epg_file, file_cache=http_server.FileCache(sendfile_size))
+                with running_server(handler) as url:
+                    def client(_):
+                        with urllib.request.urlopen(f"{url}/epg.xml", timeout=60) as response:
+                            return sum(len(block) for block in iter(lambda: response.read(2**16), b""))
+
+                    tracemalloc.start()
+                    began = time.perf_counter()
+                    with ThreadPoolExecutor(clients) as executor:
+                        sizes = list(executor.map(client, range(clients)))
+                    seconds = time.perf_counter() - began
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                self.assertEqual(sizes, [64 * 2**20] * clients)
+                results[mode] = (peak, seconds)
+
+        print("✓ 4 clients x 64 MiB guide: " + ", ".join(
+            f"{mode} peak {peak / 2**20:.1f} MiB in {seconds:.2f} s" for mode, (peak, seconds) in results.items()))
+        self.assertLess(results["sendfile"][0], results["in memory"][0] / 10)
+
+    def test_indexing_a_streamed_guide_does_not_copy_it(self):
+        """Test that the index of a streamed 100 channel x 14 day guide keeps offsets, not element bytes."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            epg_file = os.path.join(tmpdir, "epg.xml")
+            hdhomerun.write_xmltv(sample_epg_data(channels=100, slots=14 * 48), epg_file)
+            size = os.path.getsize(epg_file)
+            source = http_server.CachedFile(epg_file, None, size, 0, None, "")
+
+            peaks, slices = {}, {}
+            for mode in ("read", "mapped"):
+                with open(epg_file, "rb") as f:
+                    tracemalloc.start()
+                    content = f.read() if mode == "read" else mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    index = http_server.GuideIndex(content, source)
+                    peaks[mode] = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                slices[mode] = index.slice(None, None, None).content
+                del content, index
+
+        print(f"✓ indexing a {size / 2**20:.1f} MiB guide: read peak {peaks['read'] / 2**20:.1f} MiB, "
+              f"mapped peak {peaks['mapped'] / 2**20:.1f} MiB")
+        self.assertEqual(slices["mapped"], slices["read"])
+        self.assertLess(peaks["mapped"], peaks["read"] - size * 0.9)
+
+
+@pytest.mark.slow
+class TestCompressedTransfer(unittest.TestCase):
+    """Measure the bytes transferred and latency of compressed and uncompressed responses."""
+
+    def test_transfer_sizes(self):
+        """Test serving a 100 channel x 7 day guide and its playlist with and without gzip."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            epg_file = os.path.join(tmpdir, "epg.xml")
+            m3u_file = os.path.join(tmpdir, "channels.m3u")
+            hdhomerun.write_xmltv(sample_epg_data(channels=100, slots=7 * 48), epg_file)
+            with contextlib.redirect_stdout(io.StringIO()):
+                generate_m3u_from_xmltv.generate_m3u(generate_m3u_from_xmltv.extract_channel_info(epg_file),
+                                                     "http://hdhomerun:5004", m3u_file)
+
+            with running_server(make_handler(epg_file, m3u_file)) as url:
+                for path in ("/epg.xml", "/channels.m3u"):
+                    results = {}
+                    for accept_encoding in ("identity", "gzip"):
+                        fetch(f"{url}{path}", {"Accept-Encoding": accept_encoding})
+                        began = time.perf_counter()
+                        for _ in range(10):
+                            body = fetch(f"{url}{path}", {"Accept-Encoding": accept_encoding})[2]
+                        results[accept_encoding] = (len(body), (time.perf_counter() - began) / 10)
+                    print(f"✓ {path}: identity {results['identity'][0]} bytes in "
+                          f"{results['identity'][1] * 1000:.1f} ms, gzip {results['gzip'][0]} bytes in "
+                          f"{results['gzip'][1] * 1000:.1f} ms")
+                    self.assertLess(results["gzip"][0], results["identity"][0] / 4)
+
+
+@pytest.mark.slow
+class TestServerThroughput(unittest.TestCase):
+    """Compare requests per second of the old and new servers under concurrent clients."""
+
+    class UncachedFiles:
+        """Read the file from disk on every request, as the single threaded server used to."""
+
+        def open(self, path):
+            with open(path, "rb") as f:
+                stat = os.fstat(f.fileno())
+                content = f.read()
+            return http_server.CachedFile(path, None, stat.st_size, stat.st_mtime, content, ""), None
+
+    class SingleThreadedServer(HTTPServer):
+        """The previous server, with the same listen backlog so only threading differs."""
+
+        request_queue_size = http_server.EPGHTTPServer.request_queue_size
+
+    def measure(self, url, clients, requests_per_client):
+        def client(_):
+            for _ in range(requests_per_client):
+                with urllib.request.urlopen(f"{url}/epg.xml", timeout=60) as response:
+                    # Read at most 64 MiB/s, like a client on a gigabit network
+                    while response.read(2**16):
+                        time.sleep(0.001)
+
+        began = time.perf_counter()
+        with ThreadPoolExecutor(clients) as executor:
+            list(executor.map(client, range(clients)))
+        return clients * requests_per_client / (time.perf_counter() - began)
+
+    def in_flight(self, url, clients):
+        """Return, per client, whether every client had its response started at the same time."""
+        started = threading.Barrier(clients, timeout=5)
+
+        def client(_):
+            with urllib.request.urlopen(f"{url}/epg.xml", timeout=60) as response:
+                response.read(1)
+                try:
+                    started.wait()
+                    overlapped = True
+                except threading.BrokenBarrierError:
+                    overlapped = False
+                while response.read(2**16):
+                    pass
+            return overlapped
+
+        with ThreadPoolExecutor(clients) as executor:
+            return list(executor.map(client, range(clients)))
+
+    def test_threaded_cached_server_handles_more_requests(self):
+        """Test 8 concurrent clients fetching a 32 MiB guide, larger than the socket buffers, from both servers."""
+        clients, requests_per_client = 8, 2
+        with tempfile.TemporaryDirectory() as tmpdir:
+            epg_file = os.path.join(tmpdir, "epg.xml")
+            with open(epg_file, "wb") as f:
+                f.write(os.urandom(16 * 2**20).hex().encode())
+
+            with running_server(make_handler(epg_file, file_cache=self.UncachedFiles()),
+                                self.SingleThreadedServer) as url:
+                single_in_flight = self.in_flight(url, clients)
+                single = self.measure(url, clients, requests_per_client)
+            with running_server(make_handler(epg_file)) as url:
+                threaded_in_flight = self.in_flight(url, clients)
+                threaded = self.measure(url, clients, requests_per_client)
+
+        print(f"✓ {clients} clients x {requests_per_client} requests for a 32 MiB guide: "
+              f"single threaded {single:.1f} req/s, threaded and cached {threaded:.1f} req/s")
+        # Only the threaded server has every response in flight at once; the single threaded one
+        # is still blocked writing the first response when the barrier times out
+        self.assertEqual(threaded_in_flight, [True] * clients)
+        self.assertNotIn(True, single_in_flight)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
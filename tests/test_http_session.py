@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Test script to verify connection reuse and gzip transfer in HttpSession.
+"""
+
+import gzip
+import json
+import os
+import threading
+import unittest
+import urllib.error
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+import HDHomeRunEPG_To_XmlTv as hdhomerun
+
+PAYLOAD = json.dumps([{"GuideNumber": str(number), "Guide": []} for number in range(200)]).encode()
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    """Serve a JSON payload over HTTP/1.1, gzip encoded when the client accepts it."""
+
+    protocol_version = "HTTP/1.1"
+    connections = set()
+    paths = []
+
+    def do_GET(self):
+        KeepAliveHandler.connections.add(self.client_address)
+        KeepAliveHandler.paths.append(self.path)
+        if self.path.startswith("/missing"):
+            body = b"Bad Request"
+            self.send_response(400)
+        elif self.path.startswith("/moved"):
+            body = b"Moved"
+            self.send_response(302)
+            self.send_header("Location", "/guide")
+        elif self.path.startswith("/empty"):
+            body = b""
+            self.send_response(204)
+        else:
+            body = PAYLOAD
+            self.send_response(200)
+            if "gzip" in self.headers.get("Accept-Encoding", "") and not self.path.startswith("/plain"):
+                body = gzip.compress(body)
+                self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.path.startswith("/drop"):
+            # Close the connection without telling the client, like an idle keep-alive timeout
+            self.close_connection = True
+
+    def log_message(self, msg_format, *args):
+        pass
+
+
+class TestHttpSession(unittest.TestCase):
+    """Test the pooled keep-alive HTTP session."""
+
+    def setUp(self):
+        """Start a local HTTP/1.1 server."""
+        KeepAliveHandler.connections = set()
+        KeepAliveHandler.paths = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.session = hdhomerun.HttpSession(timeout=5)
+
+    def tearDown(self):
+        """Stop the server and close pooled connections."""
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_is_reused(self):
+        """Test that serial requests to one host share a single connection."""
+        for start in range(5):
+            self.assertEqual(self.session.get_json(f"{self.base_url}/guide?Start={start}"), json.loads(PAYLOAD))
+
+        self.assertEqual(self.session.requests, 5)
+        self.assertEqual(self.session.connections, 1)
+        self.assertEqual(len(KeepAliveHandler.connections), 1)
+
+    def test_gzip_transfer_is_counted(self):
+        """Test that gzip responses are decoded and wire vs decoded bytes are tracked."""
+        body = self.session.get(f"{self.base_url}/guide")
+
+        self.assertEqual(body, PAYLOAD)
+        self.assertEqual(self.session.bytes_decoded, len(PAYLOAD))
+        self.assertEqual(self.session.bytes_on_wire, len(gzip.compress(PAYLOAD)))
+        self.assertLess(self.session.bytes_on_wire, self.session.bytes_decoded)
+
+    def test_http_errors_are_raised(self):
+        """Test that error statuses raise HTTPError and keep the connection usable."""
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            self.session.get(f"{self.base_url}/missing")
+
+        self.assertEqual(context.exception.code, 400)
+        self.assertEqual(self.session.get(f"{self.base_url}/guide"), PAYLOAD)
+        self.assertEqual(self.session.connections, 1)
+
+    def test_reconnects_after_server_closes_idle_connection(self):
+        """Test that a keep-alive connection dropped by the server is transparently replaced."""
+        self.session.get(f"{self.base_url}/drop")
+
+        self.assertEqual(self.session.get(f"{self.base_url}/guide"), PAYLOAD)
+        self.assertEqual(self.session.connections, 2)
+
+    def test_streamed_body_is_decoded_and_connection_reused(self):
+        """Test that open streams the gunzipped body and returns the connection once it is read."""
+        for _ in range(2):
+            with self.session.open(f"{self.base_url}/guide") as response:
+                self.assertEqual(list(hdhomerun.iter_json_array(response, chunk_size=512)), json.loads(PAYLOAD))
+
+        self.assertEqual(self.session.requests, 2)
+        self.assertEqual(self.session.connections, 1)
+        self.assertEqual(self.session.bytes_decoded, 2 * len(PAYLOAD))
+        self.assertEqual(self.session.bytes_on_wire, 2 * len(gzip.compress(PAYLOAD)))
+
+    def test_partly_read_stream_is_not_reused(self):
+        """Test that a connection with unread body left is closed rather than returned to the pool."""
+        with self.session.open(f"{self.base_url}/plain") as response:
+            response.read(10)
+
+        self.assertEqual(self.session.get(f"{self.base_url}/guide"), PAYLOAD)
+        self.assertEqual(self.session.connections, 2)
+
+    def test_streamed_http_errors_are_raised(self):
+        """Test that open raises HTTPError for error statuses."""
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            with self.session.open(f"{self.base_url}/missing"):
+                pass
+
+        self.assertEqual(context.exception.code, 400)
+
+    def test_redirects_are_followed(self):
+        """Test that a redirect is followed to its Location, for buffered and streamed requests."""
+        self.assertEqual(self.session.get_json(f"{self.base_url}/moved"), json.loads(PAYLOAD))
+        with self.session.open(f"{self.base_url}/moved") as response:
+            self.assertEqual(response.read(), PAYLOAD)
+
+        self.assertEqual(KeepAliveHandler.paths, ["/moved", "/guide"] * 2)
+
+    def test_non_200_responses_are_not_decoded(self):
+        """Test that a success status other than 200 raises HTTPError instead of reaching the JSON decoder."""
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            self.session.get_json(f"{self.base_url}/empty")
+
+        self.assertEqual(context.exception.code, 204)
+
+    def test_http_proxy_is_used(self):
+        """Test that plain HTTP requests go to the proxy from the environment with the absolute URL."""
+        with patch.dict(os.environ, {"http_proxy": self.base_url, "no_proxy": ""}):
+            session = hdhomerun.HttpSession(timeout=5)
+        try:
+            self.assertEqual(session.get("http://hdhomerun.invalid/guide"), PAYLOAD)
+        finally:
+            session.close()
+
+        self.assertEqual(KeepAliveHandler.paths, ["http://hdhomerun.invalid/guide"])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Test script to verify incremental guide refresh from persisted state.
+"""
+
+import datetime
+import os
+import tempfile
+import unittest
+
+import HDHomeRunEPG_To_XmlTv as hdhomerun
+from tests.helpers import FakeGuideApi, lineup, serving
+
+NOW = datetime.datetime(2024, 1, 1, 0, 10, tzinfo=datetime.timezone.utc)
+HOURS = 3
+DAYS = 3
+REFRESH_HOURS = 6
+
+
+def guide_api(version: int = 1) -> FakeGuideApi:
+    """Return an API whose titles carry a version, to detect stale data."""
+    return FakeGuideApi(hours=HOURS + 1, version=version)
+
+
+class TestIncrementalRefresh(unittest.TestCase):
+    """Test fetch_incremental_epg_data with persisted guide state."""
+
+    def setUp(self):
+        """Set up test fixtures."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.state_file = os.path.join(self.tmpdir.name, "state", "guide.json")
+        self.channels = lineup()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def refresh(self, api: FakeGuideApi, elapsed_hours: float = 0, channels=None) -> dict:
+        """Run one incremental refresh ``elapsed_hours`` after NOW and persist the result."""
+        state = hdhomerun.load_guide_state(self.state_file)
+        with serving(api):
+            epg_data = hdhomerun.fetch_incremental_epg_data("test_auth_token", channels or self.channels, DAYS, HOURS,
+                                                            state, REFRESH_HOURS,
+                                                            now=NOW + datetime.timedelta(hours=elapsed_hours))
+        hdhomerun.save_guide_state(self.state_file, epg_data)
+        return epg_data
+
+    def assert_contiguous(self, epg_data: dict, now: datetime.datetime) -> None:
+        """Assert every channel is covered without gaps or overlaps from now to the end of the guide."""
+        for guide_number in ("1", "2"):
+            programmes = [programme for programme in epg_data["programmes"] if programme.guide_number == guide_number]
+            self.assertEqual(programmes, sorted(programmes, key=lambda programme: programme.start_time))
+            self.assertLessEqual(programmes[0].start_time, now.timestamp())
+            self.assertGreaterEqual(programmes[-1].end_time, (now + datetime.timedelta(days=DAYS)).timestamp())
+            for previous, current in zip(programmes, programmes[1:]):
+                self.assertEqual(previous.end_time, current.start_time)
+
+    def test_first_run_fetches_full_guide(self):
+        """Test that without previous state the full guide is fetched and saved."""
+        api = guide_api()
+        epg_data = self.refresh(api)
+
+        self.assertEqual(len(api.starts), DAYS * 24 // HOURS)
+        self.assert_contiguous(epg_data, NOW)
+        self.assertEqual(hdhomerun.load_guide_state(self.state_file)["programmes"], epg_data["programmes"])
+
+    def test_rerun_only_fetches_refresh_band_and_beyond_horizon(self):
+        """Test that a rerun skips windows already covered by the previous guide."""
+        self.refresh(guide_api())
+        api = guide_api()
+        now = NOW + datetime.timedelta(hours=4)
+        epg_data = self.refresh(api, elapsed_hours=4)
+
+        first_horizon = (NOW + datetime.timedelta(days=DAYS)).timestamp()
+        band_end = (now + datetime.timedelta(hours=REFRESH_HOURS)).timestamp()
+        self.assertLess(len(api.starts), DAYS * 24 // HOURS / 2)
+        self.assertTrue(all(start < band_end or start >= first_horizon for start in api.starts))
+        self.assert_contiguous(epg_data, now)
+        self.assertTrue(all(programme.end_time > now.timestamp() for programme in epg_data["programmes"]),
+                        "Expired programmes should be dropped")
+
+    def test_refresh_band_replaces_changed_listings(self):
+        """Test that refetched listings replace the previous ones without overlapping."""
+        self.refresh(guide_api(version=1))
+        now = NOW + datetime.timedelta(hours=4)
+        epg_data = self.refresh(guide_api(version=2), elapsed_hours=4)
+
+        band_end = (now + datetime.timedelta(hours=REFRESH_HOURS)).timestamp()
+        for programme in epg_data["programmes"]:
+            if programme.start_time < band_end:
+                self.assertTrue(programme.title.endswith("v2"), programme)
+        self.assertTrue(any(programme.title.endswith("v1") for programme in epg_data["programmes"]))
+        self.assert_contiguous(epg_data, now)
+
+    def test_removed_channels_are_dropped(self):
+        """Test that channels no longer in the lineup are removed from the merged guide."""
+        self.refresh(guide_api())
+        epg_data = self.refresh(guide_api(), elapsed_hours=4, channels=self.channels[:1])
+
+        self.assertEqual([channel.guide_number for channel in epg_data["channels"]], ["1"])
+        self.assertTrue(all(programme.guide_number == "1" for programme in epg_data["programmes"]))
+
+    def test_unreadable_state_is_ignored(self):
+        """Test that a corrupt state file falls back to a full fetch."""
+        os.makedirs(os.path.dirname(self.state_file))
+        with open(self.state_file, "w", encoding="utf-8") as f:
+            f.write("{not json")
+
+        self.assertIsNone(hdhomerun.load_guide_state(self.state_file))
+        api = guide_api()
+        self.refresh(api)
+        self.assertEqual(len(api.starts), DAYS * 24 // HOURS)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Test script to verify the M3U playlist written by generate_xmltv from the fetched channel list.
+"""
+
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import generate_m3u_from_xmltv
+import HDHomeRunEPG_To_XmlTv as hdhomerun
+from tests.helpers import sample_epg_data as sample_guide
+
+
+def sample_epg_data() -> dict:
+    """Build a guide whose channels cover missing names and icons."""
+    return sample_guide([hdhomerun.Channel("2.1", "Channel 2", "http://img/2.png"), hdhomerun.Channel("5.1", None),
+                         hdhomerun.Channel("7.1", ""), hdhomerun.Channel("9.1", "News & Weather <HD>")],
+                        slots=1, title="News")
+
+
+class TestM3uOutput(unittest.TestCase):
+    """Test writing the playlist in the same run as the XMLTV."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, "epg.xml")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def read(self, filename: str) -> bytes:
+        with open(filename, "rb") as f:
+            return f.read()
+
+    def test_matches_playlist_generated_from_xmltv(self):
+        """Test that the in-memory channels give exactly the playlist generate_m3u_from_xmltv.py writes."""
+        epg_data = sample_epg_data()
+        hdhomerun.write_xmltv(epg_data, self.filename)
+        from_xmltv = os.path.join(self.tmpdir.name, "from_xmltv.m3u")
+        from_channels = os.path.join(self.tmpdir.name, "from_channels.m3u")
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            generate_m3u_from_xmltv.generate_m3u(generate_m3u_from_xmltv.extract_channel_info(self.filename),
+                                                 "http://hdhomerun:5004", from_xmltv)
+            generate_m3u_from_xmltv.generate_m3u(hdhomerun.m3u_channels(epg_data["channels"]),
+                                                 "http://hdhomerun:5004", from_channels)
+
+        self.assertEqual(self.read(from_channels), self.read(from_xmltv))
+        self.assertEqual(self.read(from_channels).count(b"#EXTINF"), 3)
+
+    @patch('HDHomeRunEPG_To_XmlTv.fetch_epg_data')
+    @patch('HDHomeRunEPG_To_XmlTv.fetch_channels', return_value=[{"GuideNumber": "2.1"}])
+    @patch('HDHomeRunEPG_To_XmlTv.discover_device_auth', return_value="auth")
+    def test_generate_writes_playlist(self, mock_discover, mock_fetch_channels, mock_fetch_epg_data):
+        """Test that generate_xmltv writes the playlist, compressed too with gzip, with device stream URLs."""
+        mock_fetch_epg_data.return_value = sample_epg_data()
+        m3u_file = os.path.join(self.tmpdir.name, "channels.m3u")
+
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            hdhomerun.generate_xmltv("10.0.0.5", 1, 3, self.filename, gzip_output=True, m3u_file=m3u_file)
+
+        playlist = self.read(m3u_file).decode()
+        self.assertTrue(playlist.startswith("#EXTM3U\n"))
+        self.assertIn('tvg-logo="http://img/2.png"', playlist)
+        self.assertIn("http://10.0.0.5:5004/auto/v9.1\n", playlist)
+        self.assertTrue(os.path.exists(f"{m3u_file}.gz"))
+        self.assertEqual(stdout.getvalue(), "")
+
+    @patch('HDHomeRunEPG_To_XmlTv.fetch_epg_data')
+    @patch('HDHomeRunEPG_To_XmlTv.fetch_channels', return_value=[{"GuideNumber": "2.1"}])
+    @patch('HDHomeRunEPG_To_XmlTv.discover_device_auth', return_value="auth")
+    def test_playlist_error_keeps_state_and_metrics(self, mock_discover, mock_fetch_channels, mock_fetch_epg_data):
+        """Test that a playlist that cannot be written fails the run after the guide state and metrics are saved."""
+        mock_fetch_epg_data.return_value = sample_epg_data()
+        state_file = os.path.join(self.tmpdir.name, "state.json")
+        m3u_file = os.path.join(self.tmpdir.name, "missing", "channels.m3u")
+
+        with self.assertLogs("HDHomeRunEPG_To_XmlTv", "ERROR"), self.assertRaises(hdhomerun.GuideError):
+            hdhomerun.generate_xmltv("10.0.0.5", 1, 3, self.filename, state_file=state_file, m3u_file=m3u_file)
+
+        self.assertTrue(os.path.exists(state_file))
+        self.assertTrue(os.path.exists(hdhomerun.metrics_path(self.filename)))
+
+    @patch('HDHomeRunEPG_To_XmlTv.setup_logging', return_value=hdhomerun.logger)
+    @patch('HDHomeRunEPG_To_XmlTv.fetch_epg_data')
+    @patch('HDHomeRunEPG_To_XmlTv.fetch_channels', return_value=[{"GuideNumber": "2.1"}])
+    @patch('HDHomeRunEPG_To_XmlTv.discover_device_auth', return_value="auth")
+    def test_command_line_exits_on_playlist_error(self, mock_discover, mock_fetch_channels, mock_fetch_epg_data,
+                                                  mock_setup_logging):
+        """Test that the command line turns a failed run into exit status 1."""
+        mock_fetch_epg_data.return_value = sample_epg_data()
+        m3u_file = os.path.join(self.tmpdir.name, "missing", "channels.m3u")
+
+        with self.assertLogs("HDHomeRunEPG_To_XmlTv", "ERROR"), self.assertRaises(SystemExit) as raised:
+            hdhomerun.main(["--filename", self.filename, "--m3u-file", m3u_file])
+
+        self.assertEqual(raised.exception.code, 1)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
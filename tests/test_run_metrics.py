@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Test script to verify the stage timings and counters the generator records for /metrics.
+"""
+
+import io
+import json
+import os
+import tempfile
+import unittest
+import urllib.error
+from unittest.mock import patch
+
+import HDHomeRunEPG_To_XmlTv as hdhomerun
+
+START = 1700000000
+
+
+def guide_window(*titles):
+    """Build a guide.php response of consecutive half-hour programmes on one channel."""
+    return io.BytesIO(json.dumps([{
+        "GuideNumber": "2.1",
+        "Guide": [{"Title": title, "StartTime": START + index * 1800, "EndTime": START + (index + 1) * 1800}
+                  for index, title in enumerate(titles)],
+    }]).encode())
+
+
+def guide_end():
+    return urllib.error.HTTPError("https://api.hdhomerun.com/api/guide.php", 400, "Bad Request", {}, None)
+
+
+class TestRunMetrics(unittest.TestCase):
+    """Test the run stats collected while fetching and written next to the guide."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, "epg.xml")
+        self.channels = [{"GuideNumber": "2.1", "GuideName": "Channel 2"}]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    @patch('HDHomeRunEPG_To_XmlTv.HttpSession.open')
+    def test_fetch_counts_programmes_and_cutoff(self, mock_open):
+        """Test that overlapping windows count as ingested and deduped, and the first 400 is the cutoff."""
+        mock_open.side_effect = [guide_window("News", "Sport"), guide_window("News", "Sport", "Film"), guide_end()]
+        stats = hdhomerun.RunStats()
+        start_date = hdhomerun.datetime.datetime.fromtimestamp(START, tz=hdhomerun.pytz.UTC)
+
+        epg_data = hdhomerun.fetch_epg_data("auth", self.channels, days=1, hours=8, start_date=start_date,
+                                            stats=stats)
+
+        self.assertEqual(len(epg_data["programmes"]), 3)
+        self.assertEqual((stats.programmes_ingested, stats.programmes_deduped), (5, 2))
+        self.assertEqual(stats.guide_cutoff, START + 16 * 3600)
+        self.assertIn("transform", stats.stage_seconds)
+
+    @patch('HDHomeRunEPG_To_XmlTv.HttpSession.open')
+    @patch('HDHomeRunEPG_To_XmlTv.fetch_channels')
+    @patch('HDHomeRunEPG_To_XmlTv.discover_device_auth', return_value="auth")
+    def test_generate_writes_metrics_sidecar(self, mock_discover, mock_fetch_channels, mock_open):
+        """Test that a run writes every stage and counter to the metrics sidecar in Prometheus format."""
+        mock_fetch_channels.return_value = self.channels
+        mock_open.side_effect = [guide_window("News", "Sport"), guide_end()]
+
+        hdhomerun.generate_xmltv("hdhomerun.local", 1, 12, self.filename)
+
+        with open(hdhomerun.metrics_path(self.filename), encoding="utf-8") as f:
+            metrics = f.read()
+        samples = {line.rsplit(" ", 1)[0]: float(line.rsplit(" ", 1)[1])
+                   for line in metrics.splitlines() if not line.startswith("#")}
+        for stage in ("discover", "lineup", "fetch", "transform", "write"):
+            self.assertIn(f'hdhomerun_epg_run_stage_duration_seconds{{stage="{stage}"}}', samples)
+        self.assertIn("# TYPE hdhomerun_epg_run_programmes gauge", metrics)
+        self.assertEqual(samples['hdhomerun_epg_run_programmes{state="ingested"}'], 2)
+        self.assertEqual(samples['hdhomerun_epg_run_programmes{state="written"}'], 2)
+        self.assertIn("hdhomerun_epg_run_http_requests", samples)
+        self.assertIn("hdhomerun_epg_run_guide_cutoff_timestamp_seconds", samples)
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)), ["epg.xml", "epg.xml.metrics", "epg.xml.sha256"])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Test script to verify incremental decoding of guide.php responses.
+"""
+
+import io
+import json
+import time
+import tracemalloc
+import unittest
+
+import pytest
+
+import HDHomeRunEPG_To_XmlTv as hdhomerun
+
+
+def build_guide_response(channels: int, programmes_per_channel: int) -> bytes:
+    """Build a guide.php response body for a synthetic lineup."""
+    return json.dumps([
+        {
+            "GuideNumber": f"{number}.1",
+            "GuideName": f"Channel {number}",
+            "ImageURL": f"https://img.hdhomerun.com/channels/{number}.png",
+            "Guide": [
+                {"StartTime": 1700000000 + index * 1800, "EndTime": 1700001800 + index * 1800,
+                 "Title": f"Programme {index}", "EpisodeTitle": f"Episode \"{index}\" \\ ✓",
+                 "Synopsis": "A synthetic programme description with [brackets] and {braces} " * 3,
+                 "Filter": ["Drama"], "SeriesID": f"C{index:06d}"}
+                for index in range(programmes_per_channel)
+            ],
+        }
+        for number in range(channels)
+    ], ensure_ascii=False).encode()
+
+
+class TestIterJsonArray(unittest.TestCase):
+    """Test iter_json_array against json.loads."""
+
+    def test_elements_match_json_loads(self):
+        """Test that every chunk size, including ones splitting escapes and UTF-8, decodes identically."""
+        body = build_guide_response(3, 4)
+        for chunk_size in (1, 2, 3, 7, 64, 65536):
+            self.assertEqual(list(hdhomerun.iter_json_array(io.BytesIO(body), chunk_size)), json.loads(body))
+
+    def test_empty_array(self):
+        """Test that an empty array yields nothing."""
+        self.assertEqual(list(hdhomerun.iter_json_array(io.BytesIO(b" [ ]\n"))), [])
+
+    def test_invalid_documents_raise(self):
+        """Test that non-array, malformed and truncated documents raise JSONDecodeError."""
+        for body in (b'{"Error": "DeviceAuth"}', b'[{"a": 1},]', b'[{"a": 1} {"b": 2}]', b'[1, 2]',
+                     b'[{"a": ]}]', b'[{"a": 1}', b'[{"a": 1}] []', b''):
+            with self.subTest(body=body), self.assertRaises(json.JSONDecodeError):
+                list(hdhomerun.iter_json_array(io.BytesIO(body), chunk_size=4))
+
+    def test_guide_window_is_decoded_to_records(self):
+        """Test that a streamed window matches decoding the whole response, without untuned channels."""
+        body = build_guide_response(3, 4)
+        segment = hdhomerun._decode_guide_window(hdhomerun.iter_json_array(io.BytesIO(body), 256), {"0.1", "2.1"})
+
+        expected = hdhomerun._decode_guide_window(json.loads(body), {"0.1", "2.1"})
+        self.assertEqual(segment, expected)
+        self.assertEqual([guide_number for guide_number, _, _ in segment], ["0.1", "2.1"])
+
+
+def peak_allocated(decode, body: bytes) -> int:
+    """Return the peak bytes allocated while ``decode`` consumes a response read from a file object."""
+    tracemalloc.start()
+    try:
+        decode(io.BytesIO(body))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+@pytest.mark.slow
+class TestStreamingJsonMemory(unittest.TestCase):
+    """Compare peak memory and decode time of streaming and whole-response decoding for one guide window."""
+
+    def test_streaming_peak_is_bounded_by_one_channel(self):
+        """Test that walking a 300 channel window holds about one channel instead of the whole response."""
+        body = build_guide_response(300, 24)
+        channel_size = len(body) // 300
+
+        def whole(response):
+            for channel_epg_segment in json.loads(response.read().decode()):
+                channel_epg_segment.clear()
+
+        def streaming(response):
+            for channel_epg_segment in hdhomerun.iter_json_array(response):
+                channel_epg_segment.clear()
+
+        whole_peak = peak_allocated(whole, body)
+        streaming_peak = peak_allocated(streaming, body)
+        # Four times as many channels must not raise the streaming peak
+        larger_peak = peak_allocated(streaming, build_guide_response(1200, 24))
+        print(f"✓ {len(body) / 2**20:.1f} MiB window: whole response peak {whole_peak / 2**20:.1f} MiB, "
+              f"streaming peak {streaming_peak / 2**10:.0f} KiB ({channel_size / 2**10:.0f} KiB per channel), "
+              f"{larger_peak / 2**10:.0f} KiB at 1200 channels")
+        self.assertLess(streaming_peak, whole_peak / 10)
+        self.assertLess(larger_peak, streaming_peak * 1.5)
+
+    def test_streaming_decode_keeps_pace_with_json_loads(self):
+        """Test that decoding element by element costs little more than decoding the whole response."""
+        body = build_guide_response(300, 24)
+
+        def best_of(decode):
+            timings = []
+            for _ in range(5):
+                began = time.perf_counter()
+                decode()
+                timings.append(time.perf_counter() - began)
+            return min(timings)
+
+        whole = best_of(lambda: json.loads(body.decode()))
+        streaming = best_of(lambda: list(hdhomerun.iter_json_array(io.BytesIO(body))))
+        print(f"✓ json.loads {whole * 1000:.1f} ms, iter_json_array {streaming * 1000:.1f} ms "
+              f"({streaming / whole:.2f}x)")
+        self.assertLess(streaming, whole * 2)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
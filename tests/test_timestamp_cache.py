@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Test script to verify memoized timestamp conversion for XMLTV programmes.
+"""
+
+import datetime
+import time
+import unittest
+import zoneinfo
+from unittest.mock import patch
+
+import pytest
+import pytz
+
+import HDHomeRunEPG_To_XmlTv as hdhomerun
+
+NEW_YORK = zoneinfo.ZoneInfo("America/New_York")
+# 2024-11-03 04:30 UTC is 00:30 EDT, two hours before the clocks go back
+DST_END = 1730608200
+
+
+def clear_time_caches() -> None:
+    for cached in (hdhomerun._local_datetime, hdhomerun._local_midnight, hdhomerun._xmltv_times, hdhomerun._xmltv_date):
+        cached.cache_clear()
+
+
+def uncached_xmltv_times(start: int, end: int) -> tuple:
+    """Format programme times the way create_xmltv_programme did before memoization."""
+    start_time = datetime.datetime.fromtimestamp(start, tz=pytz.UTC).astimezone(hdhomerun.LOCAL_TZ)
+    end_time = start_time + datetime.timedelta(seconds=end - start)
+    return start_time.strftime("%Y%m%d%H%M%S %z"), end_time.strftime("%Y%m%d%H%M%S %z")
+
+
+def synthetic_times(count: int, channels: int = 300) -> list:
+    """Build (start, end) pairs on half-hour boundaries shared across channels."""
+    slots = count // channels + 1
+    return [(DST_END + (slot % 672) * 1800, DST_END + (slot % 672 + 1 + channel % 2) * 1800)
+            for slot in range(slots) for channel in range(channels)][:count]
+
+
+class TestTimestampCache(unittest.TestCase):
+    """Test that memoized conversions match the original formatting."""
+
+    def setUp(self):
+        clear_time_caches()
+        self.tz_patch = patch('HDHomeRunEPG_To_XmlTv.LOCAL_TZ', NEW_YORK)
+        self.tz_patch.start()
+
+    def tearDown(self):
+        self.tz_patch.stop()
+        clear_time_caches()
+
+    def test_times_match_uncached_formatting(self):
+        """Test start/stop strings across a DST transition match the original conversion."""
+        for start, end in synthetic_times(2000, channels=3):
+            self.assertEqual(hdhomerun._xmltv_times(start, end), uncached_xmltv_times(start, end))
+
+    def test_previously_shown_matches_uncached_formatting(self):
+        """Test the previously-shown date and same-day check match the original conversion."""
+        for offset in range(0, 3 * 86400, 3600):
+            timestamp = DST_END + offset
+            local = datetime.datetime.fromtimestamp(timestamp, tz=pytz.UTC).astimezone(NEW_YORK)
+            self.assertEqual(hdhomerun._xmltv_date(timestamp), local.strftime("%Y%m%d%H%M%S"))
+            self.assertEqual(hdhomerun._local_midnight(timestamp), local.replace(hour=0, minute=0, second=0, microsecond=0))
+
+    def test_cache_is_bounded(self):
+        """Test that the memo caches never grow past their configured size."""
+        info = hdhomerun._xmltv_times.cache_info()
+        self.assertEqual(info.maxsize, hdhomerun.XMLTV_TIME_CACHE_SIZE)
+
+
+@pytest.mark.slow
+class TestTimestampCacheBenchmark(unittest.TestCase):
+    """Microbenchmark memoized conversion on 100k programmes."""
+
+    def test_memoized_conversion_is_faster(self):
+        """Test that formatting 100k clustered programme times is much faster with the memo cache."""
+        times = synthetic_times(100_000)
+        clear_time_caches()
+        with patch('HDHomeRunEPG_To_XmlTv.LOCAL_TZ', NEW_YORK):
+            started = time.perf_counter()
+            for start, end in times:
+                uncached_xmltv_times(start, end)
+            uncached = time.perf_counter() - started
+
+            started = time.perf_counter()
+            for start, end in times:
+                hdhomerun._xmltv_times(start, end)
+            cached = time.perf_counter() - started
+        clear_time_caches()
+
+        print(f"✓ 100k programme times: uncached {uncached:.3f}s, memoized {cached:.3f}s")
+        self.assertLess(cached, uncached / 2)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
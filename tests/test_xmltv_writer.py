@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Test script to verify the streaming XMLTV writer produces the same file as the in-memory tree.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import HDHomeRunEPG_To_XmlTv as hdhomerun
+from tests.helpers import sample_epg_data
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def write_xmltv_tree(epg_data: dict, filename: str) -> None:
+    """Write XMLTV the original way, building the whole tree before indenting and writing it."""
+    xmltv_root = ET.Element("tv")
+    xmltv_root.set("source-info-name", "HDHomeRun")
+    xmltv_root.set("generator-info-name", "HDHomeRunEPG_to_XmlTv")
+    for guide_channel in epg_data.get("channels", []):
+        hdhomerun.create_xmltv_channel(guide_channel, xmltv_root)
+    for guide_channel in epg_data.get("channels", []):
+        guide_number = guide_channel.guide_number
+        for guide_programme in epg_data.get("programmes", []):
+            if guide_programme.guide_number == guide_number:
+                hdhomerun.create_xmltv_programme(guide_programme, guide_number, xmltv_root)
+    tree = ET.ElementTree(xmltv_root)
+    ET.indent(tree, space="\t", level=0)
+    tree.write(filename, encoding="UTF-8", xml_declaration=True)
+
+
+def as_records(epg_data: dict) -> dict:
+    """Convert API-style guide dicts to Channel and Programme records."""
+    return {
+        "channels": [hdhomerun.Channel.from_dict(channel) for channel in epg_data["channels"]],
+        "programmes": [hdhomerun.Programme.from_dict(programme["GuideNumber"], programme)
+                       for programme in epg_data["programmes"]],
+    }
+
+
+def every_element_epg_data() -> dict:
+    """Build guide data exercising every optional programme element."""
+    return as_records({
+        "channels": [
+            {"GuideNumber": "2.1", "GuideName": "KTVK & Friends", "ImageURL": "http://img/2.1.png"},
+            {"GuideNumber": "5.1", "GuideName": "Ünïcode <TV>", "ImageURL": ""},
+        ],
+        "programmes": [
+            {"GuideNumber": "2.1", "Title": "News", "StartTime": 1700000000, "EndTime": 1700001800,
+             "Synopsis": "Local \"news\" & weather", "Filter": ["News", "Local"], "First": True,
+             "OriginalAirdate": 1700000000},
+            {"GuideNumber": "5.1", "Title": "Drama", "EpisodeTitle": "Pilot", "EpisodeNumber": "S01E02",
+             "StartTime": 1700000000, "EndTime": 1700003600, "ImageURL": "http://img/drama.png",
+             "OriginalAirdate": 1600000000, "First": False},
+            {"GuideNumber": "2.1", "Title": "Sports", "StartTime": 1700001800, "EndTime": 1700005400,
+             "EpisodeNumber": "Special"},
+        ],
+    })
+
+
+class TestXmltvWriter(unittest.TestCase):
+    """Test write_xmltv against the in-memory ElementTree output."""
+
+    def assert_same_output(self, epg_data: dict) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            expected_file = os.path.join(tmpdir, "expected.xml")
+            actual_file = os.path.join(tmpdir, "nested", "actual.xml")
+            write_xmltv_tree(epg_data, expected_file)
+            hdhomerun.write_xmltv(epg_data, actual_file)
+            with open(expected_file, "rb") as expected, open(actual_file, "rb") as actual:
+                self.assertEqual(actual.read(), expected.read())
+
+    def test_output_is_identical(self):
+        """Test that streaming output matches the indented tree byte for byte."""
+        self.assert_same_output(every_element_epg_data())
+
+    def test_empty_guide_is_identical(self):
+        """Test that a guide without channels matches the indented tree byte for byte."""
+        self.assert_same_output({"channels": [], "programmes": []})
+
+    def test_worker_processes_produce_identical_output(self):
+        """Test that rendering channels in a process pool writes the same bytes as the serial path."""
+        epg_data = every_element_epg_data()
+        extra = sample_epg_data([hdhomerun.Channel(f"{number}.1", f"Channel {number}") for number in range(10, 20)],
+                                slots=20, fields=lambda index: {"episode_number": f"S01E{index + 1:02d}"})
+        epg_data["channels"] += extra["channels"]
+        epg_data["programmes"] += extra["programmes"]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            serial_file = os.path.join(tmpdir, "serial.xml")
+            parallel_file = os.path.join(tmpdir, "parallel.xml")
+            hdhomerun.write_xmltv(epg_data, serial_file)
+            hdhomerun.write_xmltv(epg_data, parallel_file, workers=3)
+            with open(serial_file, "rb") as serial, open(parallel_file, "rb") as parallel:
+                self.assertEqual(parallel.read(), serial.read())
+
+    def test_programmes_are_written_in_start_order(self):
+        """Test that each channel's programmes are written chronologically whatever the input order."""
+        epg_data = every_element_epg_data()
+        epg_data["programmes"].reverse()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "epg.xml")
+            hdhomerun.write_xmltv(epg_data, filename)
+            root = ET.parse(filename).getroot()
+
+        channels = [programme.get("channel") for programme in root.findall("programme")]
+        starts = [programme.get("start") for programme in root.findall("programme") if programme.get("channel") == "2.1"]
+        self.assertEqual(channels, ["2.1", "2.1", "5.1"], "Programmes should follow channel order")
+        self.assertEqual(starts, sorted(starts))
+
+
+def measure_peak_rss_growth(writer: str) -> int:
+    """Return the peak RSS growth in KiB while writing a synthetic guide in a fresh interpreter."""
+    script = textwrap.dedent(f"""
+        import json, os, sys, tempfile
+        sys.path.insert(0, {REPO_ROOT!r})
+        sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r})
+        import HDHomeRunEPG_To_XmlTv as hdhomerun
+        import test_xmltv_writer
+
+        def peak_rss():
+            # VmHWM is per process image, unlike ru_maxrss which inherits the parent's peak on fork
+            with open("/proc/self/status") as status:
+                return next(int(line.split()[1]) for line in status if line.startswith("VmHWM:"))
+
+        channels = [{{"GuideNumber": f"{{n}}.1", "GuideName": f"Channel {{n}}", "ImageURL": ""}} for n in range(100)]
+        programmes = [
+            {{"GuideNumber": channel["GuideNumber"], "Title": f"Programme {{i}}", "StartTime": 1700000000 + i * 1800,
+              "EndTime": 1700001800 + i * 1800, "Synopsis": "A synthetic programme description " * 4,
+              "Filter": ["Drama"], "EpisodeNumber": "S01E01", "First": False}}
+            for channel in channels for i in range(150)
+        ]
+        epg_data = test_xmltv_writer.as_records({{"channels": channels, "programmes": programmes}})
+        channels, programmes = epg_data["channels"], epg_data["programmes"]
+        # Warm up so lazily initialised machinery is not counted
+        with tempfile.TemporaryDirectory() as tmpdir:
+            hdhomerun.write_xmltv({{"channels": channels[:1], "programmes": programmes[:1]}}, os.path.join(tmpdir, "w.xml"))
+            test_xmltv_writer.write_xmltv_tree({{"channels": channels[:1], "programmes": programmes[:1]}}, os.path.join(tmpdir, "t.xml"))
+            baseline = peak_rss()
+            {writer}(epg_data, os.path.join(tmpdir, "epg.xml"))
+            print(json.dumps(peak_rss() - baseline))
+    """)
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+    return json.loads(result.stdout)
+
+
+@pytest.mark.slow
+@unittest.skipUnless(os.path.exists("/proc/self/status"), "peak RSS is read from /proc/self/status")
+class TestXmltvWriterMemory(unittest.TestCase):
+    """Benchmark peak RSS of the streaming writer against the in-memory tree."""
+
+    def test_streaming_writer_keeps_memory_flat(self):
+        """Test that streaming a 15,000 programme guide grows peak RSS far less than the tree."""
+        tree_growth = measure_peak_rss_growth("test_xmltv_writer.write_xmltv_tree")
+        streaming_growth = measure_peak_rss_growth("hdhomerun.write_xmltv")
+
+        print(f"✓ Peak RSS growth: tree {tree_growth} KiB, streaming {streaming_growth} KiB")
+        self.assertLess(streaming_growth, tree_growth / 4)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)